@@ -0,0 +1,275 @@
+"""Admission control and load shedding for the API.
+
+Every request to a limited route passes three gates:
+
+1. per-user concurrency (fail fast with 429 when the user is at the limit)
+2. a per-route limiter with a bounded, priority-ordered wait queue
+3. a global limiter that keeps ADMISSION_RESERVED_FOR_READS slots free
+   for interactive reads (GET), so bulk ingest cannot starve them
+
+Queue overflow and queue timeouts are answered with 503 + Retry-After.
+When the queue is full, a higher-priority arrival evicts the lowest-priority
+waiter instead of being rejected.
+"""
+import os
+import re
+import json
+import heapq
+import asyncio
+import itertools
+
+from metrics import metrics
+
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_ROUTE_LIMITS = os.getenv(
+    'ADMISSION_ROUTE_LIMITS',
+    '/api/sms/parse=16,/api/sms/batch=4,/api/ocr/upload=4,/api/transactions=32,/api/export=2'
+)
+ADMISSION_USER_LIMIT = int(os.getenv('ADMISSION_USER_LIMIT', '4'))
+ADMISSION_GLOBAL_LIMIT = int(os.getenv('ADMISSION_GLOBAL_LIMIT', '48'))
+ADMISSION_RESERVED_FOR_READS = int(os.getenv('ADMISSION_RESERVED_FOR_READS', '8'))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '64'))
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv('ADMISSION_QUEUE_TIMEOUT_MS', '2000'))
+
+INTERACTIVE = 0
+BULK = 1
+
+MAX_SNIFF_BODY = 64 * 1024
+_PATH_USER_ID = re.compile(r'^/api/(?:transactions(?:/stats)?|sms/history)/(\d+)')
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, status_code=503, retry_after=2):
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class PriorityLimiter:
+    """Concurrency limit with a bounded wait queue served in priority order"""
+
+    def __init__(self, name, limit, queue_size=ADMISSION_QUEUE_SIZE, reserved=0):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.reserved = reserved
+        self.in_flight = 0
+        self.queued = 0
+        self.waiters = []
+        self._order = itertools.count()
+
+    def _capacity(self, priority):
+        return self.limit if priority == INTERACTIVE else self.limit - self.reserved
+
+    def _publish(self):
+        metrics.set_gauge(f"admission.{self.name}.in_flight", self.in_flight)
+        metrics.set_gauge(f"admission.{self.name}.queue_depth", self.queued)
+
+    def _pending(self):
+        return [waiter for waiter in self.waiters if not waiter[2].done()]
+
+    async def acquire(self, priority, timeout):
+        ahead = any(waiter[0] <= priority for waiter in self._pending())
+        if not ahead and self.in_flight < self._capacity(priority):
+            self.in_flight += 1
+            self._publish()
+            return
+
+        if self.queued >= self.queue_size:
+            pending = self._pending()
+            worst = max(pending) if pending else None
+            if worst is None or worst[0] <= priority:
+                raise Overloaded(f"{self.name} queue full")
+            # Shed the lowest-priority waiter to make room
+            worst[2].set_exception(Overloaded(f"{self.name} shed for higher priority work"))
+            self.queued -= 1
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self._order), future))
+        self.queued += 1
+        self._publish()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException as error:
+            # Timed out, shed, or cancelled (client gone, shutdown): settle this waiter's accounting
+            granted = future.done() and not future.cancelled() and future.exception() is None
+            shed = future.done() and not future.cancelled() and future.exception() is not None
+            if granted:
+                # The slot was handed over just before we gave up: pass it on
+                self.release()
+            elif not shed:
+                self.queued -= 1
+                self._publish()
+            if isinstance(error, asyncio.TimeoutError):
+                raise Overloaded(f"{self.name} queue timeout") from None
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        while self.waiters:
+            priority, _, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if self.in_flight >= self._capacity(priority):
+                break
+            heapq.heappop(self.waiters)
+            self.queued -= 1
+            self.in_flight += 1
+            future.set_result(None)
+        self._publish()
+
+
+class AdmissionController:
+    def __init__(self, route_limits=ADMISSION_ROUTE_LIMITS, user_limit=ADMISSION_USER_LIMIT,
+                 global_limit=ADMISSION_GLOBAL_LIMIT, reserved_for_reads=ADMISSION_RESERVED_FOR_READS,
+                 queue_size=ADMISSION_QUEUE_SIZE, queue_timeout_ms=ADMISSION_QUEUE_TIMEOUT_MS):
+        self.routes = []
+        for item in route_limits.split(','):
+            if '=' not in item:
+                continue
+            prefix, limit = item.split('=', 1)
+            prefix = prefix.strip()
+            self.routes.append((prefix, PriorityLimiter(prefix.strip('/').replace('/', '.'), int(limit), queue_size)))
+        # Longest prefix wins
+        self.routes.sort(key=lambda route: len(route[0]), reverse=True)
+        self.global_limiter = PriorityLimiter("global", global_limit, queue_size, reserved_for_reads)
+        self.user_limit = user_limit
+        self.user_in_flight = {}
+        self.queue_timeout = queue_timeout_ms / 1000.0
+
+    def limiter_for(self, path):
+        for prefix, limiter in self.routes:
+            if path.startswith(prefix):
+                return limiter
+        return None
+
+    def _enter_user(self, user_id):
+        if user_id is None:
+            return
+        count = self.user_in_flight.get(user_id, 0)
+        if count >= self.user_limit:
+            raise Overloaded(f"user {user_id} has {count} requests in flight", status_code=429, retry_after=1)
+        self.user_in_flight[user_id] = count + 1
+
+    def _leave_user(self, user_id):
+        if user_id is None:
+            return
+        count = self.user_in_flight.get(user_id, 1) - 1
+        if count <= 0:
+            self.user_in_flight.pop(user_id, None)
+        else:
+            self.user_in_flight[user_id] = count
+
+    async def admit(self, limiter, user_id, priority):
+        """Pass all gates; returns the release callback"""
+        self._enter_user(user_id)
+        # Shed, timed out or cancelled (client gone, shutdown): give back what was taken
+        try:
+            await limiter.acquire(priority, self.queue_timeout)
+        except BaseException:
+            self._leave_user(user_id)
+            raise
+        try:
+            await self.global_limiter.acquire(priority, self.queue_timeout)
+        except BaseException:
+            limiter.release()
+            self._leave_user(user_id)
+            raise
+
+        def release():
+            self.global_limiter.release()
+            limiter.release()
+            self._leave_user(user_id)
+        return release
+
+
+async def _buffer_body(receive):
+    """Read the whole request body; returns (body, replaying receive)"""
+    messages = []
+    body = b''
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message['type'] != 'http.request':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body') or len(body) > MAX_SNIFF_BODY:
+            break
+
+    async def replay():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+    return body, replay
+
+
+async def request_user_id(scope, receive):
+    """Best-effort user id from path, query, X-User-Id or a JSON body"""
+    match = _PATH_USER_ID.match(scope['path'])
+    if match:
+        return int(match.group(1)), receive
+
+    headers = dict(scope.get('headers') or [])
+    if b'x-user-id' in headers:
+        try:
+            return int(headers[b'x-user-id']), receive
+        except ValueError:
+            pass
+
+    query = scope.get('query_string', b'').decode('latin-1')
+    for pair in query.split('&'):
+        if pair.startswith('user_id=') and pair[8:].isdigit():
+            return int(pair[8:]), receive
+
+    if scope['method'] == 'POST' and headers.get(b'content-type', b'').startswith(b'application/json'):
+        body, receive = await _buffer_body(receive)
+        try:
+            user_id = json.loads(body).get('user_id')
+            if isinstance(user_id, int):
+                return user_id, receive
+        except (ValueError, AttributeError):
+            pass
+    return None, receive
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying an AdmissionController to limited routes"""
+
+    def __init__(self, app, controller=None):
+        self.app = app
+        self.controller = controller or AdmissionController()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        limiter = self.controller.limiter_for(scope['path'])
+        if limiter is None:
+            return await self.app(scope, receive, send)
+
+        priority = INTERACTIVE if scope['method'] in ('GET', 'HEAD') else BULK
+        user_id, receive = await request_user_id(scope, receive)
+        try:
+            release = await self.controller.admit(limiter, user_id, priority)
+        except Overloaded as e:
+            metrics.inc(f"admission.rejected.{e.status_code}")
+            return await self._reject(send, e)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            release()
+
+    async def _reject(self, send, error):
+        body = json.dumps({"detail": error.reason}).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': error.status_code,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'retry-after', str(error.retry_after).encode()),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
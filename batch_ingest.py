@@ -0,0 +1,149 @@
+"""Compact MessagePack batch format for POST /api/sms/batch.
+
+Body (application/msgpack, optionally Content-Encoding: gzip or zstd):
+
+    {
+        "v": 1,
+        "user_id": 42,
+        "senders": [["VK-HDFCBK", "HDFC Bank"], ["AX-ICICIB", null]],
+        "messages": [
+            ["HDFC Bank: Rs. 1,500.00 debited ...", 0],
+            ["Your OTP is 123456", null]
+        ]
+    }
+
+Each message is [text, sender_index]; sender strings are sent once in the
+senders dictionary instead of once per message. Messages decode straight
+into (text, sender_number, sender_name) tuples, with no per-message
+pydantic model.
+
+msgpack is in requirement.txt; zstandard is optional (gzip always works).
+"""
+import os
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BATCH_FORMAT_VERSION = 1
+BATCH_MAX_MESSAGES = int(os.getenv('BATCH_MAX_MESSAGES', '5000'))
+# Limit on the decompressed body, so a small zstd/gzip bomb cannot blow up memory
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', str(8 * 1024 * 1024)))
+
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+class BatchFormatError(ValueError):
+    """Malformed batch; status_code is what the API should answer with"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def supported_encodings():
+    return ["identity", "gzip"] + (["zstd"] if zstandard is not None else [])
+
+
+def decompress(body, content_encoding=None, max_bytes=BATCH_MAX_BYTES):
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        data = body
+    elif encoding in ("gzip", "x-gzip"):
+        inflater = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        try:
+            data = inflater.decompress(body, max_bytes + 1)
+        except zlib.error as e:
+            raise BatchFormatError(f"Invalid gzip body: {e}")
+    elif encoding == "zstd":
+        if zstandard is None:
+            raise BatchFormatError("zstd encoding is not available on this server", status_code=415)
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                data = reader.read(max_bytes + 1)
+        except zstandard.ZstdError as e:
+            raise BatchFormatError(f"Invalid zstd body: {e}")
+    else:
+        raise BatchFormatError(f"Unsupported Content-Encoding: {encoding}", status_code=415)
+
+    if len(data) > max_bytes:
+        raise BatchFormatError(f"Batch exceeds {max_bytes} bytes once decompressed", status_code=413)
+    return data
+
+
+def decode_batch(data, max_messages=BATCH_MAX_MESSAGES):
+    """Unpack a batch; returns (user_id, [(text, sender_number, sender_name)])"""
+    if msgpack is None:
+        raise BatchFormatError("MessagePack support is not installed", status_code=501)
+    try:
+        batch = msgpack.unpackb(data, raw=False, strict_map_key=True,
+                                max_array_len=max(max_messages, 1024))
+    except (ValueError, msgpack.UnpackException) as e:
+        raise BatchFormatError(f"Invalid MessagePack body: {e}")
+
+    if not isinstance(batch, dict):
+        raise BatchFormatError("Batch must be a map")
+    if batch.get("v", BATCH_FORMAT_VERSION) != BATCH_FORMAT_VERSION:
+        raise BatchFormatError(f"Unsupported batch version: {batch.get('v')}")
+    user_id = batch.get("user_id")
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise BatchFormatError("user_id must be an integer")
+
+    senders = batch.get("senders") or []
+    raw_messages = batch.get("messages")
+    if not isinstance(senders, list) or not isinstance(raw_messages, list):
+        raise BatchFormatError("senders and messages must be arrays")
+    if len(raw_messages) > max_messages:
+        raise BatchFormatError(f"Batch has {len(raw_messages)} messages (max {max_messages})", status_code=413)
+
+    sender_table = []
+    for entry in senders:
+        if not isinstance(entry, list) or not entry or len(entry) > 2:
+            raise BatchFormatError("Each sender must be [number, name]")
+        number = entry[0]
+        name = entry[1] if len(entry) > 1 else None
+        sender_table.append((number, name))
+
+    messages = []
+    for position, entry in enumerate(raw_messages):
+        if isinstance(entry, str):
+            text, sender_index = entry, None
+        elif isinstance(entry, list) and entry and len(entry) <= 2:
+            text = entry[0]
+            sender_index = entry[1] if len(entry) > 1 else None
+        else:
+            raise BatchFormatError(f"Message {position} must be [text, sender_index]")
+        if not isinstance(text, str):
+            raise BatchFormatError(f"Message {position} text must be a string")
+        if sender_index is None:
+            messages.append((text, None, None))
+            continue
+        if not isinstance(sender_index, int) or not 0 <= sender_index < len(sender_table):
+            raise BatchFormatError(f"Message {position} has an unknown sender index")
+        number, name = sender_table[sender_index]
+        messages.append((text, number, name))
+    return user_id, messages
+
+
+def encode_batch(user_id, messages):
+    """Client-side helper: [(text, sender_number, sender_name)] -> msgpack bytes"""
+    senders, index = [], {}
+    packed = []
+    for text, number, name in messages:
+        if number is None and name is None:
+            packed.append([text, None])
+            continue
+        key = (number, name)
+        if key not in index:
+            index[key] = len(senders)
+            senders.append([number, name])
+        packed.append([text, index[key]])
+    return msgpack.packb({"v": BATCH_FORMAT_VERSION, "user_id": user_id,
+                          "senders": senders, "messages": packed})
@@ -0,0 +1,301 @@
+"""Opt-in capture of live API traffic for replay.py.
+
+With CAPTURE_ENABLED=true, CaptureMiddleware records requests to
+CAPTURE_PATHS (by default /api/sms/ and /api/transactions/) together with
+their arrival time, status and latency. The request path only copies the
+body and puts the request on a bounded queue; a background thread then
+anonymizes it and appends it to rotating JSONL files in CAPTURE_DIR. When
+the queue is full the request is not captured (capture.dropped in
+/api/metrics).
+
+Anonymization keeps what the parser and the database react to (amounts,
+dates, bank sender headers, merchant names, message shape) and replaces
+identifiers:
+- user ids, in the path, the query and the body, become stable pseudonyms
+  (HMAC with CAPTURE_SALT, so one user keeps one pseudonym per salt)
+- digit runs of 6 or more (phone numbers, OTPs, references, card and
+  account numbers), also when written in groups joined by spaces or
+  hyphens ("4111 1111 1111 1111", "98765 43210"), keep their shape but
+  become 9s; amounts after a currency token and dates are kept
+- masked account tails like XX1234 become XX0000
+- UPI ids and e-mail addresses become user@upi
+- phone-number senders are masked and sender_name is dropped
+Personal names inside message text (e.g. "paid to RAHUL SHARMA") cannot be
+told apart from merchants and are kept, so treat captures as confidential.
+
+One JSON object per line:
+    {"t": 1700000000.123, "method": "POST", "path": "/api/sms/parse", "query": "",
+     "headers": {"content-type": "application/json"}, "body": {...},
+     "status": 200, "latency_ms": 12.3}
+Binary bodies (/api/sms/batch MessagePack) are stored as "body_b64".
+"""
+import os
+import re
+import hmac
+import json
+import time
+import queue
+import base64
+import random
+import hashlib
+import threading
+from urllib.parse import parse_qsl, urlencode
+
+from metrics import metrics
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+CAPTURE_ENABLED = os.getenv('CAPTURE_ENABLED', 'false').lower() == 'true'
+CAPTURE_DIR = os.getenv('CAPTURE_DIR', 'captures')
+CAPTURE_PATHS = [path.strip() for path in os.getenv('CAPTURE_PATHS', '/api/sms/,/api/transactions/').split(',')
+                 if path.strip()]
+CAPTURE_SAMPLE = float(os.getenv('CAPTURE_SAMPLE', '1.0'))
+CAPTURE_SALT = os.getenv('CAPTURE_SALT') or os.urandom(16).hex()
+CAPTURE_FILE_BYTES = int(os.getenv('CAPTURE_FILE_BYTES', str(64 * 1024 * 1024)))
+CAPTURE_MAX_FILES = int(os.getenv('CAPTURE_MAX_FILES', '20'))
+CAPTURE_MAX_BODY = int(os.getenv('CAPTURE_MAX_BODY', str(1024 * 1024)))
+CAPTURE_QUEUE_SIZE = int(os.getenv('CAPTURE_QUEUE_SIZE', '10000'))
+
+KEPT_HEADERS = (b'content-type', b'content-encoding', b'accept', b'accept-encoding')
+
+_USER_PATH = re.compile(r'^(/api/(?:transactions(?:/stats)?|sms/history)/)(\d+)')
+# Digit groups joined by spaces/hyphens; currency amounts and dates match first and are kept.
+# A group chain is consumed whole (no lookahead to backtrack from), so this stays linear.
+_LONG_DIGITS = re.compile(r'''(?ix)
+    (?:\b(?:rs\.?|inr)|₹)\s*\d[\d,]*(?:\.\d+)?
+  | (?<![\d.,])\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4}(?!\d)
+  | (?<![\d.,])(\d+(?:[ -]\d+)*)
+''')
+_AMOUNT_TAIL = re.compile(r',\d|\.\d')
+MIN_MASKED_DIGITS = 6
+_ACCOUNT_TAIL = re.compile(r'(?i)((?:x|\*){2,})\d{2,6}')
+_HANDLE = re.compile(r'[\w.+-]+@[\w.-]+')
+_PHONE = re.compile(r'^\+?\d[\d\s-]{6,}$')
+
+
+def pseudonym(user_id, salt=CAPTURE_SALT):
+    """Stable positive 31-bit stand-in for a user id"""
+    digest = hmac.new(salt.encode(), str(user_id).encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], "big") % (2 ** 31 - 1) + 1
+
+
+def anonymize_text(text):
+    if not isinstance(text, str):
+        return text
+    text = _HANDLE.sub("user@upi", text)
+    text = _ACCOUNT_TAIL.sub(lambda match: match.group(1) + "0" * (len(match.group(0)) - len(match.group(1))), text)
+    return _LONG_DIGITS.sub(_mask_digits, text)
+
+
+def _mask_digits(match):
+    digits = match.group(1)
+    if digits is None or sum(char.isdigit() for char in digits) < MIN_MASKED_DIGITS:
+        return match.group(0)
+    # Followed by ",123" or ".50": an amount written without a currency token
+    if _AMOUNT_TAIL.match(match.string, match.end()):
+        return digits
+    return re.sub(r'\d', '9', digits)
+
+
+def anonymize_sender(sender):
+    if isinstance(sender, str) and _PHONE.match(sender.strip()):
+        return re.sub(r'\d', '9', sender)
+    return sender
+
+
+def anonymize_message(message):
+    """One SMS dict from a JSON body"""
+    message = dict(message)
+    if isinstance(message.get("user_id"), int):
+        message["user_id"] = pseudonym(message["user_id"])
+    if "message_text" in message:
+        message["message_text"] = anonymize_text(message["message_text"])
+    if "sender_number" in message:
+        message["sender_number"] = anonymize_sender(message["sender_number"])
+    if message.get("sender_name") is not None:
+        message["sender_name"] = None
+    return message
+
+
+def anonymize_path(path):
+    return _USER_PATH.sub(lambda match: match.group(1) + str(pseudonym(int(match.group(2)))), path)
+
+
+def anonymize_query(query):
+    pairs = []
+    for name, value in parse_qsl(query, keep_blank_values=True):
+        if name == "user_id" and value.isdigit():
+            value = str(pseudonym(int(value)))
+        pairs.append((name, value))
+    return urlencode(pairs)
+
+
+def _anonymize_msgpack(body, content_encoding):
+    """Decode an /api/sms/batch body and re-encode it (uncompressed) without identifiers"""
+    from batch_ingest import decode_batch, decompress, encode_batch
+    user_id, messages = decode_batch(decompress(body, content_encoding))
+    messages = [(anonymize_text(text), anonymize_sender(number), None) for text, number, _ in messages]
+    return encode_batch(pseudonym(user_id), messages)
+
+
+def build_record(raw):
+    """Anonymized capture line from what the middleware saw (runs on the writer thread)"""
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in raw["headers"]}
+    record = {
+        "t": raw["t"],
+        "method": raw["method"],
+        "path": anonymize_path(raw["path"]),
+        "query": anonymize_query(raw["query"]),
+        "headers": headers,
+        "status": raw["status"],
+        "latency_ms": raw["latency_ms"],
+    }
+    body = raw["body"]
+    if body is None:
+        record["body_truncated"] = True
+        return record
+    if not body:
+        return record
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        payload = json.loads(body)
+        if isinstance(payload, dict) and isinstance(payload.get("messages"), list):
+            payload = dict(payload, messages=[anonymize_message(m) if isinstance(m, dict) else m
+                                              for m in payload["messages"]])
+        record["body"] = anonymize_message(payload) if isinstance(payload, dict) else payload
+    elif "msgpack" in content_type:
+        record["body_b64"] = base64.b64encode(
+            _anonymize_msgpack(body, headers.get("content-encoding"))).decode("ascii")
+        record["headers"].pop("content-encoding", None)
+    else:
+        # Unknown formats cannot be anonymized: keep the request shape only
+        record["body_bytes"] = len(body)
+    return record
+
+
+class CaptureWriter:
+    """Background thread turning captured requests into rotating JSONL files"""
+
+    def __init__(self, directory=CAPTURE_DIR, file_bytes=CAPTURE_FILE_BYTES, max_files=CAPTURE_MAX_FILES,
+                 queue_size=CAPTURE_QUEUE_SIZE):
+        self.directory = directory
+        self.file_bytes = file_bytes
+        self.max_files = max_files
+        self.queue = queue.Queue(queue_size)
+        self._file = None
+        self._written = 0
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, raw):
+        try:
+            self.queue.put_nowait(raw)
+        except queue.Full:
+            metrics.inc("capture.dropped")
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        name = f"capture-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{random.randrange(16 ** 4):04x}.jsonl"
+        self._file = open(os.path.join(self.directory, name), "a", encoding="utf-8")
+        self._written = 0
+        files = sorted(entry for entry in os.listdir(self.directory)
+                       if entry.startswith("capture-") and entry.endswith(".jsonl"))
+        for old in files[:max(len(files) - self.max_files, 0)]:
+            os.remove(os.path.join(self.directory, old))
+
+    def _run(self):
+        while True:
+            try:
+                raw = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._file is not None:
+                    self._file.flush()
+                continue
+            if raw is None:
+                break
+            try:
+                line = json.dumps(build_record(raw), ensure_ascii=False, default=str) + "\n"
+            except Exception as e:
+                metrics.inc("capture.unencodable")
+                log.debug("Capture skipped %s: %s", raw["path"], e)
+                continue
+            if self._file is None or self._written >= self.file_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._written += len(line)
+            metrics.inc("capture.recorded")
+        if self._file is not None:
+            self._file.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join(timeout=10)
+
+
+async def _read_body(receive, limit=CAPTURE_MAX_BODY):
+    """Read the request body up front; returns (body or None when over limit, replaying receive)"""
+    messages = []
+    body = b''
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message['type'] != 'http.request':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body') or len(body) > limit:
+            break
+
+    async def replay():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+    # Oversized bodies are not kept; replay.py skips such requests
+    return (body if len(body) <= limit and not messages[-1].get('more_body') else None), replay
+
+
+class CaptureMiddleware:
+    """ASGI middleware handing captured requests to a CaptureWriter"""
+
+    def __init__(self, app, writer, paths=None, sample=CAPTURE_SAMPLE):
+        self.app = app
+        self.writer = writer
+        self.paths = tuple(paths or CAPTURE_PATHS)
+        self.sample = sample
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] != 'http' or not scope['path'].startswith(self.paths)
+                or (self.sample < 1.0 and random.random() >= self.sample)):
+            return await self.app(scope, receive, send)
+
+        arrived = time.time()
+        started = time.perf_counter()
+        body, receive = await _read_body(receive)
+        status = None
+
+        async def capture_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture_send)
+        finally:
+            self.writer.submit({
+                "t": arrived,
+                "method": scope['method'],
+                "path": scope['path'],
+                "query": scope.get('query_string', b'').decode('latin-1'),
+                "headers": [(name, value) for name, value in scope.get('headers') or []
+                            if name in KEPT_HEADERS],
+                "body": body,
+                "status": status,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
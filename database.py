@@ -4,60 +4,141 @@ import os
 from dotenv import load_dotenv
 from datetime import datetime
 import time
+import threading
+import functools
+
+from merchant_index import DEFAULT_MERCHANTS
+from partitions import PARTITIONING_ENABLED, PartitionManager
+from profiler import profiler
+from spool import is_unavailable_error
+from log_config import get_logger
 
 load_dotenv()
 
-print("📦 Loading Database Module for finapp_sms...")
+log = get_logger(__name__)
+log.debug("📦 Loading Database Module for finapp_sms...")
+
+# Applies to the shared request connection; a slow database fails fast (and spools)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+
+def serialized(method):
+    """Run a Database method while holding its connection lock
+
+    self.conn is one psycopg2 connection, so one transaction, and it is used
+    from the event loop and from worker threads: a rollback in one thread must
+    not discard another thread's uncommitted insert.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class Database:
-    def __init__(self):
+    def __init__(self, params=None, name="default"):
+        # params: psycopg2.connect() kwargs (e.g. {"dsn": ...}); None reads DB_* from the env
+        self.params = params
+        self.name = name
         self.conn = None
+        self.lock = threading.RLock()
+        self._writes = threading.local()
         self.connect()
     
+    @serialized
     def connect(self):
         """Establish database connection with correct database name"""
         try:
-            print("Connecting to PostgreSQL...")
-            print(f"Database: {os.getenv('DB_NAME', 'finapp_sms')}")
-            print(f"User: {os.getenv('DB_USER', 'postgres')}")
-            print(f"Host: {os.getenv('DB_HOST', 'localhost')}")
+            if self.params is None:
+                log.info("Connecting to PostgreSQL (database %s, user %s, host %s)...",
+                         os.getenv('DB_NAME', 'finapp_sms'), os.getenv('DB_USER', 'postgres'),
+                         os.getenv('DB_HOST', 'localhost'))
+            else:
+                log.info("Connecting to PostgreSQL shard %s...", self.name)
             
-            self.conn = psycopg2.connect(
-                host=os.getenv('DB_HOST', 'localhost'),
-                database=os.getenv('DB_NAME', 'finapp_sms'),
-                user=os.getenv('DB_USER', 'postgres'),
-                password=os.getenv('DB_PASSWORD', 'postgres123'),
-                port=os.getenv('DB_PORT', '5432'),
-                connect_timeout=5
-            )
+            self.conn = psycopg2.connect(**self.connection_params())
             
             self.conn.autocommit = False
-            print(" Connected to finapp_sms database successfully!")
+            log.info(" Connected to finapp_sms database successfully! (shard %s)", self.name)
             
             # Create all tables
             self.create_all_tables()
             
+            if DB_STATEMENT_TIMEOUT_MS > 0:
+                with self.conn.cursor() as cursor:
+                    cursor.execute("SET statement_timeout = %s", (DB_STATEMENT_TIMEOUT_MS,))
+                self.conn.commit()
+            
         except psycopg2.OperationalError as e:
-            print(f" Database connection failed: {e}")
-            print("\nTroubleshooting steps:")
-            print("1. Make sure PostgreSQL is running")
-            print("2. Check if database 'finapp_sms' exists")
-            print("3. Verify credentials in .env file")
-            print("4. Try: CREATE DATABASE finapp_sms;")
+            log.error(" Database connection failed: %s\n"
+                      "Troubleshooting steps:\n"
+                      "1. Make sure PostgreSQL is running\n"
+                      "2. Check if database 'finapp_sms' exists\n"
+                      "3. Verify credentials in .env file\n"
+                      "4. Try: CREATE DATABASE finapp_sms;", e)
             self.conn = None
         except Exception as e:
-            print(f" Unexpected error: {e}")
+            log.error(" Unexpected error: %s", e)
             self.conn = None
     
+    @serialized
+    def reconnect(self):
+        """Connect again if the connection was lost; safe to call from any thread"""
+        if self.conn is None or self.conn.closed:
+            self.connect()
+    
+    def connection_params(self):
+        if self.params is not None:
+            return {"connect_timeout": 5, **self.params}
+        return {
+            "host": os.getenv('DB_HOST', 'localhost'),
+            "database": os.getenv('DB_NAME', 'finapp_sms'),
+            "user": os.getenv('DB_USER', 'postgres'),
+            "password": os.getenv('DB_PASSWORD', 'postgres123'),
+            "port": os.getenv('DB_PORT', '5432'),
+            "connect_timeout": 5
+        }
+    
+    def new_connection(self, user_id=None):
+        """Open a separate connection for background jobs (never shares self.conn)"""
+        try:
+            conn = psycopg2.connect(**self.connection_params())
+            conn.autocommit = False
+            return conn
+        except psycopg2.OperationalError as e:
+            log.error(" Database connection failed: %s", e)
+            return None
+    
+    # Same interface as sharding.ShardedDatabase, for code that works per shard
+    def shard_for(self, user_id):
+        return self
+    
+    def shard(self, name):
+        if name not in (None, self.name):
+            raise KeyError(f"Unknown shard: {name} (DB_SHARDS is not set)")
+        return self
+    
+    def shard_databases(self):
+        return [self]
+    
+    def write_unavailable(self, user_id=None):
+        """Whether this thread's last save failed for lack of a database (worth spooling)"""
+        return getattr(self._writes, "unavailable", False)
+    
+    def _write_failed(self, error=None):
+        self._writes.unavailable = error is None or is_unavailable_error(error)
+    
+    @serialized
     def create_all_tables(self):
         """Create all required tables"""
         if not self.conn:
-            print(" No database connection, skipping table creation")
+            log.warning(" No database connection, skipping table creation")
             return
         
         try:
             with self.conn.cursor() as cursor:
-                print("Creating/verifying tables in finapp_sms...")
+                log.info("Creating/verifying tables in finapp_sms...")
+                # Worker processes start together: one at a time runs the DDL
+                cursor.execute("SELECT pg_advisory_lock(hashtext('finapp_sms.create_all_tables'))")
                 
                 # USERS TABLE
                 cursor.execute("""
@@ -69,7 +150,7 @@ class Database:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
-                print(" users table ready")
+                log.debug(" users table ready")
                 
                 # Insert test user
                 cursor.execute("""
@@ -93,7 +174,7 @@ class Database:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
-                print(" sms_messages table ready")
+                log.debug(" sms_messages table ready")
                 
                 # SMS TRANSACTIONS TABLE
                 cursor.execute("""
@@ -109,7 +190,7 @@ class Database:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
-                print(" sms_transactions table ready")
+                log.debug(" sms_transactions table ready")
                 
                 # MAIN TRANSACTIONS TABLE
                 cursor.execute("""
@@ -125,7 +206,30 @@ class Database:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
-                print(" transactions table ready")
+                log.debug(" transactions table ready")
+                
+                # Monthly partitions for the SMS/transaction tables
+                if PARTITIONING_ENABLED:
+                    self.conn.commit()
+                    PartitionManager(self.conn).setup()
+                
+                # Hot-path indexes (on the parent when partitioned)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_sms_messages_user_received
+                    ON sms_messages (user_id, received_at DESC)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_sms_transactions_sms_id
+                    ON sms_transactions (sms_id)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_transactions_user_date
+                    ON transactions (user_id, date DESC, created_at DESC)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_transactions_sms_id
+                    ON transactions (sms_id)
+                """)
                 
                 # SMS TEMPLATES TABLE
                 cursor.execute("""
@@ -140,7 +244,7 @@ class Database:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
-                print(" sms_templates table ready")
+                log.debug(" sms_templates table ready")
                 
                 # Insert SMS templates
                 templates = [
@@ -166,23 +270,182 @@ class Database:
                         ON CONFLICT DO NOTHING
                     """, (bank, amount_pat, merch_pat, date_pat, conf))
                 
-                print(f" {len(templates)} SMS templates inserted")
+                log.debug(" %s SMS templates inserted", len(templates))
+                
+                # MERCHANTS + ALIASES TABLES (canonical merchant index)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS merchants (
+                        id SERIAL PRIMARY KEY,
+                        canonical_name VARCHAR(255) UNIQUE NOT NULL,
+                        category VARCHAR(100) DEFAULT 'Uncategorized',
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS merchant_aliases (
+                        id SERIAL PRIMARY KEY,
+                        merchant_id INTEGER NOT NULL REFERENCES merchants(id),
+                        alias VARCHAR(255) UNIQUE NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                log.debug(" merchants/merchant_aliases tables ready")
+                
+                for canonical_name, category, aliases in DEFAULT_MERCHANTS:
+                    cursor.execute("""
+                        INSERT INTO merchants (canonical_name, category)
+                        VALUES (%s, %s)
+                        ON CONFLICT (canonical_name) DO NOTHING
+                    """, (canonical_name, category))
+                    for alias in aliases:
+                        cursor.execute("""
+                            INSERT INTO merchant_aliases (merchant_id, alias)
+                            SELECT id, %s FROM merchants WHERE canonical_name = %s
+                            ON CONFLICT (alias) DO NOTHING
+                        """, (alias, canonical_name))
+                
+                # Canonical merchant IDs on transaction rows
+                cursor.execute("ALTER TABLE sms_transactions ADD COLUMN IF NOT EXISTS merchant_id INTEGER")
+                cursor.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS merchant_id INTEGER")
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_transactions_user_merchant
+                    ON transactions (user_id, merchant_id)
+                """)
+                log.debug(" %s default merchants seeded", len(DEFAULT_MERCHANTS))
+                
+                # RECEIPT IMAGES TABLE (content-addressed by sha256)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS receipt_images (
+                        id SERIAL PRIMARY KEY,
+                        user_id INTEGER DEFAULT 1,
+                        filename VARCHAR(255),
+                        file_path TEXT NOT NULL,
+                        file_size BIGINT,
+                        sha256 CHAR(64) NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE (user_id, sha256)
+                    )
+                """)
+                cursor.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS receipt_id INTEGER")
+                # get_receipt_by_hash joins on it
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_transactions_receipt_id
+                    ON transactions (receipt_id)
+                """)
+                # Bumped on re-parse/edits so list ETags change with the data
+                cursor.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP")
+                log.debug(" receipt_images table ready")
+                
+                # RE-PARSE CHECKPOINTS (one row per reparse.py job)
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS reparse_checkpoints (
+                        job_name VARCHAR(100) PRIMARY KEY,
+                        last_sms_id INTEGER NOT NULL DEFAULT 0,
+                        rows_seen BIGINT DEFAULT 0,
+                        rows_updated BIGINT DEFAULT 0,
+                        rows_inserted BIGINT DEFAULT 0,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                log.debug(" reparse_checkpoints table ready")
+                
+                # PARSE QUEUE (INGEST_MODE=queue): unprocessed rows are the work queue
+                cursor.execute("ALTER TABLE sms_messages ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(100)")
+                cursor.execute("ALTER TABLE sms_messages ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP")
+                cursor.execute("ALTER TABLE sms_messages ADD COLUMN IF NOT EXISTS parse_attempts SMALLINT DEFAULT 0")
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_sms_messages_unprocessed
+                    ON sms_messages (id) WHERE processed = FALSE
+                """)
+                # Worker heartbeats: counters of the parse_worker.py processes, for /api/queue/stats
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS parse_workers (
+                        worker_id VARCHAR(100) PRIMARY KEY,
+                        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        processed BIGINT DEFAULT 0,
+                        transactions BIGINT DEFAULT 0,
+                        linked BIGINT DEFAULT 0,
+                        lease_lost BIGINT DEFAULT 0,
+                        batches_failed BIGINT DEFAULT 0,
+                        claim_lag_s NUMERIC(12,3)
+                    )
+                """)
+                log.debug(" parse queue columns ready")
+                
+                # SPOOL REPLAY LEDGER (spool.py): one row per journal record replayed
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS spool_replayed (
+                        spool_id VARCHAR(32) NOT NULL,
+                        seq BIGINT NOT NULL,
+                        sms_id INTEGER,
+                        replayed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (spool_id, seq)
+                    )
+                """)
+                log.debug(" spool_replayed table ready")
+                
+                # SHARD MOVE LEDGER (sharding.py): rows copied in from another shard
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS shard_moves (
+                        source_shard VARCHAR(64) NOT NULL,
+                        table_name VARCHAR(64) NOT NULL,
+                        source_id INTEGER NOT NULL,
+                        target_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        moved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (source_shard, table_name, source_id)
+                    )
+                """)
+                log.debug(" shard_moves table ready")
+                
+                # TRANSACTION LINKS (dedupe.py): extra notifications of a saved payment
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS transaction_links (
+                        id SERIAL PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        transaction_id INTEGER NOT NULL,
+                        sms_id INTEGER NOT NULL,
+                        link_type VARCHAR(32) DEFAULT 'duplicate',
+                        similarity NUMERIC(4,3),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_transaction_links_user_txn
+                    ON transaction_links (user_id, transaction_id)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_transaction_links_sms
+                    ON transaction_links (sms_id)
+                """)
+                log.debug(" transaction_links table ready")
                 
                 self.conn.commit()
-                print(" Database finapp_sms is fully set up and ready!")
+                log.info(" Database finapp_sms is fully set up and ready!")
                 
         except Exception as e:
-            print(f" Error creating tables: {e}")
+            log.error(" Error creating tables: %s", e)
             if self.conn:
                 self.conn.rollback()
+        finally:
+            if self.conn:
+                with self.conn.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock_all()")
+                self.conn.commit()
     
     # SMS Methods
+    @profiler.profiled
+    @serialized
     def save_sms_message(self, user_id, message_text, sender_number=None, 
-                        sender_name=None, is_bank_sms=False, bank_detected=None):
+                        sender_name=None, is_bank_sms=False, bank_detected=None,
+                        processed=False):
         """Save incoming SMS message"""
+        self._writes.unavailable = False
         if not self.conn:
-            print(" No database connection, returning test ID")
-            return 999  # Test ID for offline mode
+            log.warning(" No database connection, SMS not saved")
+            self._write_failed()
+            return None
         
         try:
             with self.conn.cursor() as cursor:
@@ -193,49 +456,57 @@ class Database:
                     VALUES (%s, %s, %s, %s, %s, %s, %s)
                     RETURNING id
                 """, (user_id, message_text, sender_number, sender_name,
-                     is_bank_sms, bank_detected, False))
+                     is_bank_sms, bank_detected, processed))
                 
                 sms_id = cursor.fetchone()[0]
                 self.conn.commit()
-                print(f" SMS saved to database with ID: {sms_id}")
+                log.debug(" SMS saved to database with ID: %s", sms_id)
                 return sms_id
                 
         except Exception as e:
-            print(f" Error saving SMS: {e}")
+            log.error(" Error saving SMS: %s", e)
+            self._write_failed(e)
             if self.conn:
                 self.conn.rollback()
             return None
     
+    @profiler.profiled
+    @serialized
     def save_parsed_sms_transaction(self, user_id, sms_id, amount, merchant, 
-                                   transaction_date, bank_name, confidence=0.0):
+                                   transaction_date, bank_name, confidence=0.0,
+                                   merchant_id=None, category='Uncategorized'):
         """Save parsed transaction from SMS"""
+        self._writes.unavailable = False
         if not self.conn:
-            print(" No database connection, returning test ID")
-            return 888  # Test ID for offline mode
+            log.warning(" No database connection, transaction not saved")
+            self._write_failed()
+            return None
         
         try:
             with self.conn.cursor() as cursor:
                 # Save to sms_transactions
                 cursor.execute("""
                     INSERT INTO sms_transactions 
-                    (user_id, sms_id, amount, merchant, transaction_date, bank_name, confidence)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    (user_id, sms_id, amount, merchant, transaction_date, bank_name, confidence,
+                     merchant_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                     RETURNING id
-                """, (user_id, sms_id, amount, merchant, transaction_date, bank_name, confidence))
+                """, (user_id, sms_id, amount, merchant, transaction_date, bank_name, confidence,
+                     merchant_id))
                 
                 txn_id = cursor.fetchone()[0]
-                print(f" SMS transaction saved with ID: {txn_id}")
+                log.debug(" SMS transaction saved with ID: %s", txn_id)
                 
                 # Also save to main transactions table
                 cursor.execute("""
                     INSERT INTO transactions 
-                    (user_id, amount, date, merchant, sms_id)
-                    VALUES (%s, %s, %s, %s, %s)
+                    (user_id, amount, date, merchant, merchant_id, category, sms_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
                     RETURNING id
-                """, (user_id, amount, transaction_date, merchant, sms_id))
+                """, (user_id, amount, transaction_date, merchant, merchant_id, category, sms_id))
                 
                 main_txn_id = cursor.fetchone()[0]
-                print(f" Main transaction saved with ID: {main_txn_id}")
+                log.debug(" Main transaction saved with ID: %s", main_txn_id)
                 
                 # Mark SMS as processed
                 cursor.execute("UPDATE sms_messages SET processed = TRUE WHERE id = %s", (sms_id,))
@@ -244,15 +515,223 @@ class Database:
                 return txn_id
                 
         except Exception as e:
-            print(f" Error saving parsed transaction: {e}")
+            log.error(" Error saving parsed transaction: %s", e)
+            self._write_failed(e)
             if self.conn:
                 self.conn.rollback()
             return None
     
+    @profiler.profiled
+    @serialized
+    def save_transaction_link(self, user_id, transaction_id, sms_id, similarity=None,
+                              link_type='duplicate'):
+        """Link an SMS to an existing sms_transactions row instead of saving it again"""
+        self._writes.unavailable = False
+        if not self.conn:
+            log.warning(" No database connection, transaction link not saved")
+            self._write_failed()
+            return None
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO transaction_links
+                    (user_id, transaction_id, sms_id, link_type, similarity)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id
+                """, (user_id, transaction_id, sms_id, link_type, similarity))
+                link_id = cursor.fetchone()[0]
+                cursor.execute("UPDATE sms_messages SET processed = TRUE WHERE id = %s", (sms_id,))
+                self.conn.commit()
+                log.debug(" SMS %s linked to transaction %s", sms_id, transaction_id)
+                return link_id
+                
+        except Exception as e:
+            log.error(" Error saving transaction link: %s", e)
+            self._write_failed(e)
+            if self.conn:
+                self.conn.rollback()
+            return None
+    
+    # Receipt Methods
+    @profiler.profiled
+    @serialized
+    def save_receipt_image(self, user_id, filename, file_path, file_size, sha256):
+        """Save a stored receipt image (one row per user and image hash)"""
+        if not self.conn:
+            log.warning(" No database connection, receipt image not saved")
+            return None
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO receipt_images (user_id, filename, file_path, file_size, sha256)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (user_id, sha256) DO UPDATE SET filename = EXCLUDED.filename
+                    RETURNING id
+                """, (user_id, filename, file_path, file_size, sha256))
+                
+                image_id = cursor.fetchone()[0]
+                self.conn.commit()
+                log.debug(" Receipt image saved with ID: %s", image_id)
+                return image_id
+                
+        except Exception as e:
+            log.error(" Error saving receipt image: %s", e)
+            self.conn.rollback()
+            return None
+    
+    @profiler.profiled
+    @serialized
+    def get_receipt_by_hash(self, user_id, sha256):
+        """Find an already processed receipt image and its transaction"""
+        if not self.conn:
+            return None
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT ri.id, t.id
+                    FROM receipt_images ri
+                    LEFT JOIN transactions t ON t.receipt_id = ri.id
+                    WHERE ri.user_id = %s AND ri.sha256 = %s
+                    LIMIT 1
+                """, (user_id, sha256))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                return {"image_id": row[0], "transaction_id": row[1]}
+                
+        except Exception as e:
+            log.error(" Error looking up receipt: %s", e)
+            self.conn.rollback()
+            return None
+    
+    @profiler.profiled
+    @serialized
+    def save_transaction(self, user_id, amount, date, merchant, category='Uncategorized',
+                         source='manual', receipt_id=None, sms_id=None):
+        """Save a transaction that did not come from the SMS parser"""
+        if not self.conn:
+            log.warning(" No database connection, transaction not saved")
+            return None
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO transactions 
+                    (user_id, amount, date, merchant, category, source, receipt_id, sms_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                """, (user_id, amount, date, merchant, category, source, receipt_id, sms_id))
+                
+                txn_id = cursor.fetchone()[0]
+                self.conn.commit()
+                log.debug(" Transaction saved with ID: %s", txn_id)
+                return txn_id
+                
+        except Exception as e:
+            log.error(" Error saving transaction: %s", e)
+            self.conn.rollback()
+            return None
+    
+    @serialized
+    def get_merchant_aliases(self):
+        """Get (alias, merchant_id, canonical_name, category) rows for the merchant index"""
+        if not self.conn:
+            return None
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT ma.alias, m.id, m.canonical_name, m.category
+                    FROM merchant_aliases ma
+                    JOIN merchants m ON m.id = ma.merchant_id
+                """)
+                return cursor.fetchall()
+                
+        except Exception as e:
+            log.error(" Error loading merchant aliases: %s", e)
+            self.conn.rollback()
+            return None
+    
+    @profiler.profiled
+    @serialized
+    def get_user_write_version(self, user_id):
+        """(row count, max id, latest write time) of a user's transactions, for ETags"""
+        if not self.conn:
+            return None
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COUNT(*), MAX(id), MAX(COALESCE(updated_at, created_at))
+                    FROM transactions
+                    WHERE user_id = %s
+                """, (user_id,))
+                count, max_id, last_write = cursor.fetchone()
+                return count, max_id, last_write.isoformat() if last_write else None
+                
+        except Exception as e:
+            log.error(" Error getting write version: %s", e)
+            self.conn.rollback()
+            return None
+    
+    @serialized
+    def get_parse_queue_stats(self, lease_seconds, max_attempts):
+        """Backlog and lag of the sms_messages parse queue"""
+        if not self.conn:
+            return None
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT
+                        COUNT(*) FILTER (WHERE parse_attempts < %(max_attempts)s AND (claimed_at IS NULL
+                            OR claimed_at < NOW() - make_interval(secs => %(lease)s))),
+                        COUNT(*) FILTER (WHERE claimed_at >= NOW() - make_interval(secs => %(lease)s)),
+                        COUNT(*) FILTER (WHERE parse_attempts >= %(max_attempts)s),
+                        EXTRACT(EPOCH FROM NOW() - MIN(received_at))
+                    FROM sms_messages
+                    WHERE processed = FALSE
+                """, {"lease": lease_seconds, "max_attempts": max_attempts})
+                pending, leased, dead, oldest_age = cursor.fetchone()
+                # Workers heartbeat well within a lease; counters are totals over all workers
+                cursor.execute("""
+                    SELECT
+                        COUNT(*) FILTER (WHERE last_seen >= NOW() - make_interval(secs => %(lease)s)),
+                        COALESCE(SUM(processed), 0), COALESCE(SUM(transactions), 0), COALESCE(SUM(linked), 0),
+                        COALESCE(SUM(lease_lost), 0), COALESCE(SUM(batches_failed), 0),
+                        MAX(claim_lag_s) FILTER (WHERE last_seen >= NOW() - make_interval(secs => %(lease)s))
+                    FROM parse_workers
+                """, {"lease": lease_seconds})
+                workers, processed, transactions, linked, lease_lost, failed, claim_lag = cursor.fetchone()
+            self.conn.commit()
+            return {
+                "pending": pending,
+                "leased": leased,
+                "dead_letter": dead,
+                "oldest_unprocessed_age_s": round(float(oldest_age), 1) if oldest_age is not None else 0.0,
+                "workers": workers,
+                "processed": int(processed),
+                "transactions": int(transactions),
+                "linked": int(linked),
+                "lease_lost": int(lease_lost),
+                "batches_failed": int(failed),
+                "claim_lag_s": round(float(claim_lag), 1) if claim_lag is not None else 0.0
+            }
+            
+        except Exception as e:
+            log.error(" Error getting parse queue stats: %s", e)
+            self.conn.rollback()
+            return None
+    
+    @profiler.profiled
+    @serialized
     def get_user_transactions(self, user_id, limit=100):
         """Get all transactions for a user"""
         if not self.conn:
-            print(" No database connection, returning test data")
+            log.warning(" No database connection, returning test data")
             return [
                 {
                     "id": 1,
@@ -290,13 +769,15 @@ class Database:
                 return transactions
                 
         except Exception as e:
-            print(f" Error getting transactions: {e}")
+            log.error(" Error getting transactions: %s", e)
             return []
     
+    @profiler.profiled
+    @serialized
     def get_sms_history(self, user_id, limit=50):
         """Get SMS history for user"""
         if not self.conn:
-            print(" No database connection, returning test data")
+            log.warning(" No database connection, returning test data")
             return [
                 {
                     "id": 1,
@@ -341,9 +822,13 @@ class Database:
                 return messages
                 
         except Exception as e:
-            print(f" Error getting SMS history: {e}")
+            log.error(" Error getting SMS history: %s", e)
             return []
 
-# Create global instance
-db = Database()
-print(" Database module initialized successfully!")
+# Create global instance (DB_SHARDS spreads users over several databases)
+if os.getenv('DB_SHARDS'):
+    from sharding import ShardedDatabase
+    db = ShardedDatabase.from_env()
+else:
+    db = Database()
+log.debug(" Database module initialized successfully!")
@@ -0,0 +1,135 @@
+"""In-memory suppression of duplicate notifications for one payment.
+
+A single UPI payment usually arrives twice: the bank's debit alert and the
+payment app's confirmation. Both parse to the same user, amount, date and
+direction, so the second one would become a second transactions row.
+
+DuplicateIndex keeps, per user, the transactions saved in the last
+DEDUPE_WINDOW_S seconds, keyed by (amount, date, direction). A new
+transaction matches an entry with the same key when it came from a
+different sender (two identical coffees from the same bank are two
+payments; without both senders there is no telling, so nothing is linked)
+and the merchants agree: same canonical merchant_id, the same normalized
+name or a fuzzy match of the whole names (difflib ratio >=
+DEDUPE_MERCHANT_SIMILARITY), or one side has no merchant at all (bank
+alerts often omit it). A match is saved as a transaction_links row instead of a
+new transaction.
+
+Memory is bounded: at most DEDUPE_MAX_PER_USER entries per user (oldest
+evicted first) and DEDUPE_MAX_USERS users (least recently active evicted).
+The index is per API process and starts empty, so it is a cheap first line
+of defence, not a guarantee.
+"""
+import os
+import re
+import time
+import difflib
+import threading
+from collections import OrderedDict, deque
+
+DEDUPE_ENABLED = os.getenv('DEDUPE_ENABLED', 'true').lower() == 'true'
+DEDUPE_WINDOW_S = float(os.getenv('DEDUPE_WINDOW_S', '900'))
+DEDUPE_MAX_PER_USER = int(os.getenv('DEDUPE_MAX_PER_USER', '32'))
+DEDUPE_MAX_USERS = int(os.getenv('DEDUPE_MAX_USERS', '100000'))
+DEDUPE_MERCHANT_SIMILARITY = float(os.getenv('DEDUPE_MERCHANT_SIMILARITY', '0.6'))
+
+UNKNOWN_MERCHANTS = {"", "UNKNOWN MERCHANT"}
+_NOISE = re.compile(r'[^A-Z0-9 ]+')
+_SUFFIXES = re.compile(r'\b(?:PVT|PRIVATE|LTD|LIMITED|INDIA|IN|INC|LLP|CO)\b')
+
+
+def normalize_merchant(name):
+    if not name:
+        return ""
+    name = _NOISE.sub(" ", name.upper())
+    if name.strip() in UNKNOWN_MERCHANTS:
+        return ""
+    return " ".join(_SUFFIXES.sub(" ", name).split())
+
+
+def merchant_similarity(a, b, a_id=None, b_id=None):
+    """1.0 for the same canonical merchant, None when either side is unknown, else a fuzzy ratio"""
+    if a_id is not None and a_id == b_id:
+        return 1.0
+    a, b = normalize_merchant(a), normalize_merchant(b)
+    if not a or not b:
+        return None
+    if a == b:
+        return 1.0
+    # Whole names, not substrings: "OLA" must not match "COCA COLA"
+    return difflib.SequenceMatcher(None, " ".join(sorted(a.split())), " ".join(sorted(b.split()))).ratio()
+
+
+class _Entry:
+    __slots__ = ("key", "merchant", "merchant_id", "sender", "transaction_id", "seen_at")
+
+    def __init__(self, key, merchant, merchant_id, sender, transaction_id, seen_at):
+        self.key = key
+        self.merchant = merchant
+        self.merchant_id = merchant_id
+        self.sender = sender
+        self.transaction_id = transaction_id
+        self.seen_at = seen_at
+
+
+class DuplicateIndex:
+    def __init__(self, window_s=DEDUPE_WINDOW_S, max_per_user=DEDUPE_MAX_PER_USER,
+                 max_users=DEDUPE_MAX_USERS, min_similarity=DEDUPE_MERCHANT_SIMILARITY):
+        self.window_s = window_s
+        self.max_per_user = max_per_user
+        self.max_users = max_users
+        self.min_similarity = min_similarity
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(amount, date, direction):
+        return (round(float(amount), 2), date, direction)
+
+    def _entries(self, user_id, now):
+        """The user's live entries (expired ones dropped); marks the user recently active"""
+        entries = self._users.get(user_id)
+        if entries is None:
+            return None
+        self._users.move_to_end(user_id)
+        while entries and now - entries[0].seen_at > self.window_s:
+            entries.popleft()
+        return entries
+
+    def find(self, user_id, amount, date, direction, merchant=None, merchant_id=None,
+             sender=None, now=None):
+        """(transaction_id, similarity) of an earlier notification of this payment, or None"""
+        now = time.monotonic() if now is None else now
+        key = self.key(amount, date, direction)
+        with self._lock:
+            entries = self._entries(user_id, now)
+            if not entries:
+                return None
+            best = None
+            for entry in reversed(entries):
+                if entry.key != key:
+                    continue
+                if not sender or not entry.sender or sender == entry.sender:
+                    continue
+                similarity = merchant_similarity(merchant, entry.merchant, merchant_id, entry.merchant_id)
+                if similarity is not None and similarity < self.min_similarity:
+                    continue
+                if best is None or (similarity or 0.0) > (best[1] or 0.0):
+                    best = (entry.transaction_id, similarity)
+            return best
+
+    def remember(self, user_id, amount, date, direction, transaction_id, merchant=None,
+                 merchant_id=None, sender=None, now=None):
+        now = time.monotonic() if now is None else now
+        entry = _Entry(self.key(amount, date, direction), merchant, merchant_id, sender, transaction_id, now)
+        with self._lock:
+            entries = self._entries(user_id, now)
+            if entries is None:
+                entries = self._users[user_id] = deque(maxlen=self.max_per_user)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            entries.append(entry)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._users), "entries": sum(len(entries) for entries in self._users.values())}
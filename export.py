@@ -0,0 +1,291 @@
+"""Streaming bulk export of transactions.
+
+CSV is produced by PostgreSQL itself (COPY ... TO STDOUT) and Parquet /
+Arrow IPC from a server-side cursor read in fixed-size batches, so memory
+stays constant no matter how many rows are exported. Every export runs on
+its own read-only connection and never touches the API's shared one.
+
+pyarrow is optional; without it only CSV is available.
+
+CLI:
+    python export.py --user-id 1 -o user1.csv
+    python export.py --start 2024-01-01 --end 2024-04-01 --format parquet -o q1.parquet
+"""
+import sys
+import queue
+import argparse
+import threading
+from datetime import date
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EXPORT_BATCH_ROWS = 50000
+COPY_QUEUE_CHUNKS = 16
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+}
+
+EXPORT_COLUMNS = ("id", "user_id", "amount", "date", "merchant", "merchant_id", "category",
+                  "source", "sms_id", "receipt_id", "created_at", "updated_at")
+
+
+class ExportUnavailable(Exception):
+    pass
+
+
+def check_format(fmt):
+    """Raise ValueError/ExportUnavailable for formats that cannot be produced here"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt} (expected one of {', '.join(EXPORT_FORMATS)})")
+    if fmt != "csv" and pa is None:
+        raise ExportUnavailable(f"{fmt} export requires pyarrow")
+
+
+def export_query(cursor, user_id=None, start=None, end=None):
+    """SELECT for the requested slice, with parameters already bound (COPY takes no params)"""
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append("user_id = %s")
+        params.append(user_id)
+    # date is the partition key, so a range only scans the matching months
+    if start is not None:
+        conditions.append("date >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("date < %s")
+        params.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM transactions {where} ORDER BY date, id"
+    return cursor.mogrify(sql, params).decode("utf-8")
+
+
+def _begin_read_only(conn):
+    conn.set_session(readonly=True)
+
+
+class _QueueWriter:
+    """File-like target for copy_expert that hands chunks to a bounded queue"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise IOError("export consumer went away")
+        self.chunks.put(data if isinstance(data, bytes) else data.encode("utf-8"))
+        return len(data)
+
+
+def iter_csv(conn, user_id=None, start=None, end=None, header=True):
+    """Yield CSV bytes straight from COPY TO STDOUT
+
+    COPY runs in a helper thread; the bounded queue applies backpressure so a
+    slow reader pauses the server-side COPY instead of buffering the export.
+    """
+    _begin_read_only(conn)
+    chunks = queue.Queue(maxsize=COPY_QUEUE_CHUNKS)
+    writer = _QueueWriter(chunks)
+    done = object()
+    errors = []
+
+    def run_copy():
+        try:
+            with conn.cursor() as cursor:
+                sql = export_query(cursor, user_id, start, end)
+                cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH CSV{' HEADER' if header else ''}", writer)
+            conn.rollback()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunks.put(done)
+
+    thread = threading.Thread(target=run_copy, name="export-copy", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if errors:
+            raise errors[0]
+    finally:
+        writer.closed = True
+        # Unblock a COPY thread stuck on a full queue so it can see the close
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _arrow_schema():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("user_id", pa.int32()),
+        ("amount", pa.decimal128(10, 2)),
+        ("date", pa.date32()),
+        ("merchant", pa.string()),
+        ("merchant_id", pa.int32()),
+        ("category", pa.string()),
+        ("source", pa.string()),
+        ("sms_id", pa.int64()),
+        ("receipt_id", pa.int32()),
+        ("created_at", pa.timestamp("us")),
+        ("updated_at", pa.timestamp("us")),
+    ])
+
+
+class _ChunkSink:
+    """Writable that collects whatever pyarrow wrote since the last drain()"""
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def iter_columnar(conns, fmt, user_id=None, start=None, end=None, batch_rows=EXPORT_BATCH_ROWS):
+    """Yield Parquet (one row group per batch) or Arrow IPC stream bytes
+
+    conns: one connection, or one per shard written into the same file.
+    """
+    check_format(fmt)
+    conns = _as_list(conns)
+    for conn in conns:
+        _begin_read_only(conn)
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    output = pa.PythonFile(sink, mode="w")
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(output, schema, compression="zstd")
+        write = writer.write_table
+    else:
+        writer = ipc.new_stream(output, schema)
+        write = writer.write_batch
+
+    try:
+        for conn in conns:
+            # A named cursor keeps the result set on the server between fetches
+            with conn.cursor(name="transactions_export") as cursor:
+                cursor.itersize = batch_rows
+                cursor.execute(export_query(cursor, user_id, start, end))
+                while True:
+                    rows = cursor.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    columns = list(zip(*rows))
+                    batch = pa.RecordBatch.from_arrays(
+                        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                        schema=schema
+                    )
+                    write(pa.Table.from_batches([batch]) if fmt == "parquet" else batch)
+                    data = sink.drain()
+                    if data:
+                        yield data
+        writer.close()
+        yield sink.drain()
+    finally:
+        for conn in conns:
+            conn.rollback()
+
+
+def _as_list(conns):
+    return list(conns) if isinstance(conns, (list, tuple)) else [conns]
+
+
+def _iter_csv_shards(conns, user_id=None, start=None, end=None):
+    for position, conn in enumerate(conns):
+        yield from iter_csv(conn, user_id, start, end, header=position == 0)
+
+
+def iter_export(conns, fmt, user_id=None, start=None, end=None):
+    """conns: one connection, or one per shard (rows are ordered within each shard)"""
+    check_format(fmt)
+    if fmt == "csv":
+        return _iter_csv_shards(_as_list(conns), user_id, start, end)
+    return iter_columnar(conns, fmt, user_id, start, end)
+
+
+def open_export_connections(database, user_id=None):
+    """Dedicated connections: the user's shard, or every shard for cross-user exports"""
+    shards = [database.shard_for(user_id)] if user_id is not None else database.shard_databases()
+    conns = []
+    for shard in shards:
+        conn = shard.new_connection()
+        if conn is None:
+            for opened in conns:
+                opened.close()
+            return None
+        conns.append(conn)
+    return conns
+
+
+def export_filename(fmt, user_id=None, start=None, end=None):
+    parts = ["transactions"]
+    if user_id is not None:
+        parts.append(f"user{user_id}")
+    if start is not None or end is not None:
+        parts.append(f"{start or 'begin'}_{end or 'now'}")
+    return f"{'_'.join(parts)}.{EXPORT_FORMATS[fmt][1]}"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Stream a transactions export")
+    arg_parser.add_argument("--user-id", type=int)
+    arg_parser.add_argument("--start", type=date.fromisoformat, help="first date included (YYYY-MM-DD)")
+    arg_parser.add_argument("--end", type=date.fromisoformat, help="first date excluded (YYYY-MM-DD)")
+    arg_parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+    arg_parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = arg_parser.parse_args()
+
+    try:
+        check_format(args.format)
+    except ExportUnavailable as e:
+        print(f" {e}", file=sys.stderr)
+        raise SystemExit(2)
+
+    from database import db
+    conns = open_export_connections(db, args.user_id)
+    if conns is None:
+        raise SystemExit(1)
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    written = 0
+    try:
+        for chunk in iter_export(conns, args.format, args.user_id, args.start, args.end):
+            out.write(chunk)
+            written += len(chunk)
+    finally:
+        if args.output:
+            out.close()
+        for conn in conns:
+            conn.close()
+    print(f" Exported {written} bytes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Leveled logging through a queue, drained by one background thread.
+
+Modules log with log = get_logger(__name__). Records go through a
+QueueHandler into a bounded in-memory queue, and a QueueListener thread
+formats them and writes them to stderr. The request path never does log
+I/O and never blocks: when the queue is full the record is dropped and
+counted (logging.dropped in /api/metrics).
+
+Per-message traces (banners, matched patterns, results) are DEBUG and
+sampled: start_trace() decides once per message, and hot-path call sites
+check tracing() before building any log arguments.
+
+Settings:
+    LOG_LEVEL          DEBUG | INFO | WARNING | ERROR (default INFO)
+    LOG_FORMAT         text | json (one JSON object per line)
+    LOG_TRACE_SAMPLE   trace 1 in N messages when LOG_LEVEL=DEBUG (1 = all)
+    LOG_QUEUE_SIZE     records buffered before dropping
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+import logging.handlers
+
+from metrics import metrics
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_TRACE_SAMPLE = int(os.getenv('LOG_TRACE_SAMPLE', '1000'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+TEXT_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+_tracing = contextvars.ContextVar('log_tracing', default=False)
+_lock = threading.Lock()
+_handler = None
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "process": record.process,
+        }
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking on a full queue"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("logging.dropped")
+
+
+def _start_listener():
+    global _listener
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_handler.queue, stream, respect_handler_level=False)
+    _listener.start()
+
+
+def _after_fork():
+    # A forked child has the handler but not the listener thread: give it its own
+    global _listener
+    if _handler is not None:
+        _listener = None
+        _start_listener()
+
+
+def setup_logging(level=None):
+    """Install the queue handler on the root logger (idempotent)"""
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return
+        _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        root = logging.getLogger()
+        root.addHandler(_handler)
+        root.setLevel(getattr(logging, (level or LOG_LEVEL), logging.INFO))
+        _start_listener()
+        atexit.register(shutdown_logging)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_after_fork)
+
+
+def shutdown_logging():
+    """Flush queued records (the listener drains the queue before stopping)"""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(name)
+
+
+def start_trace(logger):
+    """Decide once per message whether its debug trace is logged"""
+    traced = logger.isEnabledFor(logging.DEBUG) and (
+        LOG_TRACE_SAMPLE <= 1 or random.randrange(LOG_TRACE_SAMPLE) == 0)
+    _tracing.set(traced)
+    return traced
+
+
+def tracing():
+    """True while the current message was sampled by start_trace()"""
+    return _tracing.get()
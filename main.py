@@ -1,21 +1,97 @@
 # main.py - SINGLE FastAPI App with ALL endpoints
 
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Header, Depends, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
 import uvicorn
-import shutil
+import asyncio
+import hashlib
+import hmac
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 # Import your modules
 from database import db
-from sms_parser import get_sms_parser
+from metrics import metrics
+from profiler import profiler
+from admission import ADMISSION_ENABLED, AdmissionMiddleware
+from sms_parser import MAX_SMS_LENGTH, get_sms_parser, resolve_fields
+from parse_executor import ParseExecutor
+from parse_result import results_to_json_bytes
+from responses import (ParseResultResponse, compressed_json_response, etag_matches,
+                       negotiate_encoding, not_modified)
+from receipt_pipeline import ReceiptStore, OCRJobQueue, OCRJob, ReceiptTooLarge, UnsupportedReceipt
+from partitions import PARTITIONING_ENABLED, run_maintenance
+from batch_ingest import MSGPACK_CONTENT_TYPES, BatchFormatError, decode_batch, decompress
+from parse_worker import INGEST_MODE, PARSE_LEASE_SECONDS, PARSE_MAX_ATTEMPTS
+from spool import SPOOL_ENABLED, Spool, drain, spool_record
+from prefilter import PREFILTER_ENABLED, TRANSACTIONAL, SMSPrefilter
+from log_config import get_logger, shutdown_logging
+from capture import CAPTURE_ENABLED, CaptureMiddleware, CaptureWriter
+from export import (EXPORT_FORMATS, ExportUnavailable, check_format, export_filename, iter_export,
+                    open_export_connections)
 
 # Initialize
 app = FastAPI(title="FinApp Backend", version="1.0")
-sms_parser = get_sms_parser(db)
+if ADMISSION_ENABLED:
+    app.add_middleware(AdmissionMiddleware)
+capture_writer = CaptureWriter() if CAPTURE_ENABLED else None
+if capture_writer is not None:
+    # Outermost, so shed requests are captured with their real arrival times
+    app.add_middleware(CaptureMiddleware, writer=capture_writer)
+local_spool = Spool() if SPOOL_ENABLED else None
+sms_parser = get_sms_parser(db, spool=local_spool)
+parse_executor = ParseExecutor(sms_parser)
+receipt_store = ReceiptStore()
+ocr_jobs = OCRJobQueue(db)
+
+PARTITION_MAINTENANCE_HOURS = float(os.getenv('PARTITION_MAINTENANCE_HOURS', '24'))
+SPOOL_REPLAY_SECONDS = float(os.getenv('SPOOL_REPLAY_SECONDS', '5'))
+background_tasks = []
+log = get_logger("main")
+
+async def partition_maintenance_loop():
+    """Create upcoming monthly partitions and archive expired raw SMS"""
+    while True:
+        await asyncio.sleep(PARTITION_MAINTENANCE_HOURS * 3600)
+        try:
+            for shard in db.shard_databases():
+                await asyncio.to_thread(run_maintenance, shard)
+        except Exception as e:
+            log.error("⚠️ Partition maintenance failed: %s", e)
+
+async def spool_replay_loop():
+    """Drain SMS spooled during database outages once Postgres is back"""
+    while True:
+        await asyncio.sleep(SPOOL_REPLAY_SECONDS)
+        if local_spool.backlog() <= 0:
+            continue
+        try:
+            await asyncio.to_thread(drain, local_spool, db)
+        except Exception as e:
+            log.error("⚠️ Spool replay failed: %s", e)
+
+@app.on_event("startup")
+async def start_background_workers():
+    parse_executor.start()
+    ocr_jobs.start()
+    if PARTITIONING_ENABLED and db.conn:
+        background_tasks.append(asyncio.create_task(partition_maintenance_loop()))
+    if local_spool is not None:
+        background_tasks.append(asyncio.create_task(spool_replay_loop()))
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    for task in background_tasks:
+        task.cancel()
+    await ocr_jobs.stop()
+    parse_executor.shutdown()
+    if local_spool is not None:
+        local_spool.close()
+    if capture_writer is not None:
+        capture_writer.close()
+    shutdown_logging()
 
 # Pydantic Models
 class SMSRequest(BaseModel):
@@ -34,72 +110,160 @@ class TransactionResponse(BaseModel):
     created_at: str
 
 # ============ OCR ENDPOINTS (Your existing) ============
-@app.post("/api/ocr/upload")
+@app.post("/api/ocr/upload", status_code=202)
 async def upload_receipt(
     user_id: int = Form(...),
     file: UploadFile = File(...)
 ):
-    """Upload receipt for OCR processing"""
+    """Upload receipt for OCR processing (returns a job to poll)"""
     try:
-        # Save file temporarily
-        temp_path = f"/tmp/{file.filename}"
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # TODO: Call your OCR processing
-        ocr_result = {
-            "amount": 1500.0,
-            "date": "2023-12-15",
-            "merchant": "Test Store",
-            "confidence": 0.85
-        }
-        
-        # Save to database
-        image_id = db.save_receipt_image(
-            user_id=user_id,
-            filename=file.filename,
-            file_path=temp_path,
-            file_size=os.path.getsize(temp_path)
-        )
-        
-        transaction_id = db.save_transaction(
-            user_id=user_id,
-            amount=ocr_result["amount"],
-            date=ocr_result["date"],
-            merchant=ocr_result["merchant"],
-            category="Shopping",
-            source="receipt_ocr",
-            receipt_id=image_id
-        )
-        
-        return {
-            "success": True,
-            "image_id": image_id,
-            "transaction_id": transaction_id,
-            "parsed_data": ocr_result
-        }
-        
+        sha256, file_path, file_size = await receipt_store.save_upload(file)
+    except ReceiptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UnsupportedReceipt as e:
+        raise HTTPException(status_code=415, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    # Same image already processed for this user: no new OCR job
+    existing = db.get_receipt_by_hash(user_id, sha256)
+    if existing:
+        return JSONResponse({"success": True, "duplicate": True, "image_sha256": sha256, **existing})
+    
+    job = ocr_jobs.find_active(user_id, sha256)
+    if job is None:
+        try:
+            job = ocr_jobs.submit(OCRJob(user_id, file.filename, sha256, file_path, file_size))
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="OCR queue is full, retry later",
+                                headers={"Retry-After": "5"})
+    
+    return {"success": True, "duplicate": False, **job.to_dict()}
+
+@app.get("/api/ocr/jobs/{job_id}")
+async def get_ocr_job(job_id: str):
+    """OCR job status and result"""
+    job = ocr_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+prefilter = SMSPrefilter() if PREFILTER_ENABLED else None
+
+def queue_raw_sms(user_id, message_text, sender_number=None, sender_name=None):
+    """Store a raw SMS for the parse workers; spools it when the database is down"""
+    # Non-transactional SMS are stored already processed, so workers never claim them
+    message_class = TRANSACTIONAL
+    if prefilter is not None:
+        # Runs on the event loop: classify no more text than the parser would read
+        message_class = prefilter.classify(message_text[:MAX_SMS_LENGTH], sender_number)
+        metrics.inc(f"prefilter.{message_class}")
+    sms_id = db.save_sms_message(
+        user_id=user_id,
+        message_text=message_text,
+        sender_number=sender_number,
+        sender_name=sender_name,
+        processed=message_class != TRANSACTIONAL
+    )
+    if sms_id is not None:
+        if message_class != TRANSACTIONAL:
+            return sms_id, "filtered"
+        metrics.inc("parse_queue.enqueued")
+        return sms_id, "queued"
+    if not db.write_unavailable(user_id):
+        raise HTTPException(status_code=500, detail="Could not store SMS")
+    if local_spool is None:
+        raise HTTPException(status_code=503, detail="Could not queue SMS")
+    local_spool.append(spool_record(user_id, message_text, sender_number, sender_name, None))
+    return None, "spooled"
+
+def queue_batch(user_id, messages):
+    return [queue_raw_sms(user_id, text, sender_number, sender_name)
+            for text, sender_number, sender_name in messages]
+
+def persist_batch(results, user_id, messages):
+    for result, (text, sender_number, sender_name) in zip(results, messages):
+        sms_parser.persist_result(result, user_id, text, sender_number, sender_name)
 
 # ============ SMS ENDPOINTS (NEW) ============
-@app.post("/api/sms/parse")
-async def parse_sms(sms_request: SMSRequest):
-    """Parse SMS message"""
+@app.post("/api/sms/parse", response_class=ParseResultResponse)
+async def parse_sms(sms_request: SMSRequest, fields: Optional[str] = None):
+    """Parse SMS message
+    
+    fields: comma-separated subset (e.g. amount,transaction_type); only those
+    extractors run and projected results are not saved.
+    """
+    field_list = None
+    if fields:
+        field_list = [name.strip() for name in fields.split(",") if name.strip()]
+        try:
+            resolve_fields(field_list)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    # Queue mode: store the raw SMS and let parse_worker.py do the rest
+    if INGEST_MODE == "queue" and field_list is None:
+        sms_id, status = queue_raw_sms(sms_request.user_id, sms_request.message_text,
+                                       sms_request.sender_number, sms_request.sender_name)
+        return JSONResponse(status_code=202, content={"success": True, "sms_id": sms_id, "status": status})
+    
     try:
-        result = sms_parser.parse_sms(
+        result = await parse_executor.parse(
+            user_id=sms_request.user_id,
+            message_text=sms_request.message_text,
+            sender_number=sms_request.sender_number,
+            fields=field_list
+        )
+        
+        # Persistence stays in the API process
+        sms_parser.persist_result(
+            result,
             user_id=sms_request.user_id,
             message_text=sms_request.message_text,
             sender_number=sms_request.sender_number,
             sender_name=sms_request.sender_name
         )
         
-        return result
+        return ParseResultResponse(result)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/sms/batch", response_class=ParseResultResponse)
+async def parse_sms_batch(request: Request, content_type: Optional[str] = Header(None),
+                          content_encoding: Optional[str] = Header(None)):
+    """Parse a MessagePack batch (see batch_ingest.py), optionally gzip/zstd encoded"""
+    if (content_type or "").split(";")[0].strip().lower() not in MSGPACK_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail="Expected application/msgpack")
+    body = await request.body()
+    try:
+        user_id, messages = decode_batch(decompress(body, content_encoding))
+    except BatchFormatError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    metrics.inc("sms_batch.requests")
+    metrics.inc("sms_batch.messages", len(messages))
+    metrics.inc("sms_batch.wire_bytes", len(body))
+    
+    # Per-message writes run off the event loop: a large batch must not stall other requests.
+    # Database serializes the shared connection between this thread and the handlers.
+    if INGEST_MODE == "queue":
+        queued = await asyncio.to_thread(queue_batch, user_id, messages)
+        return JSONResponse(status_code=202, content={
+            "success": True,
+            "sms_ids": [sms_id for sms_id, _ in queued],
+            "spooled": sum(1 for _, status in queued if status == "spooled"),
+            "status": "queued"
+        })
+    
+    try:
+        results = await parse_executor.parse_many(user_id, messages)
+        await asyncio.to_thread(persist_batch, results, user_id, messages)
+        return ParseResultResponse(results_to_json_bytes(results, user_id=user_id, count=len(results)))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/sms/test")
+@app.get("/api/sms/test", response_class=ParseResultResponse)
 async def test_sms_parser():
     """Test SMS parser with sample messages"""
     test_messages = [
@@ -118,18 +282,44 @@ async def test_sms_parser():
         )
         results.append(result)
     
-    return {
-        "tested": len(test_messages),
-        "results": results
-    }
+    return ParseResultResponse(results_to_json_bytes(results, tested=len(test_messages)))
 
 # ============ TRANSACTIONS ENDPOINTS (Unified) ============
+LIST_GROUP_FIELDS = ("source", "category", "merchant")
+
 @app.get("/api/transactions/{user_id}")
-async def get_transactions(user_id: int, limit: int = 100):
-    """Get ALL transactions for user (OCR + SMS)"""
+async def get_transactions(request: Request, user_id: int, limit: int = 100,
+                           lean: bool = False, group_by: Optional[str] = None):
+    """Get ALL transactions for user (OCR + SMS)
+    
+    lean=true returns each row once; group_by (source/category/merchant)
+    then adds an index of row positions per group instead of copies.
+    """
+    if group_by is not None and group_by not in LIST_GROUP_FIELDS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {', '.join(LIST_GROUP_FIELDS)}")
+    
     try:
+        # Strong ETag from the user's latest write, checked before loading rows
+        etag = None
+        encoding = negotiate_encoding(request)
+        version = db.get_user_write_version(user_id)
+        if version is not None:
+            tag_source = f"{user_id}:{version}:{limit}:{lean}:{group_by}:{encoding}"
+            etag = '"' + hashlib.sha1(tag_source.encode()).hexdigest() + '"'
+            if etag_matches(request, etag):
+                return not_modified(etag)
+        
         transactions = db.get_user_transactions(user_id, limit)
         
+        if lean:
+            payload = {"total": len(transactions), "transactions": transactions}
+            if group_by:
+                index = {}
+                for position, txn in enumerate(transactions):
+                    index.setdefault(str(txn[group_by]), []).append(position)
+                payload["index"] = {group_by: index}
+            return compressed_json_response(request, payload, etag, encoding)
+        
         # Categorize by source
         by_source = {}
         for txn in transactions:
@@ -138,11 +328,11 @@ async def get_transactions(user_id: int, limit: int = 100):
                 by_source[source] = []
             by_source[source].append(txn)
         
-        return {
+        return compressed_json_response(request, {
             "total": len(transactions),
             "by_source": by_source,
             "transactions": transactions
-        }
+        }, etag, encoding)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -183,6 +373,83 @@ async def get_transaction_stats(user_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ============ ADMIN ============
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # No token configured means admin routes are off, not open
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=503, detail="Admin endpoints are disabled (ADMIN_TOKEN is not set)")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.post("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def start_profiling(duration: float = 30.0, max_requests: Optional[int] = None,
+                          interval_ms: float = 5.0, sample_rate: float = 1.0):
+    """Sample parser/database stacks for `duration` seconds or `max_requests` calls"""
+    if not profiler.start(min(duration, 600.0), max_requests, max(interval_ms, 1.0), sample_rate):
+        raise HTTPException(status_code=409, detail="Profiling already running")
+    return profiler.status()
+
+@app.get("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def get_profile(format: str = "collapsed"):
+    """Aggregated stacks: collapsed text (flamegraph.pl/speedscope) or JSON"""
+    if format == "json":
+        return {"status": profiler.status(), "stacks": dict(profiler.stacks.most_common())}
+    return PlainTextResponse(profiler.collapsed())
+
+@app.delete("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def stop_profiling():
+    profiler.stop()
+    return profiler.status()
+
+# ============ PARSE QUEUE ============
+@app.get("/api/queue/stats")
+async def get_queue_stats():
+    """Backlog and lag of the unprocessed-SMS parse queue"""
+    stats = db.get_parse_queue_stats(PARSE_LEASE_SECONDS, PARSE_MAX_ATTEMPTS)
+    if stats is None:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    for name, value in stats.items():
+        if name != "shards":
+            metrics.set_gauge(f"parse_queue.{name}", value)
+    return {"ingest_mode": INGEST_MODE, **stats}
+
+# ============ EXPORT ============
+@app.get("/api/export/transactions")
+async def export_transactions(user_id: Optional[int] = None, start: Optional[date] = None,
+                              end: Optional[date] = None, format: str = "csv",
+                              x_admin_token: Optional[str] = Header(None)):
+    """Stream transactions for one user and/or a date range as CSV, Parquet or Arrow"""
+    if user_id is None:
+        # Cross-user exports are for the finance team only
+        require_admin(x_admin_token)
+        if start is None and end is None:
+            raise HTTPException(status_code=400, detail="user_id or a start/end range is required")
+    try:
+        check_format(format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExportUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+
+    conns = await asyncio.to_thread(open_export_connections, db, user_id)
+    if conns is None:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+
+    def stream():
+        try:
+            yield from iter_export(conns, format, user_id, start, end)
+            metrics.inc(f"export.{format}.completed")
+        finally:
+            for conn in conns:
+                conn.close()
+
+    media_type = EXPORT_FORMATS[format][0]
+    filename = export_filename(format, user_id, start, end)
+    return StreamingResponse(stream(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
 # ============ HEALTH & INFO ============
 @app.get("/")
 async def root():
@@ -191,24 +458,37 @@ async def root():
         "version": "1.0",
         "endpoints": {
             "ocr": {
-                "upload": "POST /api/ocr/upload"
+                "upload": "POST /api/ocr/upload",
+                "job": "GET /api/ocr/jobs/{job_id}"
             },
             "sms": {
                 "parse": "POST /api/sms/parse",
+                "batch": "POST /api/sms/batch",
                 "test": "GET /api/sms/test"
             },
             "transactions": {
                 "get": "GET /api/transactions/{user_id}",
                 "stats": "GET /api/transactions/stats/{user_id}"
+            },
+            "queue": "GET /api/queue/stats",
+            "export": "GET /api/export/transactions",
+            "metrics": "GET /api/metrics",
+            "admin": {
+                "profile": "POST|GET|DELETE /api/admin/profile"
             }
         }
     }
 
+@app.get("/api/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 @app.get("/health")
 async def health_check():
     return {
         "status": "healthy",
         "database": "connected" if db.conn else "disconnected",
+        "spool": local_spool.status() if local_spool is not None else None,
         "timestamp": datetime.now().isoformat()
     }
 
@@ -218,6 +498,7 @@ if __name__ == "__main__":
     print("📱 SMS Parser initialized")
     print("🌐 API Endpoints:")
     print("  - POST /api/ocr/upload")
+    print("  - GET /api/ocr/jobs/{job_id}")
     print("  - POST /api/sms/parse")
     print("  - GET /api/transactions/{user_id}")
     print("  - GET /health")
@@ -0,0 +1,118 @@
+import re
+from collections import OrderedDict
+
+# Built-in merchant catalogue, used to seed the merchants tables and as
+# the offline fallback when no database connection is available.
+# (canonical_name, category, aliases)
+DEFAULT_MERCHANTS = [
+    ("Amazon", "Shopping", ["amazon", "amazon india", "amazon pay", "amzn", "amazon seller services"]),
+    ("Flipkart", "Shopping", ["flipkart", "fkrt", "flipkart internet"]),
+    ("Myntra", "Shopping", ["myntra"]),
+    ("Swiggy", "Food & Dining", ["swiggy", "swiggy instamart", "bundl technologies"]),
+    ("Zomato", "Food & Dining", ["zomato", "blinkit"]),
+    ("BigBasket", "Groceries", ["bigbasket", "big basket", "supermarket grocery supplies"]),
+    ("Kirana Store", "Groceries", ["kirana", "kirana store"]),
+    ("Uber", "Transport", ["uber", "uber india"]),
+    ("Ola", "Transport", ["ola", "ola cabs", "ani technologies"]),
+    ("IRCTC", "Travel", ["irctc", "irctc rail"]),
+    ("Netflix", "Entertainment", ["netflix"]),
+    ("BookMyShow", "Entertainment", ["bookmyshow", "bigtree entertainment"]),
+    ("Airtel", "Bills & Utilities", ["airtel", "bharti airtel"]),
+    ("Jio", "Bills & Utilities", ["jio", "reliance jio"]),
+]
+
+# Tokens that never distinguish one merchant from another
+NOISE_TOKENS = {"pvt", "private", "ltd", "limited", "inc", "corp", "llc", "co", "the", "www", "com"}
+
+_TOKEN_SPLIT = re.compile(r'[^a-z0-9]+')
+
+
+def normalize_merchant(raw_name):
+    """Lowercase, strip punctuation and drop noise tokens"""
+    tokens = _TOKEN_SPLIT.split(raw_name.lower())
+    return tuple(token for token in tokens if token and token not in NOISE_TOKENS)
+
+
+class _TrieNode:
+    __slots__ = ("children", "entry")
+
+    def __init__(self):
+        self.children = {}
+        self.entry = None
+
+
+class MerchantIndex:
+    """Token trie mapping raw merchant strings to (merchant_id, canonical_name, category)"""
+
+    def __init__(self, cache_size=10000):
+        self.root = _TrieNode()
+        self.alias_count = 0
+        self.cache_size = cache_size
+        self.unknown_cache = OrderedDict()
+
+    @classmethod
+    def from_rows(cls, rows, cache_size=10000):
+        """Build from (alias, merchant_id, canonical_name, category) rows"""
+        index = cls(cache_size=cache_size)
+        for alias, merchant_id, canonical_name, category in rows:
+            index.add_alias(alias, merchant_id, canonical_name, category)
+        return index
+
+    @classmethod
+    def from_defaults(cls, cache_size=10000):
+        rows = []
+        for merchant_id, (canonical_name, category, aliases) in enumerate(DEFAULT_MERCHANTS, 1):
+            for alias in aliases:
+                rows.append((alias, merchant_id, canonical_name, category))
+        return cls.from_rows(rows, cache_size=cache_size)
+
+    def add_alias(self, alias, merchant_id, canonical_name, category):
+        tokens = normalize_merchant(alias)
+        if not tokens:
+            return
+        node = self.root
+        for token in tokens:
+            child = node.children.get(token)
+            if child is None:
+                child = node.children[token] = _TrieNode()
+            node = child
+        node.entry = (merchant_id, canonical_name, category or "Uncategorized")
+        self.alias_count += 1
+        # A new alias may resolve names we previously cached as unknown
+        self.unknown_cache.clear()
+
+    def _match(self, tokens):
+        """Longest alias match at the earliest token position"""
+        for start in range(len(tokens)):
+            node = self.root
+            best = None
+            for token in tokens[start:]:
+                node = node.children.get(token)
+                if node is None:
+                    break
+                if node.entry is not None:
+                    best = node.entry
+            if best is not None:
+                return best
+        return None
+
+    def lookup(self, raw_name):
+        """Resolve a raw merchant name; unknown names keep their raw form"""
+        if not raw_name:
+            return None, None, "Uncategorized"
+
+        tokens = normalize_merchant(raw_name)
+        cached = self.unknown_cache.get(tokens)
+        if cached is not None:
+            self.unknown_cache.move_to_end(tokens)
+            return cached
+
+        entry = self._match(tokens)
+        if entry is not None:
+            return entry
+
+        unknown = (None, raw_name, "Uncategorized")
+        self.unknown_cache[tokens] = unknown
+        if len(self.unknown_cache) > self.cache_size:
+            self.unknown_cache.popitem(last=False)
+        return unknown
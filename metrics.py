@@ -0,0 +1,26 @@
+import threading
+
+
+class Metrics:
+    """Process-local counters and gauges, exported by GET /api/metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {"counters": dict(self.counters), "gauges": dict(self.gauges)}
+
+
+# Global instance
+metrics = Metrics()
@@ -0,0 +1,123 @@
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from sms_parser import SMSParser, record_guard_metrics
+from profiler import profiler
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+# Parser owned by each worker process (no DB, built once per process)
+_worker_parser = None
+
+WARMUP_MESSAGES = [
+    "HDFC Bank: Rs. 1,500.00 debited from A/c XX1234 on 15-12-2023 at AMAZON INDIA.",
+    "ICICI Bank: Rs. 2,750.00 spent on Credit Card XX7878 at SWIGGY on 15 Dec 2023.",
+    "UPI: Rs. 500.00 credited to A/c XX1234 from KIRANA STORE on 15/12/2023.",
+]
+
+
+def _init_worker(merchant_rows):
+    """Build and warm up this worker's parser so compiled patterns and dateutil are hot"""
+    global _worker_parser
+    _worker_parser = SMSParser(None, merchant_rows=merchant_rows)
+    for message in WARMUP_MESSAGES:
+        _worker_parser.parse(0, message)
+
+
+def _parse_in_worker(user_id, message_text, sender_number, fields):
+    return _worker_parser.parse(user_id, message_text, sender_number, fields)
+
+
+def _parse_many_in_worker(user_id, messages, fields):
+    texts = [message[0] for message in messages]
+    sender_numbers = [message[1] for message in messages]
+    return _worker_parser.parse_batch(user_id, texts, sender_numbers, fields)
+
+
+def _profiled_in_worker(settings, fn, *args):
+    """Run fn with this worker's own sampler on; returns (result, stacks, samples)"""
+    interval_ms, sample_rate, remaining_s, window = settings
+    if not profiler.active or profiler.window != window:
+        profiler.stop()
+        profiler.start(remaining_s, None, interval_ms, sample_rate, window=window)
+    result = fn(*args)
+    stacks, samples = profiler.collect()
+    return result, stacks, samples
+
+
+def configured_workers():
+    """PARSE_WORKERS: 0 = parse inline on the API process, 'auto' = one per core"""
+    value = os.getenv('PARSE_WORKERS', '0').strip().lower()
+    if value == 'auto':
+        return os.cpu_count() or 1
+    return max(0, int(value))
+
+
+class ParseExecutor:
+    """Runs SMSParser.parse in a process pool; DB persistence stays with the caller"""
+
+    def __init__(self, sms_parser, workers=None):
+        self.parser = sms_parser
+        self.workers = configured_workers() if workers is None else workers
+        self.pool = None
+
+    def start(self):
+        if self.workers <= 0 or self.pool is not None:
+            return
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.parser.merchant_rows,)
+        )
+        log.info("⚙️ Parse executor started with %s worker processes", self.workers)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    async def _run_in_pool(self, fn, *args):
+        """Run fn in the pool; while profiling, the worker samples itself and the stacks are merged here"""
+        loop = asyncio.get_running_loop()
+        settings = profiler.worker_settings()
+        if settings is None:
+            return await loop.run_in_executor(self.pool, fn, *args)
+        result, stacks, samples = await loop.run_in_executor(self.pool, _profiled_in_worker, settings, fn, *args)
+        profiler.merge(stacks, samples)
+        return result
+
+    async def parse(self, user_id, message_text, sender_number=None, fields=None):
+        """Parse one message off the event loop thread when a pool is configured"""
+        if self.pool is None:
+            result = self.parser.parse(user_id, message_text, sender_number, fields)
+        else:
+            profiling = profiler.active
+            result = await self._run_in_pool(_parse_in_worker, user_id, message_text, sender_number, fields)
+            if profiling:
+                profiler.count_request()
+        record_guard_metrics(result)
+        return result
+
+    async def parse_many(self, user_id, messages, fields=None):
+        """Parse [(text, sender_number, sender_name)] for one user, split across the pool"""
+        if self.pool is None:
+            results = await asyncio.to_thread(
+                self.parser.parse_batch, user_id,
+                [message[0] for message in messages], [message[1] for message in messages], fields
+            )
+        else:
+            # One slice per worker keeps pickling to a few round trips per batch
+            size = max(1, -(-len(messages) // self.workers))
+            profiling = profiler.active
+            parts = await asyncio.gather(*[
+                self._run_in_pool(_parse_many_in_worker, user_id, messages[i:i + size], fields)
+                for i in range(0, len(messages), size)
+            ])
+            results = [result for part in parts for result in part]
+            if profiling:
+                profiler.count_request()
+        for result in results:
+            record_guard_metrics(result)
+        return results
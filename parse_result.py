@@ -0,0 +1,113 @@
+import json
+
+FIELD_NAMES = ("amount", "merchant", "date", "bank", "transaction_type")
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+class FieldResult:
+    """One extracted field and the confidence of its extractor"""
+    __slots__ = ("value", "confidence")
+
+    def __init__(self, value=None, confidence=0.0):
+        self.value = value
+        self.confidence = confidence
+
+    def __repr__(self):
+        return f"FieldResult({self.value!r}, {self.confidence!r})"
+
+
+class ParseResult:
+    """Compact result of SMSParser.parse_sms"""
+    __slots__ = ("success", "sms_id", "transaction_id", "amount", "merchant", "date",
+                 "bank", "transaction_type", "merchant_id", "category", "confidence",
+                 "truncated", "degraded", "fields", "message_class", "duplicate")
+
+    def __init__(self, amount, merchant, date, bank, transaction_type,
+                 merchant_id=None, category="Uncategorized", confidence=0.0):
+        self.success = amount.value is not None
+        self.sms_id = None
+        self.transaction_id = None
+        self.amount = amount
+        self.merchant = merchant
+        self.date = date
+        self.bank = bank
+        self.transaction_type = transaction_type
+        self.merchant_id = merchant_id
+        self.category = category
+        self.confidence = confidence
+        self.truncated = False
+        self.degraded = False
+        # Requested field subset, None when every field was requested
+        self.fields = None
+        # Prefilter verdict (prefilter.MESSAGE_CLASSES), None when it did not run
+        self.message_class = None
+        # True when persist_result linked this SMS to an earlier transaction
+        self.duplicate = False
+
+    def to_dict(self):
+        """Plain dict in the public API response shape"""
+        date = self.date.value
+        if self.fields is not None:
+            return self._projected_dict()
+        return {
+            "success": self.success,
+            "sms_id": self.sms_id,
+            "transaction_id": self.transaction_id,
+            "duplicate": self.duplicate,
+            "parsed_data": {
+                "amount": self.amount.value,
+                "merchant": self.merchant.value,
+                "merchant_id": self.merchant_id,
+                "category": self.category,
+                "date": date.isoformat() if date else None,
+                "bank": self.bank.value,
+                "transaction_type": self.transaction_type.value
+            },
+            "confidence": round(self.confidence, 3),
+            "degraded": self.degraded,
+            "message_class": self.message_class,
+            "field_confidences": {
+                "amount": round(self.amount.confidence, 3),
+                "date": round(self.date.confidence, 3),
+                "merchant": round(self.merchant.confidence, 3),
+                "bank": round(self.bank.confidence, 3),
+                "transaction_type": round(self.transaction_type.confidence, 3)
+            }
+        }
+
+    def _projected_dict(self):
+        parsed_data = {}
+        field_confidences = {}
+        for name in self.fields:
+            field = getattr(self, name)
+            value = field.value
+            if name == "date" and value:
+                value = value.isoformat()
+            parsed_data[name] = value
+            field_confidences[name] = round(field.confidence, 3)
+            if name == "merchant":
+                parsed_data["merchant_id"] = self.merchant_id
+                parsed_data["category"] = self.category
+        return {
+            "success": self.success,
+            "parsed_data": parsed_data,
+            "confidence": round(self.confidence, 3),
+            "degraded": self.degraded,
+            "field_confidences": field_confidences
+        }
+
+    def to_json_bytes(self):
+        """Serialize straight to UTF-8 JSON, skipping FastAPI's generic encoder"""
+        return _encode(self.to_dict()).encode("utf-8")
+
+    def __repr__(self):
+        return f"ParseResult(success={self.success!r}, amount={self.amount.value!r}, confidence={self.confidence:.3f})"
+
+
+def results_to_json_bytes(results, **extra):
+    """Encode a list of ParseResults, plus any top-level keys, as one JSON object"""
+    head = _encode(extra)[:-1]
+    sep = "," if extra else ""
+    body = b",".join(result.to_json_bytes() for result in results)
+    return f'{head}{sep}"results":['.encode("utf-8") + body + b"]}"
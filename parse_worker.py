@@ -0,0 +1,286 @@
+"""Parse workers that drain sms_messages.processed = FALSE as a work queue.
+
+With INGEST_MODE=queue the API only stores raw SMS; any number of these
+workers, on any host, claim batches of unprocessed rows and write the
+derived transactions.
+
+A claim is a short transaction: rows are picked with FOR UPDATE SKIP LOCKED
+(so workers never wait on each other) and stamped with claimed_by /
+claimed_at, then the lock is released and the lease protects the rows
+while they are parsed. A worker that crashes simply lets its lease expire
+and the rows become claimable again. Completing a batch is fenced on
+claimed_by, so a worker whose lease was taken over writes nothing.
+Messages failing PARSE_MAX_ATTEMPTS times stay unprocessed as dead letters.
+
+Each worker heartbeats its counters (messages processed, transactions
+saved, duplicates linked, leases lost, failed batches) and its latest
+claim lag into the parse_workers table every PARSE_HEARTBEAT_SECONDS;
+/api/queue/stats reports them next to the backlog, as the workers' own
+process metrics never reach the API.
+
+Duplicate notifications of one payment are linked (transaction_links)
+instead of saved twice, as in inline mode. Each worker process keeps its
+own DuplicateIndex, so a duplicate is only caught when both notifications
+pass through the same worker within DEDUPE_WINDOW_S.
+
+CLI:
+    python parse_worker.py [--processes N] [--batch-size N] [--lease-seconds S] [--shard NAME]
+
+With DB_SHARDS, each shard is its own queue: --processes workers are
+started per shard unless --shard picks one.
+"""
+import os
+import time
+import socket
+import argparse
+import multiprocessing
+
+from psycopg2.extras import execute_values
+
+from dedupe import DEDUPE_ENABLED, DuplicateIndex
+from reparse import desired_row, insert_transactions
+from sms_parser import SMSParser
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+INGEST_MODE = os.getenv('INGEST_MODE', 'inline').lower()
+PARSE_CLAIM_BATCH = int(os.getenv('PARSE_CLAIM_BATCH', '200'))
+PARSE_LEASE_SECONDS = int(os.getenv('PARSE_LEASE_SECONDS', '60'))
+PARSE_MAX_ATTEMPTS = int(os.getenv('PARSE_MAX_ATTEMPTS', '5'))
+PARSE_POLL_MS = float(os.getenv('PARSE_POLL_MS', '500'))
+PARSE_HEARTBEAT_SECONDS = float(os.getenv('PARSE_HEARTBEAT_SECONDS', '10'))
+HEARTBEAT_COUNTERS = ("processed", "transactions", "linked", "lease_lost", "batches_failed")
+
+
+class ParseWorker:
+    def __init__(self, conn, parser, worker_id=None, batch_size=PARSE_CLAIM_BATCH,
+                 lease_seconds=PARSE_LEASE_SECONDS, max_attempts=PARSE_MAX_ATTEMPTS):
+        self.conn = conn
+        self.parser = parser
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.dedupe = DuplicateIndex() if DEDUPE_ENABLED else None
+        self.running = False
+        # Counted since the last heartbeat
+        self.counters = dict.fromkeys(HEARTBEAT_COUNTERS, 0)
+        self.claim_lag = None
+        self.last_heartbeat = None
+
+    def claim(self):
+        """Lease up to batch_size unprocessed messages; [(id, user_id, text, sender, received_at)]"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                WITH picked AS (
+                    SELECT id, received_at FROM sms_messages
+                    WHERE processed = FALSE
+                      AND parse_attempts < %(max_attempts)s
+                      AND (claimed_at IS NULL OR claimed_at < NOW() - make_interval(secs => %(lease)s))
+                    ORDER BY id
+                    LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE sms_messages m
+                SET claimed_by = %(worker)s, claimed_at = NOW(), parse_attempts = m.parse_attempts + 1
+                FROM picked
+                WHERE m.id = picked.id AND m.received_at = picked.received_at
+                RETURNING m.id, m.user_id, m.message_text, m.sender_number, m.received_at,
+                          EXTRACT(EPOCH FROM NOW() - m.received_at)
+            """, {"max_attempts": self.max_attempts, "lease": self.lease_seconds,
+                  "limit": self.batch_size, "worker": self.worker_id})
+            rows = cursor.fetchall()
+        self.conn.commit()
+        if rows:
+            self.claim_lag = max(float(row[5]) for row in rows)
+        return [row[:5] for row in sorted(rows)]
+
+    def complete(self, messages, results):
+        """Write the batch's transactions; only rows this worker still leases are written"""
+        by_id = {message[0]: (message, result) for message, result in zip(messages, results)}
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE sms_messages
+                SET processed = TRUE, claimed_by = NULL, claimed_at = NULL
+                WHERE id = ANY(%s) AND claimed_by = %s
+                RETURNING id
+            """, (list(by_id), self.worker_id))
+            owned = [row[0] for row in cursor.fetchall()]
+
+            inserts, banks, links = [], [], []
+            # Payments first seen in this batch have no row id yet: match them by sms_id
+            pending = DuplicateIndex() if self.dedupe is not None else None
+            for sms_id in sorted(owned):
+                (_, user_id, _, sender, received_at), result = by_id[sms_id]
+                banks.append((sms_id, result.bank.value))
+                row = desired_row(result, received_at)
+                if row is None:
+                    continue
+                key = (user_id, row["amount"], row["transaction_date"], result.transaction_type.value)
+                if self.dedupe is not None:
+                    match = self.dedupe.find(*key, row["merchant"], row["merchant_id"], sender)
+                    if match is not None:
+                        links.append((user_id, match[0], None, sms_id, match[1]))
+                        continue
+                    match = pending.find(*key, row["merchant"], row["merchant_id"], sender)
+                    if match is not None:
+                        links.append((user_id, None, match[0], sms_id, match[1]))
+                        continue
+                    pending.remember(*key, sms_id, row["merchant"], row["merchant_id"], sender)
+                inserts.append((sms_id, user_id, row))
+            saved = insert_transactions(cursor, inserts) if inserts else {}
+            if links:
+                execute_values(cursor, """
+                    INSERT INTO transaction_links (user_id, transaction_id, sms_id, link_type, similarity)
+                    VALUES %s
+                """, [(user_id, transaction_id or saved[original_sms_id], sms_id, similarity)
+                      for user_id, transaction_id, original_sms_id, sms_id, similarity in links],
+                    template="(%s, %s, %s, 'duplicate', %s)")
+            if banks:
+                cursor.execute("""
+                    UPDATE sms_messages m SET is_bank_sms = v.bank IS NOT NULL, bank_detected = v.bank
+                    FROM unnest(%s::int[], %s::varchar[]) AS v(id, bank)
+                    WHERE m.id = v.id
+                """, ([sms_id for sms_id, _ in banks], [bank for _, bank in banks]))
+        self.conn.commit()
+
+        if self.dedupe is not None:
+            for sms_id, user_id, row in inserts:
+                result = by_id[sms_id][1]
+                self.dedupe.remember(user_id, row["amount"], row["transaction_date"], result.transaction_type.value,
+                                     saved[sms_id], row["merchant"], row["merchant_id"], by_id[sms_id][0][3])
+        self.counters["processed"] += len(owned)
+        self.counters["transactions"] += len(inserts)
+        self.counters["linked"] += len(links)
+        self.counters["lease_lost"] += len(by_id) - len(owned)
+        return len(owned), len(inserts)
+
+    def heartbeat(self):
+        """Add the counters to this worker's parse_workers row and mark it alive"""
+        counters = dict(self.counters)
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO parse_workers (worker_id, processed, transactions, linked, lease_lost,
+                                               batches_failed, claim_lag_s)
+                    VALUES (%(worker)s, %(processed)s, %(transactions)s, %(linked)s, %(lease_lost)s,
+                            %(batches_failed)s, %(lag)s)
+                    ON CONFLICT (worker_id) DO UPDATE SET
+                        last_seen = NOW(),
+                        processed = parse_workers.processed + EXCLUDED.processed,
+                        transactions = parse_workers.transactions + EXCLUDED.transactions,
+                        linked = parse_workers.linked + EXCLUDED.linked,
+                        lease_lost = parse_workers.lease_lost + EXCLUDED.lease_lost,
+                        batches_failed = parse_workers.batches_failed + EXCLUDED.batches_failed,
+                        claim_lag_s = COALESCE(EXCLUDED.claim_lag_s, parse_workers.claim_lag_s)
+                """, {"worker": self.worker_id, "lag": self.claim_lag, **counters})
+            self.conn.commit()
+        except Exception as e:
+            log.warning("⚠️ %s: heartbeat failed: %s", self.worker_id, e)
+            self.conn.rollback()
+            return
+        for name, value in counters.items():
+            self.counters[name] -= value
+        self.claim_lag = None
+        self.last_heartbeat = time.monotonic()
+
+    def release(self, messages):
+        """Give up a failed batch's leases so other workers can retry it right away"""
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE sms_messages SET claimed_by = NULL, claimed_at = NULL
+                    WHERE id = ANY(%s) AND claimed_by = %s
+                """, ([message[0] for message in messages], self.worker_id))
+            self.conn.commit()
+        except Exception as e:
+            log.warning("⚠️ Could not release leases: %s", e)
+            self.conn.rollback()
+
+    def run_once(self):
+        """Claim, parse and complete one batch; returns the number of messages claimed"""
+        messages = self.claim()
+        if not messages:
+            return 0
+        try:
+            results = []
+            for sms_id, user_id, text, sender, _ in messages:
+                result = self.parser.parse(user_id, text, sender)
+                result.sms_id = sms_id
+                results.append(result)
+            processed, saved = self.complete(messages, results)
+            log.debug(" %s: %s messages parsed, %s transactions saved", self.worker_id, processed, saved)
+        except Exception as e:
+            log.error("⚠️ %s: batch failed: %s", self.worker_id, e)
+            self.counters["batches_failed"] += 1
+            self.conn.rollback()
+            self.release(messages)
+        return len(messages)
+
+    def run(self, poll_ms=PARSE_POLL_MS, heartbeat_seconds=PARSE_HEARTBEAT_SECONDS):
+        self.running = True
+        log.info("🧵 Parse worker %s started (batch %s, lease %ss)", self.worker_id, self.batch_size, self.lease_seconds)
+        self.heartbeat()
+        try:
+            while self.running:
+                claimed = self.run_once()
+                if self.last_heartbeat is None or time.monotonic() - self.last_heartbeat >= heartbeat_seconds:
+                    self.heartbeat()
+                if claimed < self.batch_size:
+                    time.sleep(poll_ms / 1000.0)
+        finally:
+            self.heartbeat()
+
+    def stop(self):
+        self.running = False
+
+
+def _worker_main(batch_size, lease_seconds, shard_name=None, merchant_rows=None):
+    from database import db
+    conn = db.shard(shard_name).new_connection()
+    if conn is None:
+        raise SystemExit(1)
+    parser = SMSParser(None, merchant_rows=merchant_rows)
+    worker = ParseWorker(conn, parser, batch_size=batch_size, lease_seconds=lease_seconds)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Drain the sms_messages parse queue")
+    arg_parser.add_argument("--processes", type=int, default=1)
+    arg_parser.add_argument("--batch-size", type=int, default=PARSE_CLAIM_BATCH)
+    arg_parser.add_argument("--lease-seconds", type=int, default=PARSE_LEASE_SECONDS)
+    arg_parser.add_argument("--shard", help="only drain this DB_SHARDS shard")
+    args = arg_parser.parse_args()
+
+    # Set up the schema once here, not concurrently in every worker
+    from database import db
+    merchant_rows = db.get_merchant_aliases()
+    shard_names = [args.shard] if args.shard else [shard.name for shard in db.shard_databases()]
+    if args.processes <= 1 and len(shard_names) == 1:
+        _worker_main(args.batch_size, args.lease_seconds, shard_names[0], merchant_rows)
+        return
+    for shard in db.shard_databases():
+        if shard.conn:
+            shard.conn.close()
+    processes = [multiprocessing.Process(target=_worker_main,
+                                         args=(args.batch_size, args.lease_seconds, name, merchant_rows))
+                 for name in shard_names for _ in range(max(args.processes, 1))]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
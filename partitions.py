@@ -0,0 +1,335 @@
+"""Monthly range partitioning for the SMS/transaction tables.
+
+sms_messages is partitioned on received_at, sms_transactions on
+transaction_date and transactions on date. Converting existing heap
+tables is an explicit step (`migrate`; it takes an ACCESS EXCLUSIVE lock
+and scans the whole table): the old table becomes the "<table>_p_history"
+partition (MINVALUE up to the first monthly partition) and new rows land in
+monthly partitions created ahead of time. Startup and the maintenance loop
+only create future partitions for tables that are already partitioned.
+
+Rows outside every monthly range (e.g. an EMI due date far ahead) go to
+"<table>_p_default"; when their month's partition is created they are
+moved into it. Raw SMS partitions older than the retention window can be
+archived to gzipped CSV and dropped; transaction tables are never archived.
+
+CLI:
+    python partitions.py migrate             # convert heap tables + create future partitions
+    python partitions.py ensure              # create future partitions
+    python partitions.py retention [--months N] [--dry-run]
+"""
+import os
+import re
+import gzip
+import argparse
+from datetime import date
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+PARTITIONING_ENABLED = os.getenv('DB_PARTITIONING', 'true').lower() == 'true'
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', '3'))
+RAW_SMS_RETENTION_MONTHS = int(os.getenv('RAW_SMS_RETENTION_MONTHS', '0'))
+SMS_ARCHIVE_DIR = os.getenv('SMS_ARCHIVE_DIR', 'sms_archive')
+
+# table -> partition key column
+PARTITIONED_TABLES = {
+    "sms_messages": "received_at",
+    "sms_transactions": "transaction_date",
+    "transactions": "date",
+}
+
+# Only raw SMS is archived; parsed transactions are kept forever
+ARCHIVABLE_TABLES = ("sms_messages",)
+
+_UPPER_BOUND = re.compile(r"TO \('([0-9-]+)")
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month.year}{month.month:02d}"
+
+
+class PartitionManager:
+    """Creates, migrates and archives monthly partitions on one connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def is_partitioned(self, cursor, table):
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+        row = cursor.fetchone()
+        return row is not None and row[0] == 'p'
+
+    def list_partitions(self, cursor, table):
+        """[(name, upper_bound or None)] for each partition; default has no bound"""
+        cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            ORDER BY c.relname
+        """, (table,))
+        partitions = []
+        for name, bound in cursor.fetchall():
+            match = _UPPER_BOUND.search(bound or '')
+            upper = date.fromisoformat(match.group(1)) if match else None
+            partitions.append((name, upper))
+        return partitions
+
+    def migrate_table(self, cursor, table):
+        """Turn a heap table into a partitioned one; the old heap becomes the history partition"""
+        key = PARTITIONED_TABLES[table]
+        history = f"{table}_p_history"
+
+        cursor.execute(f"UPDATE {table} SET {key} = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE {key} IS NULL")
+        cursor.execute(f"SELECT MAX({key}) FROM {table}")
+        newest = cursor.fetchone()[0]
+        upper = month_start(date.today())
+        if newest is not None:
+            upper = max(upper, add_months(month_start(newest), 1))
+
+        # The parent's (id, key) primary key replaces the heap's one on attach;
+        # secondary indexes are recreated on the parent and cascade down
+        cursor.execute("""
+            SELECT indexrelid::regclass::text, indisprimary, pg_get_indexdef(indexrelid)
+            FROM pg_index WHERE indrelid = to_regclass(%s)
+        """, (table,))
+        secondary = []
+        for index_name, is_primary, definition in cursor.fetchall():
+            if is_primary:
+                cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {index_name}")
+            else:
+                cursor.execute(f"DROP INDEX {index_name}")
+                secondary.append(definition)
+
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {history}")
+        cursor.execute(f"ALTER TABLE {history} ALTER COLUMN {key} SET NOT NULL")
+        cursor.execute(f"""
+            CREATE TABLE {table} (LIKE {history} INCLUDING DEFAULTS, PRIMARY KEY (id, {key}))
+            PARTITION BY RANGE ({key})
+        """)
+        # The id sequence must outlive the history partition
+        cursor.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        cursor.execute(f"""
+            ALTER TABLE {table} ATTACH PARTITION {history}
+            FOR VALUES FROM (MINVALUE) TO (%s)
+        """, (upper,))
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_p_default PARTITION OF {table} DEFAULT")
+        # Definitions name the table, which is the new parent again by now
+        for definition in secondary:
+            cursor.execute(definition)
+        log.info(" %s converted to a partitioned table (history up to %s, %s indexes rebuilt)",
+                 table, upper, len(secondary))
+
+    def create_partition(self, cursor, table, month):
+        """Create one monthly partition, moving its rows out of the default partition first"""
+        key = PARTITIONED_TABLES[table]
+        name = partition_name(table, month)
+        default = f"{table}_p_default"
+        bounds = (month, add_months(month, 1))
+        cursor.execute("SELECT to_regclass(%s), to_regclass(%s)", (name, default))
+        exists, has_default = cursor.fetchone()
+        if exists:
+            return False
+        moved = False
+        if has_default:
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {key} >= %s AND {key} < %s)", bounds)
+            moved = cursor.fetchone()[0]
+        if not moved:
+            cursor.execute(f"""
+                CREATE TABLE {name} PARTITION OF {table}
+                FOR VALUES FROM (%s) TO (%s)
+            """, bounds)
+            return True
+        # A range cannot be attached while the default partition holds rows in it
+        cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)")
+        cursor.execute(f"""
+            WITH moved AS (
+                DELETE FROM {default} WHERE {key} >= %s AND {key} < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """, bounds)
+        log.info(" %s: %s rows moved out of %s", name, cursor.rowcount, default)
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+        return True
+
+    def ensure_future_partitions(self, cursor, table, months_ahead=PARTITION_MONTHS_AHEAD):
+        """Create monthly partitions from the last covered month through months_ahead"""
+        covered_until = None
+        for _, upper in self.list_partitions(cursor, table):
+            if upper is not None and (covered_until is None or upper > covered_until):
+                covered_until = upper
+
+        # Start where coverage ends, so months missed while nothing ran are filled too
+        month = covered_until or month_start(date.today())
+        last = add_months(month_start(date.today()), months_ahead)
+
+        created = 0
+        while month <= last:
+            if self.create_partition(cursor, table, month):
+                created += 1
+            month = add_months(month, 1)
+        return created
+
+    def setup(self, months_ahead=PARTITION_MONTHS_AHEAD, migrate=False):
+        """Make sure future partitions exist; heap tables are only converted with migrate=True
+
+        Each table is its own transaction, so one failing table does not
+        hold back the others.
+        """
+        ok = True
+        for table in PARTITIONED_TABLES:
+            try:
+                with self.conn.cursor() as cursor:
+                    if not self.is_partitioned(cursor, table):
+                        if not migrate:
+                            log.info(" %s is not partitioned; run `python partitions.py migrate`", table)
+                            continue
+                        self.migrate_table(cursor, table)
+                    created = self.ensure_future_partitions(cursor, table, months_ahead)
+                self.conn.commit()
+                if created:
+                    log.info(" %s: %s monthly partitions created", table, created)
+            except Exception as e:
+                log.error(" Error setting up partitions for %s: %s", table, e)
+                self.conn.rollback()
+                ok = False
+        return ok
+
+    def detached_partitions(self, cursor, table):
+        """Monthly tables of `table` that are no longer attached (an archive run stopped after DETACH)"""
+        cursor.execute("""
+            SELECT c.relname
+            FROM pg_class c
+            WHERE c.relkind = 'r' AND c.relname ~ %s
+              AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)
+            ORDER BY c.relname
+        """, (f"^{table}_p[0-9]{{6}}$",))
+        return [row[0] for row in cursor.fetchall()]
+
+    def _copy_to_archive(self, name, partial):
+        """COPY a table into a gzipped CSV; returns the row count"""
+        with self.conn.cursor() as cursor:
+            with gzip.open(partial, 'wb') as archive:
+                cursor.copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", archive)
+            copied = cursor.rowcount
+        self.conn.commit()
+        return copied
+
+    def archive_partition(self, table, name, path, attached=True):
+        """Archive one expired partition to path and drop it
+
+        The COPY runs while the partition is still attached and only needs
+        ACCESS SHARE on it, so ingest is not blocked. DETACH takes ACCESS
+        EXCLUSIVE on the parent, so it gets a transaction of its own that
+        does nothing else. Once detached the table cannot change: if rows
+        arrived after the COPY, it is copied again before the DROP.
+        """
+        partial = path + ".partial"
+        try:
+            copied = self._copy_to_archive(name, partial)
+            if attached:
+                with self.conn.cursor() as cursor:
+                    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                self.conn.commit()
+                with self.conn.cursor() as cursor:
+                    cursor.execute(f"SELECT COUNT(*) FROM {name}")
+                    changed = cursor.fetchone()[0] != copied
+                self.conn.commit()
+                if changed:
+                    self._copy_to_archive(name, partial)
+            os.replace(partial, path)
+            with self.conn.cursor() as cursor:
+                cursor.execute(f"DROP TABLE {name}")
+            self.conn.commit()
+            log.info(" Archived %s -> %s", name, path)
+            return True
+        except Exception as e:
+            # Still attached: retried next run; already detached: picked up by detached_partitions
+            log.error(" Error archiving %s: %s", name, e)
+            self.conn.rollback()
+            if os.path.exists(partial):
+                os.remove(partial)
+            return False
+
+    def archive_old_partitions(self, retention_months=RAW_SMS_RETENTION_MONTHS,
+                               archive_dir=SMS_ARCHIVE_DIR, dry_run=False):
+        """Archive and drop raw-SMS partitions entirely older than the retention window"""
+        if retention_months <= 0:
+            log.info(" Retention disabled (RAW_SMS_RETENTION_MONTHS=0)")
+            return []
+
+        cutoff = add_months(month_start(date.today()), -retention_months)
+        archived = []
+        os.makedirs(archive_dir, exist_ok=True)
+
+        for table in ARCHIVABLE_TABLES:
+            with self.conn.cursor() as cursor:
+                expired = [(name, True) for name, upper in self.list_partitions(cursor, table)
+                           if upper is not None and upper <= cutoff]
+                expired += [(name, False) for name in self.detached_partitions(cursor, table)]
+            self.conn.commit()
+
+            for name, attached in expired:
+                path = os.path.join(archive_dir, f"{name}.csv.gz")
+                if dry_run:
+                    log.info(" [dry-run] would archive %s -> %s", name, path)
+                    archived.append(path)
+                elif self.archive_partition(table, name, path, attached):
+                    archived.append(path)
+        return archived
+
+
+def run_maintenance(database):
+    """Future partitions + raw-SMS retention on a dedicated connection"""
+    conn = database.new_connection()
+    if conn is None:
+        return
+    try:
+        manager = PartitionManager(conn)
+        manager.setup()
+        manager.archive_old_partitions()
+    finally:
+        conn.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="SMS table partition maintenance")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="convert heap tables to partitioned ones and create future partitions")
+    sub.add_parser("ensure", help="create future partitions")
+    retention = sub.add_parser("retention", help="archive raw SMS partitions past retention")
+    retention.add_argument("--months", type=int, default=RAW_SMS_RETENTION_MONTHS)
+    retention.add_argument("--archive-dir", default=SMS_ARCHIVE_DIR)
+    retention.add_argument("--dry-run", action="store_true")
+    args = arg_parser.parse_args()
+
+    from database import db
+    ok = True
+    for shard in db.shard_databases():
+        conn = shard.new_connection()
+        if conn is None:
+            raise SystemExit(1)
+        try:
+            manager = PartitionManager(conn)
+            if args.command in ("migrate", "ensure"):
+                ok = manager.setup(migrate=args.command == "migrate") and ok
+            else:
+                manager.archive_old_partitions(args.months, args.archive_dir, args.dry_run)
+        finally:
+            conn.close()
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Cheap one-pass classifier that keeps non-financial SMS away from the extractors.
+
+Every message gets one of:
+
+    transactional  money moved (debited/credited/spent...) or a bare amount
+    otp            one-time passwords and verification codes
+    promotional    offers, sales, links
+    other          personal and everything else
+
+Only transactional messages reach the amount/date/merchant cascades. The
+decision uses three cheap features, all from precompiled patterns:
+
+- sender header shape: DLT headers like "VK-HDFCBK" (with an optional
+  -T/-S/-P/-G purpose suffix) vs. plain phone numbers
+- one scan of a combined keyword regex whose named groups say which
+  keyword family matched (the regex engine acts as the keyword automaton)
+- currency tokens ("Rs. 500", "1,200 INR", "₹99", "Amount: 99", "1,500.00")
+
+When in doubt the prefilter answers transactional: a false positive only
+costs a parse, a false negative loses a transaction.
+"""
+import os
+import re
+
+PREFILTER_ENABLED = os.getenv('PREFILTER_ENABLED', 'true').lower() == 'true'
+
+TRANSACTIONAL = "transactional"
+OTP = "otp"
+PROMOTIONAL = "promotional"
+OTHER = "other"
+MESSAGE_CLASSES = (TRANSACTIONAL, OTP, PROMOTIONAL, OTHER)
+
+# "VK-HDFCBK", "AD-ICICIT-S"; the last segment is the DLT purpose suffix
+SENDER_HEADER = re.compile(r'^[A-Z]{2}-([A-Z0-9]{6})(?:-([TSPG]))?$', re.IGNORECASE)
+SENDER_PHONE = re.compile(r'^\+?\d[\d\s-]{6,}$')
+
+KEYWORDS = re.compile(r'''
+    (?P<moved>\b(?:debited|credited|spent|withdrawn|deducted|transferred|received|refunded|reversed)\b)
+  | (?P<txn>\b(?:a/c|acct|account|txn|transaction|upi|neft|imps|rtgs|avl\.?\s*bal|balance|purchase|paid|card)\b)
+  | (?P<otp>\b(?:otp|one[\s-]time\s+password|verification\s+code|passcode|security\s+code|do\s+not\s+share)\b)
+  | (?P<promo>\b(?:offer|sale|discount|coupon|voucher|win|won|hurry|limited\s+time|shop\s+now|buy|free|deal|
+                   unsubscribe|click|apply\s+now|pre-?approved|upto|up\s+to)\b|https?://|www\.|(?<!\d)\d+\s*%\s*off)
+''', re.IGNORECASE | re.VERBOSE)
+
+# "Rs. 500", "1,200 INR", "₹99", "Amount: 99", and paise-precision numbers like "1,500.00".
+# Numbers are only tried from the start of a digit run ((?<!\d)(?<!\d,)): retrying
+# every suffix of a long run of digits backtracks quadratically.
+CURRENCY_TOKEN = re.compile(r'''
+    (?:\b(?:rs\.?|inr)|₹)\s*\d
+  | (?<!\d)(?<!\d,)\d[\d,]*(?:\.\d+)?\s*(?:\b(?:rs|inr)\b|₹)
+  | \b(?:amount|amt)\b[:\s]*\d
+  | \b(?<!\d)(?<!\d,)\d[\d,]*\.\d{2}\b
+''', re.IGNORECASE | re.VERBOSE)
+
+
+def sender_kind(sender_number):
+    """'header' (with its DLT suffix, if any), 'phone' or None"""
+    if not sender_number:
+        return None, None
+    match = SENDER_HEADER.match(sender_number.strip())
+    if match:
+        return "header", (match.group(2) or "").upper() or None
+    if SENDER_PHONE.match(sender_number.strip()):
+        return "phone", None
+    return None, None
+
+
+class SMSPrefilter:
+    def classify(self, message_text, sender_number=None):
+        """Return one of MESSAGE_CLASSES"""
+        hits = set()
+        for match in KEYWORDS.finditer(message_text):
+            hits.add(match.lastgroup)
+            if len(hits) == 4:
+                break
+        has_amount = CURRENCY_TOKEN.search(message_text) is not None
+        kind, suffix = sender_kind(sender_number)
+
+        if "otp" in hits and "moved" not in hits:
+            return OTP
+        if "moved" in hits and (has_amount or "txn" in hits):
+            return TRANSACTIONAL
+        if suffix == "P" or ("promo" in hits and "txn" not in hits):
+            return PROMOTIONAL
+        if has_amount:
+            return TRANSACTIONAL
+        # Transactional/service headers talking about an account
+        if kind == "header" and suffix in ("T", "S") and "txn" in hits:
+            return TRANSACTIONAL
+        return OTHER
+
+    def is_transactional(self, message_text, sender_number=None):
+        return self.classify(message_text, sender_number) == TRANSACTIONAL
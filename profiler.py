@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import random
+import threading
+from collections import Counter
+from functools import wraps
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+
+class SamplingProfiler:
+    """On-demand stack sampler for parser/database calls.
+
+    Functions wrapped with @profiler.profiled are sampled only while a
+    profiling window is open; otherwise the wrapper is a single attribute
+    check. A background thread snapshots the stacks of threads currently
+    inside a profiled call and aggregates them as collapsed stacks
+    ("outer;inner;leaf count"), the input format of flamegraph.pl/speedscope.
+
+    Parsing that runs in ParseExecutor's pool is sampled inside the worker
+    processes (see parse_executor._profiled_in_worker) and merged back, so
+    profiling does not move work onto the event loop.
+    """
+
+    def __init__(self):
+        self.active = False
+        self._lock = threading.Lock()
+        # thread ident -> frame of the outermost profiled call
+        self._entries = {}
+        self.stacks = Counter()
+        self.samples = 0
+        self.requests = 0
+        self.max_requests = None
+        self.sample_rate = 1.0
+        self.interval = 0.005
+        self.started_at = None
+        self.window = None
+        self.deadline = None
+        self._sampler = None
+
+    def start(self, duration_s=30.0, max_requests=None, interval_ms=5.0, sample_rate=1.0, window=None):
+        """Open a profiling window; returns False if one is already running
+
+        The window closes after duration_s or once max_requests outermost
+        profiled calls have been sampled, whichever comes first.
+        """
+        with self._lock:
+            if self.active:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.requests = 0
+            self.max_requests = max_requests
+            self.sample_rate = sample_rate
+            self.interval = interval_ms / 1000.0
+            self.started_at = time.time()
+            # Pool workers tag their sampling with the API process's window
+            self.window = window or self.started_at
+            self.deadline = time.monotonic() + duration_s
+            self.active = True
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+            self._sampler.start()
+        if window is None:
+            log.info("🔬 Profiling started for %ss / %s requests", duration_s, max_requests or 'unlimited')
+        return True
+
+    def stop(self):
+        with self._lock:
+            self.active = False
+            self._entries.clear()
+
+    def profiled(self, fn=None, *, counts=True):
+        """Sample calls to fn while profiling
+
+        Each outermost call counts toward max_requests, except with
+        counts=False for the follow-up work of a request already counted
+        (persisting a parse).
+        """
+        if fn is None:
+            return lambda fn: self.profiled(fn, counts=counts)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.active:
+                return fn(*args, **kwargs)
+            return self._call_sampled(fn, args, kwargs, counts)
+        return wrapper
+
+    def count_request(self, requests=1):
+        with self._lock:
+            self.requests += requests
+            if self.max_requests and self.requests >= self.max_requests:
+                self.active = False
+
+    def worker_settings(self):
+        """What a pool worker needs to sample its own calls, or None when not profiling"""
+        if not self.active:
+            return None
+        return (self.interval * 1000.0, self.sample_rate, max(self.deadline - time.monotonic(), 0.0),
+                self.window)
+
+    def collect(self):
+        """(stacks, samples) gathered since the last collect; a pool worker hands these back"""
+        with self._lock:
+            stacks, samples = self.stacks, self.samples
+            self.stacks, self.samples = Counter(), 0
+        return stacks, samples
+
+    def merge(self, stacks, samples, requests=0):
+        """Add samples taken in a pool worker"""
+        with self._lock:
+            self.stacks.update(stacks)
+            self.samples += samples
+        if requests:
+            self.count_request(requests)
+
+    def _call_sampled(self, fn, args, kwargs, counts=True):
+        thread_id = threading.get_ident()
+        # Nested profiled calls (parse_sms -> db.save_*) share the outer entry
+        if thread_id in self._entries or random.random() >= self.sample_rate:
+            return fn(*args, **kwargs)
+
+        self._entries[thread_id] = sys._getframe()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._entries.pop(thread_id, None)
+            if counts:
+                self.count_request()
+
+    def _sample_loop(self):
+        # A stop() quickly followed by start() must not leave two samplers running
+        while self.active and self._sampler is threading.current_thread():
+            if time.monotonic() > self.deadline:
+                self.stop()
+                break
+            frames = sys._current_frames()
+            for thread_id, entry in list(self._entries.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and frame is not entry:
+                    code = frame.f_code
+                    # Skip the wrapper frames of nested profiled calls
+                    if code.co_filename != __file__:
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+                    self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Collapsed-stack text, one "stack count" line per unique stack"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def status(self):
+        return {
+            "active": self.active,
+            "started_at": self.started_at,
+            "requests": self.requests,
+            "max_requests": self.max_requests,
+            "samples": self.samples,
+            "unique_stacks": len(self.stacks),
+            "interval_ms": self.interval * 1000.0,
+            "sample_rate": self.sample_rate
+        }
+
+
+# Global instance
+profiler = SamplingProfiler()
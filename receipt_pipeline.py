@@ -0,0 +1,267 @@
+import os
+import re
+import uuid
+import asyncio
+import hashlib
+import tempfile
+from collections import OrderedDict
+from datetime import datetime
+
+from dateutil import parser as date_parser
+
+from log_config import get_logger
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
+
+log = get_logger(__name__)
+
+RECEIPT_STORAGE_DIR = os.getenv('RECEIPT_STORAGE_DIR', 'receipt_store')
+UPLOAD_CHUNK_SIZE = 256 * 1024
+MAX_RECEIPT_BYTES = int(os.getenv('MAX_RECEIPT_BYTES', str(20 * 1024 * 1024)))
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', '2'))
+OCR_QUEUE_SIZE = int(os.getenv('OCR_QUEUE_SIZE', '100'))
+
+# Formats run_ocr can read; anything else is refused at upload instead of failing in the queue
+ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+class ReceiptTooLarge(Exception):
+    pass
+
+
+class UnsupportedReceipt(Exception):
+    pass
+
+
+class OCRUnavailable(Exception):
+    pass
+
+
+class ReceiptStore:
+    """Content-addressed receipt storage: <root>/<sha[:2]>/<sha><ext>"""
+
+    def __init__(self, root=RECEIPT_STORAGE_DIR):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    async def save_upload(self, upload):
+        """Stream an UploadFile to storage in chunks; returns (sha256, path, size)"""
+        ext = os.path.splitext(upload.filename or '')[1].lower()
+        if ext not in ALLOWED_EXTENSIONS:
+            raise UnsupportedReceipt(f"Unsupported receipt type {ext or '(none)'}; "
+                                     f"expected {', '.join(sorted(ALLOWED_EXTENSIONS))}")
+
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MAX_RECEIPT_BYTES:
+                        raise ReceiptTooLarge(f"Receipt exceeds {MAX_RECEIPT_BYTES} bytes")
+                    hasher.update(chunk)
+                    # Disk writes go to a thread so the event loop never blocks on I/O
+                    await asyncio.to_thread(tmp.write, chunk)
+
+            digest = hasher.hexdigest()
+            final_path = self.path_for(digest, ext)
+            if os.path.exists(final_path):
+                # Same bytes already stored: keep the existing copy
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+            return digest, final_path, size
+
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+_TOTAL_LINE = re.compile(r'(?i)\b(?:grand\s+total|net\s+amount|total|amount\s+due|amount\s+paid)\b')
+_AMOUNT = re.compile(r'(\d{1,3}(?:,\d{2,3})*(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?)')
+_DATE = re.compile(r'(\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4}|\d{1,2}\s+[A-Za-z]{3,9}\s+\d{2,4})')
+
+
+def extract_receipt_fields(text):
+    """Amount/date/merchant from OCR text; raises ValueError when no total is found"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    amount = None
+    # The last "total" line wins (subtotal, tax, then the grand total)
+    for line in lines:
+        if _TOTAL_LINE.search(line):
+            numbers = _AMOUNT.findall(line[_TOTAL_LINE.search(line).end():])
+            if numbers:
+                amount = float(numbers[-1].replace(',', ''))
+    if amount is None:
+        raise ValueError("No total found on the receipt")
+
+    receipt_date, confidence = None, 0.6
+    for line in lines:
+        match = _DATE.search(line)
+        if match:
+            try:
+                receipt_date = date_parser.parse(match.group(1), dayfirst=True, fuzzy=True).date()
+                confidence += 0.2
+                break
+            except (ValueError, OverflowError):
+                continue
+    merchant = next((line for line in lines if re.search(r'[A-Za-z]{3}', line)), None)
+    if merchant:
+        confidence += 0.1
+    return {
+        "amount": amount,
+        "date": (receipt_date or datetime.now().date()).isoformat(),
+        "merchant": merchant[:255] if merchant else "Unknown Merchant",
+        "confidence": round(confidence, 2)
+    }
+
+
+def run_ocr(file_path):
+    """OCR a stored receipt image (runs in a worker thread)
+
+    Needs the optional pytesseract + Pillow packages and the tesseract
+    binary; without them every job fails with OCRUnavailable rather than
+    producing a made-up transaction.
+    """
+    if pytesseract is None:
+        raise OCRUnavailable("No OCR engine installed (pip install pytesseract pillow, plus tesseract)")
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        raise OCRUnavailable(f"OCR of {ext} receipts is not supported")
+    with Image.open(file_path) as image:
+        text = pytesseract.image_to_string(image)
+    return extract_receipt_fields(text)
+
+
+class OCRJob:
+    def __init__(self, user_id, filename, sha256, file_path, file_size):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.filename = filename
+        self.sha256 = sha256
+        self.file_path = file_path
+        self.file_size = file_size
+        self.status = "queued"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.image_id = None
+        self.transaction_id = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "image_sha256": self.sha256,
+            "image_id": self.image_id,
+            "transaction_id": self.transaction_id,
+            "parsed_data": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class OCRJobQueue:
+    """Bounded OCR queue drained by a fixed pool of background workers"""
+
+    def __init__(self, db, workers=OCR_WORKERS, maxsize=OCR_QUEUE_SIZE, max_jobs=1000):
+        self.db = db
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.tasks = []
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        log.info("🧾 OCR job queue started with %s workers", self.workers)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def find_active(self, user_id, sha256):
+        """Queued/processing job for the same user and image, if any"""
+        for job in self.jobs.values():
+            if job.user_id == user_id and job.sha256 == sha256 and job.status in ("queued", "processing"):
+                return job
+        return None
+
+    def submit(self, job):
+        """Enqueue a job; raises asyncio.QueueFull when the queue is at capacity"""
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        # Forget the oldest finished jobs once the registry is full
+        excess = len(self.jobs) - self.max_jobs
+        if excess > 0:
+            finished = [job_id for job_id, old in self.jobs.items() if old.status in ("done", "failed")]
+            for job_id in finished[:excess]:
+                del self.jobs[job_id]
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                job.status = "processing"
+                job.progress = 0.1
+                job.result = await asyncio.to_thread(run_ocr, job.file_path)
+                job.progress = 0.8
+
+                # Blocking database calls stay off the event loop
+                job.image_id = await asyncio.to_thread(
+                    self.db.save_receipt_image,
+                    user_id=job.user_id,
+                    filename=job.filename,
+                    file_path=job.file_path,
+                    file_size=job.file_size,
+                    sha256=job.sha256
+                )
+                if job.image_id is None:
+                    raise RuntimeError("Database unavailable, receipt not saved")
+                job.transaction_id = await asyncio.to_thread(
+                    self.db.save_transaction,
+                    user_id=job.user_id,
+                    amount=job.result["amount"],
+                    date=job.result["date"],
+                    merchant=job.result["merchant"],
+                    category="Shopping",
+                    source="receipt_ocr",
+                    receipt_id=job.image_id
+                )
+                if job.transaction_id is None:
+                    raise RuntimeError("Database unavailable, transaction not saved")
+                job.status = "done"
+                job.progress = 1.0
+            except Exception as e:
+                log.error("⚠️ OCR job %s failed: %s", job.id, e)
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished_at = datetime.now()
+                self.queue.task_done()
@@ -0,0 +1,403 @@
+"""Re-run the current SMSParser over stored SMS and backfill derived rows.
+
+Walks sms_messages in primary-key chunks, parses each chunk across a
+process pool (the same worker setup as ParseExecutor, with the columnar
+SMSParser.parse_batch) and reconciles the results with
+sms_transactions/transactions:
+
+- changed parses update the existing rows in bulk (transactions.updated_at
+  is bumped so list ETags change)
+- messages that now parse with enough confidence but had no rows get them
+  inserted and are marked processed
+- rows whose message no longer parses are reported, never deleted
+- messages linked as duplicates of another payment (transaction_links)
+  are skipped, so re-parsing never turns them back into transactions
+- live messages are left to the API and the parse workers: rows received
+  after the job started (less REPARSE_SETTLE_SECONDS, for writes still in
+  flight) and rows under a parse worker's lease are skipped, and with
+  INGEST_MODE=queue so are unprocessed rows the workers will still claim
+
+Progress is checkpointed per job name in reparse_checkpoints after every
+chunk, so an interrupted run resumes where it stopped. --dry-run prints a
+diff of what would change and writes nothing.
+
+CLI:
+    python reparse.py [--job NAME] [--chunk-size N] [--workers N]
+                      [--sleep-ms MS] [--max-rate ROWS_PER_S]
+                      [--from-id ID] [--restart] [--dry-run]
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from psycopg2.extras import execute_values
+
+from parse_executor import _init_worker, _parse_many_in_worker
+from sms_parser import SMSParser
+
+REPARSE_CHUNK_SIZE = int(os.getenv('REPARSE_CHUNK_SIZE', '1000'))
+REPARSE_WORKERS = int(os.getenv('REPARSE_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+REPARSE_SLEEP_MS = float(os.getenv('REPARSE_SLEEP_MS', '100'))
+# Messages this recent when a run starts may still be getting their rows written
+REPARSE_SETTLE_SECONDS = int(os.getenv('REPARSE_SETTLE_SECONDS', '60'))
+# Same threshold persist_result uses before writing a transaction
+MIN_CONFIDENCE = 0.5
+# extract_date scores a date found in the text 0.9; below that it fell back to "now"
+MIN_DATE_CONFIDENCE = 0.9
+
+
+class ChunkStats:
+    __slots__ = ("seen", "unchanged", "updated", "inserted", "dropped")
+
+    def __init__(self):
+        self.seen = 0
+        self.unchanged = 0
+        self.updated = 0
+        self.inserted = 0
+        self.dropped = 0
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def desired_row(result, received_at):
+    """Column values the current parser would store, or None if it would store nothing
+
+    A message without a date in its text is dated by when it was received,
+    not by when it happens to be (re)parsed.
+    """
+    if not result.amount.value or result.confidence <= MIN_CONFIDENCE:
+        return None
+    if result.date.value and result.date.confidence >= MIN_DATE_CONFIDENCE:
+        transaction_date = result.date.value
+    else:
+        transaction_date = received_at.date()
+    return {
+        "amount": round(float(result.amount.value), 2),
+        "merchant": result.merchant.value or "Unknown Merchant",
+        "transaction_date": transaction_date,
+        "bank_name": result.bank.value or "Unknown Bank",
+        "confidence": round(result.confidence, 2),
+        "merchant_id": result.merchant_id,
+        "category": result.category,
+    }
+
+
+def row_diff(old, new):
+    """{column: (old, new)} for the columns that differ"""
+    changes = {}
+    for column, value in new.items():
+        previous = old.get(column)
+        if column in ("amount", "confidence") and previous is not None:
+            previous = round(float(previous), 2)
+        if previous != value:
+            changes[column] = (previous, value)
+    return changes
+
+
+def insert_transactions(cursor, inserts):
+    """Bulk insert sms_transactions + transactions rows for [(sms_id, user_id, desired_row)]
+
+    Returns {sms_id: sms_transactions id}.
+    """
+    saved = execute_values(cursor, """
+        INSERT INTO sms_transactions
+        (user_id, sms_id, amount, merchant, transaction_date, bank_name, confidence, merchant_id)
+        VALUES %s
+        RETURNING sms_id, id
+    """, [(user_id, sms_id, new["amount"], new["merchant"], new["transaction_date"],
+           new["bank_name"], new["confidence"], new["merchant_id"]) for sms_id, user_id, new in inserts],
+        fetch=True)
+    execute_values(cursor, """
+        INSERT INTO transactions
+        (user_id, amount, date, merchant, merchant_id, category, sms_id, updated_at)
+        VALUES %s
+    """, [(user_id, new["amount"], new["transaction_date"], new["merchant"], new["merchant_id"],
+           new["category"], sms_id) for sms_id, user_id, new in inserts],
+        template="(%s, %s, %s, %s, %s, %s, %s, NOW())")
+    return dict(saved)
+
+
+class Reparser:
+    def __init__(self, conn, job="default", chunk_size=REPARSE_CHUNK_SIZE, workers=REPARSE_WORKERS,
+                 sleep_ms=REPARSE_SLEEP_MS, max_rate=None, dry_run=False, merchant_rows=None,
+                 settle_seconds=REPARSE_SETTLE_SECONDS, lease_seconds=60, queue_attempts=None):
+        # queue_attempts: PARSE_MAX_ATTEMPTS under INGEST_MODE=queue; unprocessed rows
+        # below it still belong to the parse workers
+        self.conn = conn
+        self.job = job
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.sleep = sleep_ms / 1000.0
+        self.max_rate = max_rate
+        self.dry_run = dry_run
+        self.merchant_rows = merchant_rows
+        self.settle_seconds = settle_seconds
+        self.lease_seconds = lease_seconds
+        self.queue_attempts = queue_attempts
+        self.cutoff = None
+        self.pool = None
+        self.parser = None
+        self.totals = ChunkStats()
+
+    # ---- checkpoints ----
+    def load_checkpoint(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT last_sms_id FROM reparse_checkpoints WHERE job_name = %s", (self.job,))
+            row = cursor.fetchone()
+        self.conn.commit()
+        return row[0] if row else 0
+
+    def reset_checkpoint(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute("DELETE FROM reparse_checkpoints WHERE job_name = %s", (self.job,))
+        self.conn.commit()
+
+    def _save_checkpoint(self, cursor, last_id, stats):
+        cursor.execute("""
+            INSERT INTO reparse_checkpoints (job_name, last_sms_id, rows_seen, rows_updated, rows_inserted)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (job_name) DO UPDATE SET
+                last_sms_id = EXCLUDED.last_sms_id,
+                rows_seen = reparse_checkpoints.rows_seen + EXCLUDED.rows_seen,
+                rows_updated = reparse_checkpoints.rows_updated + EXCLUDED.rows_updated,
+                rows_inserted = reparse_checkpoints.rows_inserted + EXCLUDED.rows_inserted,
+                updated_at = CURRENT_TIMESTAMP
+        """, (self.job, last_id, stats.seen, stats.updated, stats.inserted))
+
+    # ---- parsing ----
+    def start(self):
+        if self.workers > 0:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.merchant_rows,)
+            )
+        else:
+            self.parser = SMSParser(None, merchant_rows=self.merchant_rows)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    def parse_chunk(self, messages):
+        """Columnar-parse the chunk, one slice per worker (user_id only matters for logs)"""
+        items = [(text, sender, None) for _, _, text, sender, _ in messages]
+        if self.pool is None:
+            return self.parser.parse_batch(None, [item[0] for item in items], [item[1] for item in items])
+        size = max(1, -(-len(items) // self.workers))
+        slices = [items[i:i + size] for i in range(0, len(items), size)]
+        parts = self.pool.map(_parse_many_in_worker, [None] * len(slices), slices, [None] * len(slices))
+        return [result for part in parts for result in part]
+
+    # ---- database ----
+    def fetch_cutoff(self):
+        """Receive time after which messages are left to live ingest (database clock)"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT LOCALTIMESTAMP - make_interval(secs => %s)", (self.settle_seconds,))
+            cutoff = cursor.fetchone()[0]
+        self.conn.commit()
+        return cutoff
+
+    def fetch_chunk(self, after_id):
+        queue_filter = ""
+        if self.queue_attempts is not None:
+            queue_filter = "AND (m.processed OR m.parse_attempts >= %(attempts)s)"
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT id, user_id, message_text, sender_number, received_at
+                FROM sms_messages m
+                WHERE id > %(after)s
+                  AND received_at < %(cutoff)s
+                  AND (m.claimed_at IS NULL OR m.claimed_at < NOW() - make_interval(secs => %(lease)s))
+                  {queue_filter}
+                  AND NOT EXISTS (SELECT 1 FROM transaction_links l WHERE l.sms_id = m.id)
+                ORDER BY id
+                LIMIT %(limit)s
+            """, {"after": after_id, "cutoff": self.cutoff, "lease": self.lease_seconds,
+                  "attempts": self.queue_attempts, "limit": self.chunk_size})
+            return cursor.fetchall()
+
+    def fetch_existing(self, sms_ids):
+        """sms_id -> latest sms_transactions row plus its transactions row id"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT ON (st.sms_id)
+                       st.sms_id, st.id, st.amount, st.merchant, st.transaction_date, st.bank_name,
+                       st.confidence, st.merchant_id, t.id, t.category
+                FROM sms_transactions st
+                LEFT JOIN LATERAL (
+                    SELECT id, category FROM transactions
+                    WHERE sms_id = st.sms_id AND source = 'sms_parser'
+                    ORDER BY id DESC LIMIT 1
+                ) t ON TRUE
+                WHERE st.sms_id = ANY(%s)
+                ORDER BY st.sms_id, st.id DESC
+            """, (sms_ids,))
+            existing = {}
+            for row in cursor.fetchall():
+                existing[row[0]] = {
+                    "id": row[1],
+                    "amount": row[2],
+                    "merchant": row[3],
+                    "transaction_date": row[4],
+                    "bank_name": row[5],
+                    "confidence": row[6],
+                    "merchant_id": row[7],
+                    "transaction_id": row[8],
+                    "category": row[9],
+                }
+            return existing
+
+    def apply(self, cursor, updates, inserts):
+        if updates:
+            execute_values(cursor, """
+                UPDATE sms_transactions AS st SET
+                    amount = v.amount, merchant = v.merchant, transaction_date = v.transaction_date,
+                    bank_name = v.bank_name, confidence = v.confidence, merchant_id = v.merchant_id
+                FROM (VALUES %s) AS v(id, amount, merchant, transaction_date, bank_name, confidence, merchant_id)
+                WHERE st.id = v.id
+            """, [(old["id"], new["amount"], new["merchant"], new["transaction_date"], new["bank_name"],
+                   new["confidence"], new["merchant_id"]) for old, new in updates],
+                template="(%s, %s::numeric, %s, %s::date, %s, %s::numeric, %s::integer)")
+            execute_values(cursor, """
+                UPDATE transactions AS t SET
+                    amount = v.amount, date = v.date, merchant = v.merchant,
+                    merchant_id = v.merchant_id, category = v.category, updated_at = NOW()
+                FROM (VALUES %s) AS v(id, amount, date, merchant, merchant_id, category)
+                WHERE t.id = v.id
+            """, [(old["transaction_id"], new["amount"], new["transaction_date"], new["merchant"],
+                   new["merchant_id"], new["category"]) for old, new in updates if old["transaction_id"]],
+                template="(%s, %s::numeric, %s::date, %s, %s::integer, %s)")
+
+        if inserts:
+            insert_transactions(cursor, inserts)
+            cursor.execute("UPDATE sms_messages SET processed = TRUE WHERE id = ANY(%s)",
+                           ([sms_id for sms_id, _, _ in inserts],))
+
+    # ---- driver ----
+    def process_chunk(self, messages):
+        stats = ChunkStats()
+        results = self.parse_chunk(messages)
+        existing = self.fetch_existing([message[0] for message in messages])
+        updates, inserts = [], []
+
+        for (sms_id, user_id, _, _, received_at), result in zip(messages, results):
+            stats.seen += 1
+            new = desired_row(result, received_at)
+            old = existing.get(sms_id)
+            if new is None:
+                if old is not None:
+                    stats.dropped += 1
+                    if self.dry_run:
+                        print(f"  sms {sms_id}: no longer parses (row {old['id']} kept)")
+                else:
+                    stats.unchanged += 1
+                continue
+            if old is None:
+                stats.inserted += 1
+                inserts.append((sms_id, user_id, new))
+                if self.dry_run:
+                    print(f"+ sms {sms_id}: {new['amount']} {new['merchant']} {new['transaction_date']}")
+                continue
+            changes = row_diff(old, new)
+            if not changes:
+                stats.unchanged += 1
+                continue
+            stats.updated += 1
+            updates.append((old, new))
+            if self.dry_run:
+                diff = ", ".join(f"{column} {before!r} -> {after!r}" for column, (before, after) in changes.items())
+                print(f"~ sms {sms_id}: {diff}")
+
+        if self.dry_run:
+            self.conn.rollback()
+            return stats
+        try:
+            with self.conn.cursor() as cursor:
+                self.apply(cursor, updates, inserts)
+                self._save_checkpoint(cursor, messages[-1][0], stats)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return stats
+
+    def run(self, from_id=None):
+        last_id = self.load_checkpoint() if from_id is None else from_id
+        self.cutoff = self.fetch_cutoff()
+        print(f"🔁 Re-parse job '{self.job}' starting after sms id {last_id}, messages received before "
+              f"{self.cutoff:%Y-%m-%d %H:%M:%S}{' (dry run)' if self.dry_run else ''}")
+        self.start()
+        try:
+            while True:
+                chunk_started = time.monotonic()
+                messages = self.fetch_chunk(last_id)
+                if not messages:
+                    break
+                stats = self.process_chunk(messages)
+                self.totals.add(stats)
+                last_id = messages[-1][0]
+                print(f" up to sms {last_id}: {stats.to_dict()}")
+                self._throttle(chunk_started, len(messages))
+        finally:
+            self.shutdown()
+        print(f" Re-parse job '{self.job}' finished: {self.totals.to_dict()}")
+        return self.totals
+
+    def _throttle(self, chunk_started, rows):
+        """Pause between chunks so live traffic keeps the database and CPUs"""
+        pause = self.sleep
+        if self.max_rate:
+            pause = max(pause, rows / self.max_rate - (time.monotonic() - chunk_started))
+        if pause > 0:
+            time.sleep(pause)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Re-parse stored SMS with the current parser")
+    arg_parser.add_argument("--job", default="default", help="checkpoint name")
+    arg_parser.add_argument("--chunk-size", type=int, default=REPARSE_CHUNK_SIZE)
+    arg_parser.add_argument("--workers", type=int, default=REPARSE_WORKERS, help="0 = parse inline")
+    arg_parser.add_argument("--sleep-ms", type=float, default=REPARSE_SLEEP_MS, help="pause between chunks")
+    arg_parser.add_argument("--max-rate", type=float, help="max messages per second")
+    arg_parser.add_argument("--from-id", type=int, help="start after this sms id instead of the checkpoint")
+    arg_parser.add_argument("--restart", action="store_true", help="forget the checkpoint")
+    arg_parser.add_argument("--dry-run", action="store_true", help="print the diff, write nothing")
+    arg_parser.add_argument("--shard", help="only this DB_SHARDS shard (default: each in turn)")
+    args = arg_parser.parse_args()
+
+    from database import db
+    from parse_worker import INGEST_MODE, PARSE_LEASE_SECONDS, PARSE_MAX_ATTEMPTS
+    queue_attempts = PARSE_MAX_ATTEMPTS if INGEST_MODE == "queue" else None
+    shards = [db.shard(args.shard)] if args.shard else db.shard_databases()
+    merchant_rows = db.get_merchant_aliases()
+    for shard in shards:
+        # Checkpoints live in each shard's own reparse_checkpoints table
+        conn = shard.new_connection()
+        if conn is None:
+            raise SystemExit(1)
+        # Back off instead of queueing behind locks held by live writes
+        with conn.cursor() as cursor:
+            cursor.execute("SET lock_timeout = '5s'")
+        conn.commit()
+
+        reparser = Reparser(conn, args.job, args.chunk_size, args.workers, args.sleep_ms,
+                            args.max_rate, args.dry_run, merchant_rows=merchant_rows,
+                            lease_seconds=PARSE_LEASE_SECONDS, queue_attempts=queue_attempts)
+        try:
+            if args.restart and not args.dry_run:
+                reparser.reset_checkpoint()
+            reparser.run(args.from_id if args.from_id is not None else (0 if args.restart else None))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
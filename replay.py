@@ -0,0 +1,296 @@
+"""Replay captured traffic (capture.py) against a running instance.
+
+    python replay.py run captures/*.jsonl [--target http://127.0.0.1:8000]
+                     [--speed 1|10|max] [--concurrency 64] [--limit N] [--out results.jsonl]
+    python replay.py report results.jsonl
+    python replay.py diff before.jsonl after.jsonl [--ignore key,...] [--show 10]
+
+run sends the captured requests in arrival order. At --speed N the gaps
+between arrivals are divided by N; at max they are dropped and only
+--concurrency limits the load. When the target cannot keep up, requests
+start late instead of piling up, and the report shows how far behind
+schedule the replay got. Each response is written to --out (status,
+latency, JSON body) and the run ends with latency percentiles per route.
+
+diff compares two result files from the same capture, for example one run
+against the current build and one against a candidate. It reports status
+and body differences per route, ignoring fields that differ between runs
+by nature (row ids, timestamps), and puts the two builds' latency
+percentiles side by side.
+
+Replayed writes land in the target's database, so read endpoints answer
+differently as the data grows: compare builds that start from the same
+database snapshot.
+"""
+import re
+import sys
+import json
+import math
+import time
+import base64
+import asyncio
+import hashlib
+import argparse
+from collections import Counter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+DEFAULT_IGNORE = ("sms_id", "transaction_id", "id", "job_id", "receipt_id", "image_id",
+                  "created_at", "updated_at", "timestamp")
+MAX_STORED_BODY = 256 * 1024
+PERCENTILES = (50, 90, 99)
+
+
+def load_captures(paths, limit=None):
+    """Captured requests from JSONL files, in arrival order"""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as captured:
+            for line in captured:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if not record.get("body_truncated"):
+                    records.append(record)
+    records.sort(key=lambda record: record["t"])
+    return records[:limit] if limit else records
+
+
+def route_of(path):
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+def request_args(record):
+    url = record["path"] + (f"?{record['query']}" if record.get("query") else "")
+    headers = dict(record.get("headers") or {})
+    content = None
+    if "body" in record:
+        content = json.dumps(record["body"]).encode("utf-8")
+    elif "body_b64" in record:
+        content = base64.b64decode(record["body_b64"])
+    return record["method"], url, headers, content
+
+
+def response_result(index, record, status, content, content_type, latency_ms, lag_ms, error=None):
+    result = {"i": index, "method": record["method"], "route": route_of(record["path"]),
+              "status": status, "latency_ms": round(latency_ms, 3), "lag_ms": round(lag_ms, 3)}
+    if error is not None:
+        result["error"] = error
+    elif content_type.startswith("application/json") and len(content) <= MAX_STORED_BODY:
+        try:
+            result["body"] = json.loads(content)
+        except ValueError:
+            result["body_sha1"] = hashlib.sha1(content).hexdigest()
+    else:
+        result["body_sha1"] = hashlib.sha1(content).hexdigest()
+    return result
+
+
+async def replay(records, target, speed=1.0, concurrency=64, timeout=30.0):
+    """Send records to target; speed None means as fast as concurrency allows. Returns results by index."""
+    if httpx is None:
+        raise RuntimeError("replay needs httpx (pip install httpx)")
+    results = [None] * len(records)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+    first = records[0]["t"] if records else 0.0
+
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=timeout) as client:
+        started = time.perf_counter()
+
+        async def send(index, record, due):
+            method, url, headers, content = request_args(record)
+            sent = time.perf_counter()
+            lag_ms = (sent - started - due) * 1000
+            try:
+                response = await client.request(method, url, headers=headers, content=content)
+                latency_ms = (time.perf_counter() - sent) * 1000
+                results[index] = response_result(index, record, response.status_code, response.content,
+                                                 response.headers.get("content-type", ""), latency_ms, lag_ms)
+            except httpx.HTTPError as e:
+                latency_ms = (time.perf_counter() - sent) * 1000
+                results[index] = response_result(index, record, None, b"", "", latency_ms, lag_ms,
+                                                 error=f"{type(e).__name__}: {e}")
+            finally:
+                slots.release()
+
+        for index, record in enumerate(records):
+            due = 0.0 if speed is None else (record["t"] - first) / speed
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Waiting for a slot is what makes an overloaded target fall behind schedule
+            await slots.acquire()
+            task = asyncio.create_task(send(index, record, due))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    return results, time.perf_counter() - started
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    rank = max(math.ceil(q / 100.0 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(results):
+    """{route: {count, errors, statuses, p50, p90, p99, max}} plus an "ALL" row"""
+    by_route = {}
+    for result in results:
+        by_route.setdefault(result["route"], []).append(result)
+    by_route["ALL"] = list(results)
+    summary = {}
+    for route, rows in by_route.items():
+        latencies = sorted(row["latency_ms"] for row in rows)
+        statuses = Counter(str(row["status"]) for row in rows)
+        entry = {"count": len(rows),
+                 "errors": sum(1 for row in rows if row["status"] is None or row["status"] >= 500),
+                 "statuses": dict(statuses)}
+        for q in PERCENTILES:
+            entry[f"p{q}"] = percentile(latencies, q)
+        entry["max"] = latencies[-1] if latencies else None
+        entry["max_lag_ms"] = max((row["lag_ms"] for row in rows), default=0.0)
+        summary[route] = entry
+    return summary
+
+
+def print_summary(summary, wall_s=None):
+    columns = [f"p{q}" for q in PERCENTILES] + ["max"]
+    print(f"{'route':<40} {'count':>7} {'errors':>6} " + " ".join(f"{name + ' ms':>9}" for name in columns))
+    for route in sorted(summary, key=lambda name: (name == "ALL", name)):
+        entry = summary[route]
+        print(f"{route:<40} {entry['count']:>7} {entry['errors']:>6} "
+              + " ".join(f"{entry[name]:>9.1f}" for name in columns))
+    if wall_s:
+        total = summary["ALL"]
+        print(f"\n {total['count']} requests in {wall_s:.1f}s ({total['count'] / wall_s:.1f}/s), "
+              f"max schedule lag {total['max_lag_ms']:.0f} ms")
+
+
+def strip_volatile(value, ignore):
+    if isinstance(value, dict):
+        return {key: strip_volatile(item, ignore) for key, item in value.items() if key not in ignore}
+    if isinstance(value, list):
+        return [strip_volatile(item, ignore) for item in value]
+    return value
+
+
+def diff_paths(a, b, path=""):
+    """Key paths where two JSON values differ"""
+    if isinstance(a, dict) and isinstance(b, dict):
+        paths = []
+        for key in sorted(set(a) | set(b), key=str):
+            paths.extend(diff_paths(a.get(key), b.get(key), f"{path}.{key}"))
+        return paths
+    if isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        paths = []
+        for position, (left, right) in enumerate(zip(a, b)):
+            paths.extend(diff_paths(left, right, f"{path}[{position}]"))
+        return paths
+    return [] if a == b else [path or "."]
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as results:
+        return [json.loads(line) for line in results if line.strip()]
+
+
+def diff_results(before, after, ignore=DEFAULT_IGNORE):
+    """Per-route counts of status/body differences and examples"""
+    after_by_index = {result["i"]: result for result in after}
+    report = {"compared": 0, "missing": 0, "status": 0, "body": 0, "routes": {}, "examples": []}
+    ignore = set(ignore)
+    for left in before:
+        right = after_by_index.get(left["i"])
+        if right is None:
+            report["missing"] += 1
+            continue
+        report["compared"] += 1
+        route = report["routes"].setdefault(left["route"], {"compared": 0, "status": 0, "body": 0})
+        route["compared"] += 1
+        if left["status"] != right["status"]:
+            kind, paths = "status", [f"{left['status']} -> {right['status']}"]
+        elif "body" in left and "body" in right:
+            paths = diff_paths(strip_volatile(left["body"], ignore), strip_volatile(right["body"], ignore))
+            kind = "body" if paths else None
+        else:
+            same = left.get("body_sha1") == right.get("body_sha1") and ("body" in left) == ("body" in right)
+            kind, paths = (None, []) if same else ("body", ["<non-JSON body>"])
+        if kind:
+            report[kind] += 1
+            route[kind] += 1
+            report["examples"].append({"i": left["i"], "route": left["route"], "kind": kind, "paths": paths[:10]})
+    return report
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Replay captured API traffic and compare builds")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="replay captures against a target")
+    run.add_argument("captures", nargs="+")
+    run.add_argument("--target", default="http://127.0.0.1:8000")
+    run.add_argument("--speed", default="1", help="time scale: 1 = as captured, N = N times faster, max")
+    run.add_argument("--concurrency", type=int, default=64)
+    run.add_argument("--timeout", type=float, default=30.0)
+    run.add_argument("--limit", type=int)
+    run.add_argument("--out", default="replay_results.jsonl")
+    report = sub.add_parser("report", help="latency percentiles of a results file")
+    report.add_argument("results")
+    diff = sub.add_parser("diff", help="compare the results of two builds")
+    diff.add_argument("before")
+    diff.add_argument("after")
+    diff.add_argument("--ignore", default=",".join(DEFAULT_IGNORE), help="JSON keys to skip")
+    diff.add_argument("--show", type=int, default=10, help="examples to print")
+    args = arg_parser.parse_args()
+
+    if args.command == "run":
+        speed = None if args.speed == "max" else float(args.speed)
+        if speed is not None and speed <= 0:
+            arg_parser.error("--speed must be positive or max")
+        records = load_captures(args.captures, args.limit)
+        if not records:
+            print(" No captured requests found")
+            raise SystemExit(1)
+        span = records[-1]["t"] - records[0]["t"]
+        print(f"▶️ Replaying {len(records)} requests ({span:.0f}s captured) against {args.target} "
+              f"at {args.speed}{'x' if speed else ''} speed")
+        results, wall_s = asyncio.run(replay(records, args.target, speed, args.concurrency, args.timeout))
+        with open(args.out, "w", encoding="utf-8") as out:
+            for result in results:
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        print_summary(summarize(results), wall_s)
+        print(f" Results written to {args.out}")
+    elif args.command == "report":
+        print_summary(summarize(load_results(args.results)))
+    else:
+        before, after = load_results(args.before), load_results(args.after)
+        ignore = [key.strip() for key in args.ignore.split(",") if key.strip()]
+        result = diff_results(before, after, ignore)
+        print(f" {result['compared']} responses compared: {result['status']} status and "
+              f"{result['body']} body differences ({result['missing']} missing in {args.after})\n")
+        for route, counts in sorted(result["routes"].items()):
+            print(f"  {route:<40} {counts['compared']:>7} compared {counts['status']:>5} status "
+                  f"{counts['body']:>5} body")
+        for example in result["examples"][:args.show]:
+            print(f"  #{example['i']} {example['route']} {example['kind']}: {', '.join(example['paths'])}")
+
+        print("\nLatency (before | after):")
+        left, right = summarize(before), summarize(after)
+        for route in sorted(set(left) & set(right), key=lambda name: (name == "ALL", name)):
+            cells = " ".join(f"p{q} {left[route][f'p{q}']:.1f}|{right[route][f'p{q}']:.1f}" for q in PERCENTILES)
+            print(f"  {route:<40} {cells}")
+        if result["status"] or result["body"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
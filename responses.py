@@ -0,0 +1,78 @@
+import gzip
+import json
+
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = 1024
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+class ParseResultResponse(Response):
+    """JSON response built from pre-encoded ParseResult bytes (no jsonable_encoder pass)"""
+    media_type = "application/json"
+
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return content.to_json_bytes()
+
+
+def etag_matches(request, etag):
+    """True if the request's If-None-Match covers this strong ETag"""
+    header = request.headers.get("if-none-match")
+    if not header or etag is None:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+
+def negotiate_encoding(request):
+    """Pick br (when the brotli module is installed) or gzip from Accept-Encoding"""
+    accepted = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compressed_json_response(request, payload, etag=None, encoding=None):
+    """Encode payload once and compress it for clients that accept br/gzip
+
+    Strong ETags must differ per encoding, so callers that send one should
+    negotiate the encoding first, fold it into the tag and pass it in.
+    """
+    headers = {"Vary": "Accept-Encoding"}
+    if etag:
+        headers["ETag"] = etag
+    body = _encode(payload).encode("utf-8")
+
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = encoding or negotiate_encoding(request)
+        if encoding == "br":
+            body = brotli.compress(body, quality=5)
+            headers["Content-Encoding"] = "br"
+        elif encoding == "gzip":
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept-Encoding"})
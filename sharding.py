@@ -0,0 +1,349 @@
+"""Spread users over several PostgreSQL databases.
+
+Every user-scoped query already carries a user_id, so a user's rows can
+live on one shard. DB_SHARDS names the shards as comma-separated
+name=dsn pairs:
+
+    DB_SHARDS="s0=postgresql://app@pg0/finapp_sms,s1=postgresql://app@pg1/finapp_sms"
+
+ShardRouter maps a user_id to a shard through a consistent-hash ring.
+Each shard gets SHARD_VNODES points on the ring, so adding a shard moves
+about 1/N of the users and leaves the rest where they are.
+ShardedDatabase has the Database interface: per-user methods go to the
+owning shard (each with its own connection), and cross-user ones fan out.
+The users and merchant tables are not sharded. Every shard seeds the same
+default merchants.
+
+Rebalancing after a change to DB_SHARDS:
+
+    python sharding.py plan                        # users whose rows are on the wrong shard
+    python sharding.py rebalance [--dry-run]       # move all of them
+    python sharding.py move --user 42 --to s1 [--from s0]
+
+A move copies the user's rows to the target with fresh ids (links between
+sms_messages, sms_transactions, transactions, transaction_links and
+receipt_images are remapped), records each copy in the target's shard_moves ledger, then
+deletes the originals. A move that dies half way is simply re-run: rows
+already in the ledger are not copied again. Rows written to the old shard
+while the move runs stay there; deploy the new DB_SHARDS first, then
+rebalance, and a second pass sweeps up any stragglers.
+"""
+import os
+import bisect
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', '64'))
+
+# Parents before children, so foreign ids can be remapped on the way
+USER_TABLES = ("receipt_images", "sms_messages", "sms_transactions", "transactions", "transaction_links")
+ID_LINKS = {"sms_id": "sms_messages", "receipt_id": "receipt_images", "transaction_id": "sms_transactions"}
+
+
+def parse_shards(spec):
+    """'s0=dsn0,s1=dsn1' -> [(name, dsn)]"""
+    shards = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, sep, dsn = entry.partition("=")
+        if not sep or not name.strip() or not dsn.strip():
+            raise ValueError(f"DB_SHARDS entry must be name=dsn, got {entry!r}")
+        shards.append((name.strip(), dsn.strip()))
+    names = [name for name, _ in shards]
+    if not names:
+        raise ValueError("DB_SHARDS names no shards")
+    if len(set(names)) != len(names):
+        raise ValueError("DB_SHARDS has duplicate shard names")
+    return shards
+
+
+def _ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class ShardRouter:
+    """Consistent-hash ring from user_id to shard name"""
+
+    def __init__(self, names, vnodes=SHARD_VNODES):
+        self.names = list(names)
+        points = sorted((_ring_hash(f"{name}#{i}"), name) for name in self.names for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def shard_for(self, user_id):
+        position = bisect.bisect(self._hashes, _ring_hash(f"user:{user_id}"))
+        return self._owners[position % len(self._owners)]
+
+
+class ShardedDatabase:
+    """Database look-alike that routes each user to its shard"""
+
+    def __init__(self, shards, vnodes=SHARD_VNODES):
+        # shards: [(name, Database)]
+        self.shards = dict(shards)
+        self.router = ShardRouter(self.shards, vnodes)
+        self.name = "sharded"
+
+    @classmethod
+    def from_env(cls):
+        from database import Database
+        shards = parse_shards(os.environ['DB_SHARDS'])
+        return cls([(name, Database({"dsn": dsn}, name=name)) for name, dsn in shards])
+
+    def shard_for(self, user_id):
+        return self.shards[self.router.shard_for(user_id)]
+
+    def shard(self, name):
+        if name not in self.shards:
+            raise KeyError(f"Unknown shard: {name} (have {', '.join(self.shards)})")
+        return self.shards[name]
+
+    def shard_databases(self):
+        return list(self.shards.values())
+
+    def fan_out(self, fn):
+        """Run fn(shard_database) on every shard in parallel; {name: result}"""
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as pool:
+            futures = {name: pool.submit(fn, shard) for name, shard in self.shards.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    @property
+    def conn(self):
+        """A connection when every shard is connected (health checks), else None"""
+        conns = [shard.conn for shard in self.shards.values()]
+        if any(conn is None or conn.closed for conn in conns):
+            return None
+        return conns[0]
+
+    def connect(self):
+        """Reconnect shards whose connection was lost"""
+        self.reconnect()
+
+    def reconnect(self):
+        for shard in self.shards.values():
+            shard.reconnect()
+
+    def new_connection(self, user_id=None):
+        if user_id is None:
+            raise ValueError("A sharded connection needs a user_id; use shard_databases() for cross-user work")
+        return self.shard_for(user_id).new_connection()
+
+    # Per-user methods: the owning shard answers
+    def save_sms_message(self, user_id, *args, **kwargs):
+        return self.shard_for(user_id).save_sms_message(user_id, *args, **kwargs)
+
+    def save_parsed_sms_transaction(self, user_id, *args, **kwargs):
+        return self.shard_for(user_id).save_parsed_sms_transaction(user_id, *args, **kwargs)
+
+    def save_receipt_image(self, user_id, *args, **kwargs):
+        return self.shard_for(user_id).save_receipt_image(user_id, *args, **kwargs)
+
+    def get_receipt_by_hash(self, user_id, sha256):
+        return self.shard_for(user_id).get_receipt_by_hash(user_id, sha256)
+
+    def save_transaction_link(self, user_id, *args, **kwargs):
+        return self.shard_for(user_id).save_transaction_link(user_id, *args, **kwargs)
+
+    def write_unavailable(self, user_id=None):
+        return self.shard_for(user_id).write_unavailable() if user_id is not None else False
+
+    def save_transaction(self, user_id, *args, **kwargs):
+        return self.shard_for(user_id).save_transaction(user_id, *args, **kwargs)
+
+    def get_user_write_version(self, user_id):
+        return self.shard_for(user_id).get_user_write_version(user_id)
+
+    def get_user_transactions(self, user_id, limit=100):
+        return self.shard_for(user_id).get_user_transactions(user_id, limit)
+
+    def get_sms_history(self, user_id, limit=50):
+        return self.shard_for(user_id).get_sms_history(user_id, limit)
+
+    # Cross-user methods
+    def get_merchant_aliases(self):
+        for shard in self.shards.values():
+            if shard.conn:
+                return shard.get_merchant_aliases()
+        return []
+
+    def get_parse_queue_stats(self, lease_seconds, max_attempts):
+        per_shard = self.fan_out(lambda shard: shard.get_parse_queue_stats(lease_seconds, max_attempts))
+        if any(stats is None for stats in per_shard.values()):
+            return None
+        totals = {}
+        for stats in per_shard.values():
+            for name, value in stats.items():
+                if name in ("oldest_unprocessed_age_s", "claim_lag_s"):
+                    totals[name] = max(totals.get(name) or 0, value or 0)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+        totals["shards"] = per_shard
+        return totals
+
+
+def _user_ids(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(" UNION ".join(f"SELECT DISTINCT user_id FROM {table}" for table in USER_TABLES))
+        user_ids = sorted(row[0] for row in cursor.fetchall() if row[0] is not None)
+    conn.rollback()
+    return user_ids
+
+
+def misplaced_users(database):
+    """[(user_id, current shard, owning shard)] for rows not on their ring shard"""
+    moves = []
+    for name, shard in database.shards.items():
+        conn = shard.new_connection()
+        if conn is None:
+            raise RuntimeError(f"Shard {name} is unavailable")
+        try:
+            for user_id in _user_ids(conn):
+                owner = database.router.shard_for(user_id)
+                if owner != name:
+                    moves.append((user_id, name, owner))
+        finally:
+            conn.close()
+    return moves
+
+
+def move_user(source_conn, target_conn, source_name, user_id):
+    """Copy a user's rows to the target shard, then delete them from the source
+
+    Returns {table: rows moved}. Safe to re-run after a failure at any point.
+    """
+    moved = {}
+    id_maps = {}
+    try:
+        with source_conn.cursor() as source, target_conn.cursor() as target:
+            copied = {}
+            for table in USER_TABLES:
+                source.execute(f"SELECT * FROM {table} WHERE user_id = %s ORDER BY id FOR UPDATE", (user_id,))
+                columns = [column.name for column in source.description]
+                rows = source.fetchall()
+                copied[table] = [row[0] for row in rows]
+                if not rows:
+                    id_maps[table] = {}
+                    continue
+
+                # Rows a previous, interrupted move already copied
+                target.execute("""
+                    SELECT source_id, target_id FROM shard_moves
+                    WHERE source_shard = %s AND table_name = %s AND source_id = ANY(%s)
+                """, (source_name, table, copied[table]))
+                mapping = dict(target.fetchall())
+                fresh = [row for row in rows if row[0] not in mapping]
+
+                if fresh:
+                    target.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                                   (table, len(fresh)))
+                    for row, (new_id,) in zip(fresh, target.fetchall()):
+                        mapping[row[0]] = new_id
+
+                    remapped = []
+                    for row in fresh:
+                        values = list(row)
+                        values[0] = mapping[row[0]]
+                        for position, column in enumerate(columns):
+                            if column in ID_LINKS and values[position] is not None:
+                                values[position] = id_maps.get(ID_LINKS[column], {}).get(values[position])
+                        remapped.append(values)
+                    column_list = ", ".join(columns)
+                    execute_values(target, f"INSERT INTO {table} ({column_list}) VALUES %s", remapped)
+                    execute_values(target, """
+                        INSERT INTO shard_moves (source_shard, table_name, source_id, target_id, user_id)
+                        VALUES %s
+                    """, [(source_name, table, row[0], mapping[row[0]], user_id) for row in fresh])
+                id_maps[table] = mapping
+                moved[table] = len(fresh)
+            target_conn.commit()
+
+            for table in reversed(USER_TABLES):
+                if copied[table]:
+                    source.execute(f"DELETE FROM {table} WHERE id = ANY(%s) AND user_id = %s",
+                                   (copied[table], user_id))
+            source_conn.commit()
+    except Exception:
+        target_conn.rollback()
+        source_conn.rollback()
+        raise
+    return moved
+
+
+def move(database, user_id, target_name, source_name=None):
+    """Move one user; source defaults to every shard other than the target"""
+    database.shard(target_name)
+    sources = [source_name] if source_name else [name for name in database.shards if name != target_name]
+    target_conn = database.shard(target_name).new_connection()
+    if target_conn is None:
+        raise RuntimeError(f"Shard {target_name} is unavailable")
+    totals = {}
+    try:
+        for name in sources:
+            source_conn = database.shard(name).new_connection()
+            if source_conn is None:
+                raise RuntimeError(f"Shard {name} is unavailable")
+            try:
+                moved = move_user(source_conn, target_conn, name, user_id)
+            finally:
+                source_conn.close()
+            if moved:
+                log.info("🔀 User %s: %s -> %s %s", user_id, name, target_name, moved)
+            for table, count in moved.items():
+                totals[table] = totals.get(table, 0) + count
+    finally:
+        target_conn.close()
+    return totals
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Inspect and rebalance user shards")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="users per shard")
+    sub.add_parser("plan", help="list users stored on the wrong shard")
+    rebalance = sub.add_parser("rebalance", help="move every misplaced user to its ring shard")
+    rebalance.add_argument("--dry-run", action="store_true")
+    move_cmd = sub.add_parser("move", help="move one user's rows")
+    move_cmd.add_argument("--user", type=int, required=True)
+    move_cmd.add_argument("--to", required=True)
+    move_cmd.add_argument("--from", dest="source")
+    args = arg_parser.parse_args()
+
+    from database import db
+    if not hasattr(db, "router"):
+        print(" DB_SHARDS is not set, nothing to route")
+        raise SystemExit(2)
+
+    if args.command == "status":
+        def count(shard):
+            conn = shard.new_connection()
+            if conn is None:
+                return None
+            try:
+                return len(_user_ids(conn))
+            finally:
+                conn.close()
+        for name, users in db.fan_out(count).items():
+            print(f" {name}: {'unavailable' if users is None else f'{users} users'}")
+    elif args.command == "move":
+        print(f" {move(db, args.user, args.to, args.source)}")
+    else:
+        plan = misplaced_users(db)
+        for user_id, current, owner in plan:
+            print(f" user {user_id}: {current} -> {owner}")
+        if args.command == "rebalance" and not args.dry_run:
+            for user_id, current, owner in plan:
+                move(db, user_id, owner, current)
+        print(f" {len(plan)} misplaced users")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,230 @@
 ﻿import re
+import os
 import json
+import time
+import threading
 from datetime import datetime
 from dateutil import parser
 
+from merchant_index import MerchantIndex
+from parse_result import FIELD_NAMES, FieldResult, ParseResult
+from metrics import metrics
+from profiler import profiler
+from spool import spool_record
+from prefilter import PREFILTER_ENABLED, TRANSACTIONAL, SMSPrefilter
+from log_config import get_logger, start_trace, tracing
+from dedupe import DEDUPE_ENABLED, DuplicateIndex
+
+log = get_logger(__name__)
+
+# Input guards: cap the text the regex cascades see and give each message a
+# time budget. Python's re cannot be interrupted mid-search, so the budget is
+# checked between pattern attempts while the length cap bounds each attempt.
+GUARDS_ENABLED = os.getenv('PARSER_GUARDS', 'true').lower() == 'true'
+MAX_SMS_LENGTH = int(os.getenv('MAX_SMS_LENGTH', '1000'))
+PARSE_TIME_BUDGET_MS = float(os.getenv('PARSE_TIME_BUDGET_MS', '50'))
+DEGRADED_CONFIDENCE_FACTOR = 0.5
+
+# ALL possible amount patterns (ordered by priority), compiled once
+AMOUNT_PATTERNS = [re.compile(p, re.IGNORECASE) for p in [
+    # Pattern 1: Rs. 1,500.00 or ₹1,500.00 or INR 1,500.00
+    r'(?:Rs\.?|INR|₹)\s*([\d,]+\.\d{2})\b',
+    
+    # Pattern 2: 1,500.00 Rs or 1,500.00 INR
+    r'([\d,]+\.\d{2})\s*(?:Rs|INR|₹)\b',
+    
+    # Pattern 3: debited/paid/spent 1,500.00
+    r'(?:debited|paid|spent|credited)\D*?([\d,]+\.\d{2})\b',
+    
+    # Pattern 4: Amount: 4,500.00 or Amt: 4,500.00
+    r'(?:Amount|Amt)[:\s]*([\d,]+\.\d{2})\b',
+    
+    # Pattern 5: Rs. 1,500 (without .00)
+    r'(?:Rs\.?|INR|₹)\s*([\d,]+)\b',
+    
+    # Pattern 6: 1,500 Rs (without .00)
+    r'([\d,]+)\s*(?:Rs|INR|₹)\b',
+    
+    # Pattern 7: Any number with comma and optional decimals
+    r'\b([\d,]+\.?\d*)\s+(?:debited|paid|spent|credited|rs|inr)\b',
+    
+    # Pattern 8: Generic amount extraction as last resort
+    r'\b(\d{1,3}(?:,\d{3})*\.?\d*)\b(?=\s*(?:rs|inr|₹)?\s|$)'
+]]
+
+DATE_PATTERNS = [re.compile(p, re.IGNORECASE) for p in [
+    r'on\s+(\d{2}-\d{2}-\d{4})',          # on 15-12-2023
+    r'on\s+(\d{1,2}/\d{1,2}/\d{4})',      # on 15/12/2023
+    r'Date[:\s]*(\d{2}-\d{2}-\d{4})',     # Date: 15-12-2023
+    r'(\d{2}-\d{2}-\d{4})',               # 15-12-2023
+    r'(\d{1,2}/\d{1,2}/\d{4})',           # 15/12/2023
+    r'(\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{4})',  # 15 Dec 2023
+]]
+
+MERCHANT_PATTERNS = [re.compile(p) for p in [
+    r'at\s+([A-Z][A-Z\s&]+?)(?:\s+on|\.|,|$)',      # at AMAZON INDIA on
+    r'to\s+([A-Z][A-Z\s&]+?)(?:\s+on|\.|,|$)',      # to AMAZON INDIA
+    r'@\s+([A-Z][A-Z\s&]+?)(?:\s+on|\.|,|$)',       # @ AMAZON INDIA
+    r'(?:Info|Merchant)[:\s]*([^\n.,]+)',           # Info: AMAZON INDIA
+    r'(?:via|through)\s+([A-Z][A-Z\s&]+)',          # via AMAZON INDIA
+    r'[^\w]([A-Z]{2,}[A-Z\s&]+)(?:\s+(?:on|at|\.|,|$))',  # Any all caps words
+]]
+
+def resolve_fields(fields):
+    """Validate a field projection; None means every field"""
+    if fields is None:
+        return FIELD_NAMES
+    unknown = set(fields) - set(FIELD_NAMES)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(name for name in FIELD_NAMES if name in fields)
+
+class ParseBudgetExceeded(Exception):
+    """Raised by extractors when the per-message time budget runs out"""
+
+def check_deadline(deadline):
+    if deadline is not None and time.perf_counter() > deadline:
+        raise ParseBudgetExceeded()
+
+def record_guard_metrics(result):
+    """Count guarded inputs and prefilter verdicts (runs in the API process, also for pool results)"""
+    if result.message_class is not None:
+        metrics.inc(f'prefilter.{result.message_class}')
+    if result.truncated:
+        metrics.inc('parser.input_truncated')
+    if result.degraded:
+        metrics.inc('parser.budget_exceeded')
+
+def clean_merchant_name(raw):
+    """Collapse whitespace, title-case and strip company suffixes"""
+    merchant = raw.strip()
+    merchant = re.sub(r'\s+', ' ', merchant)  # Remove extra spaces
+    merchant = ' '.join(word.capitalize() for word in merchant.split())
+    
+    # Remove common suffixes
+    suffixes = ['Pvt', 'Ltd', 'Inc', 'Corp', 'LLC']
+    for suffix in suffixes:
+        if merchant.endswith(suffix):
+            merchant = merchant[:-len(suffix)].strip()
+    return merchant
+
+def amount_confidence(tier):
+    """Higher confidence for more specific patterns (tier is 1-based)"""
+    return 0.95 if tier <= 4 else 0.85
+
+def assemble_result(wanted, fields, ran, degraded, truncated, bank, txn_type,
+                    amount, date, merchant, merchant_id, category):
+    """Combine per-field (value, confidence) pairs into a ParseResult
+    
+    Shared by parse() and parse_batch() so both paths score identically.
+    """
+    bank_detected, bank_conf = bank
+    txn_type_value, txn_type_conf = txn_type
+    amount_value, amount_conf = amount
+    date_value, date_conf = date
+    merchant_value, merchant_conf = merchant
+    
+    # Calculate overall confidence from the fields that ran
+    confidences = []
+    if "amount" in ran and amount_conf > 0:
+        confidences.append(amount_conf)
+    if "date" in ran and date_conf > 0:
+        confidences.append(date_conf)
+    if "merchant" in ran and merchant_conf > 0:
+        confidences.append(merchant_conf)
+    
+    bank_factor = bank_conf if "bank" in ran else 1.0
+    txn_type_factor = txn_type_conf if "transaction_type" in ran else 1.0
+    if confidences:
+        field_avg = sum(confidences) / len(confidences)
+        overall_conf = field_avg * bank_factor * txn_type_factor
+    else:
+        overall_conf = bank_factor * txn_type_factor * 0.5
+    
+    if degraded:
+        overall_conf *= DEGRADED_CONFIDENCE_FACTOR
+    
+    result = ParseResult(
+        amount=FieldResult(amount_value, amount_conf),
+        merchant=FieldResult(merchant_value, merchant_conf),
+        date=FieldResult(date_value, date_conf),
+        bank=FieldResult(bank_detected, bank_conf),
+        transaction_type=FieldResult(txn_type_value, txn_type_conf),
+        merchant_id=merchant_id,
+        category=category,
+        confidence=overall_conf
+    )
+    result.truncated = truncated
+    result.degraded = degraded
+    if fields is not None:
+        result.fields = wanted
+        result.success = amount_value is not None if "amount" in wanted else bool(ran)
+    return result
+
+def prefiltered_result(message_class, truncated, degraded=False):
+    """Result for a message the prefilter kept away from the extractors"""
+    result = assemble_result(
+        FIELD_NAMES, None, set(), degraded, truncated,
+        bank=(None, 0.5),
+        txn_type=('UNKNOWN', 0.5),
+        amount=(None, 0.0),
+        date=(None, 0.0),
+        merchant=(None, 0.0),
+        merchant_id=None,
+        category="Uncategorized"
+    )
+    result.confidence = 0.0
+    result.message_class = message_class
+    return result
+
+def cascade_column(texts, rows, patterns, convert, deadline=None):
+    """Apply a pattern tier list to a column of messages
+    
+    Each tier runs over every still-unresolved row before the next tier is
+    tried, so the per-pattern Python dispatch is paid once per tier instead
+    of once per message. A row is resolved by the first tier whose match
+    converts without raising, exactly like the per-message loops.
+    
+    Returns ({row: (tier, value)}, unresolved rows, rows cut off by the deadline).
+    """
+    found = {}
+    active = list(rows)
+    for tier, pattern in enumerate(patterns, 1):
+        if not active:
+            break
+        if deadline is not None and time.perf_counter() > deadline:
+            return found, [], active
+        search = pattern.search
+        still_active = []
+        for row in active:
+            match = search(texts[row])
+            if match:
+                try:
+                    found[row] = (tier, convert(match.group(1)))
+                    continue
+                except Exception:
+                    pass
+            still_active.append(row)
+        active = still_active
+    return found, active, []
+
+def _parse_amount(text):
+    return float(text.replace(',', ''))
+
+def _parse_date(text):
+    return parser.parse(text, dayfirst=True, fuzzy=True)
+
 class SMSParser:
-    def __init__(self, db_instance):
+    def __init__(self, db_instance, merchant_rows=None, spool=None):
         self.db = db_instance
+        self.spool = spool
+        self.prefilter = SMSPrefilter() if PREFILTER_ENABLED else None
+        # Recent transactions per user, to link a payment's second notification
+        self.dedupe = DuplicateIndex() if DEDUPE_ENABLED else None
+        self._persist_lock = threading.Lock()
         self.bank_patterns = self.load_bank_patterns()
-        print("✅ SMS Parser initialized with improved patterns")
+        self.merchant_index = self.load_merchant_index(merchant_rows)
+        log.info("✅ SMS Parser initialized with improved patterns")
     
     def load_bank_patterns(self):
         return {
@@ -20,6 +237,21 @@ class SMSParser:
             "PHONEPE": {"confidence": 0.89}
         }
     
+    def load_merchant_index(self, rows=None):
+        """Build the merchant alias index from the DB, falling back to built-in defaults"""
+        cache_size = int(os.getenv('MERCHANT_CACHE_SIZE', '10000'))
+        if rows is None and self.db and hasattr(self.db, 'get_merchant_aliases'):
+            rows = self.db.get_merchant_aliases()
+        
+        # Kept so worker processes can rebuild the same index without a DB
+        self.merchant_rows = rows
+        if rows:
+            index = MerchantIndex.from_rows(rows, cache_size=cache_size)
+        else:
+            index = MerchantIndex.from_defaults(cache_size=cache_size)
+        log.info("🏷️ Merchant index loaded with %d aliases", index.alias_count)
+        return index
+    
     def detect_bank(self, message_text, sender_number=None):
         """Improved bank detection"""
         message_lower = message_text.lower()
@@ -46,130 +278,86 @@ class SMSParser:
         else:
             return None, 0.5
     
-    def extract_amount(self, message_text):
+    def extract_amount(self, message_text, deadline=None):
         """COMPLETE FIXED VERSION - extracts all amount formats"""
-        print(f"🔍 Extracting amount from: {message_text[:80]}...")
-        
-        # ALL possible amount patterns (ordered by priority)
-        patterns = [
-            # Pattern 1: Rs. 1,500.00 or ₹1,500.00 or INR 1,500.00
-            r'(?:Rs\.?|INR|₹)\s*([\d,]+\.\d{2})\b',
-            
-            # Pattern 2: 1,500.00 Rs or 1,500.00 INR
-            r'([\d,]+\.\d{2})\s*(?:Rs|INR|₹)\b',
-            
-            # Pattern 3: debited/paid/spent 1,500.00
-            r'(?:debited|paid|spent|credited)\D*?([\d,]+\.\d{2})\b',
-            
-            # Pattern 4: Amount: 4,500.00 or Amt: 4,500.00
-            r'(?:Amount|Amt)[:\s]*([\d,]+\.\d{2})\b',
-            
-            # Pattern 5: Rs. 1,500 (without .00)
-            r'(?:Rs\.?|INR|₹)\s*([\d,]+)\b',
-            
-            # Pattern 6: 1,500 Rs (without .00)
-            r'([\d,]+)\s*(?:Rs|INR|₹)\b',
-            
-            # Pattern 7: Any number with comma and optional decimals
-            r'\b([\d,]+\.?\d*)\s+(?:debited|paid|spent|credited|rs|inr)\b',
-            
-            # Pattern 8: Generic amount extraction as last resort
-            r'\b(\d{1,3}(?:,\d{3})*\.?\d*)\b(?=\s*(?:rs|inr|₹)?\s|$)'
-        ]
+        trace = tracing()
+        if trace:
+            log.debug("🔍 Extracting amount from: %s...", message_text[:80])
         
-        for i, pattern in enumerate(patterns, 1):
-            match = re.search(pattern, message_text, re.IGNORECASE)
+        for i, pattern in enumerate(AMOUNT_PATTERNS, 1):
+            check_deadline(deadline)
+            match = pattern.search(message_text)
             if match:
                 amount_str = match.group(1)
-                print(f"  Pattern {i} matched: '{amount_str}'")
+                if trace:
+                    log.debug("  Pattern %d matched: '%s'", i, amount_str)
                 
                 # Clean and convert
                 try:
                     amount_clean = amount_str.replace(',', '')
                     amount = float(amount_clean)
-                    print(f"  ✅ Parsed amount: {amount}")
+                    if trace:
+                        log.debug("  ✅ Parsed amount: %s", amount)
                     
-                    # Higher confidence for more specific patterns
-                    confidence = 0.95 if i <= 4 else 0.85
+                    confidence = amount_confidence(i)
                     return amount, confidence
                     
                 except ValueError as e:
-                    print(f"  ⚠️ Failed to parse '{amount_str}': {e}")
+                    if trace:
+                        log.debug("  ⚠️ Failed to parse '%s': %s", amount_str, e)
                     continue
         
-        print(f"  ❌ No amount found")
+        if trace:
+            log.debug("  ❌ No amount found")
         return None, 0.0
     
-    def extract_date(self, message_text):
+    def extract_date(self, message_text, deadline=None):
         """Extract date from SMS"""
         date_obj = None
         confidence = 0.0
         
-        patterns = [
-            r'on\s+(\d{2}-\d{2}-\d{4})',          # on 15-12-2023
-            r'on\s+(\d{1,2}/\d{1,2}/\d{4})',      # on 15/12/2023
-            r'Date[:\s]*(\d{2}-\d{2}-\d{4})',     # Date: 15-12-2023
-            r'(\d{2}-\d{2}-\d{4})',               # 15-12-2023
-            r'(\d{1,2}/\d{1,2}/\d{4})',           # 15/12/2023
-            r'(\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{4})',  # 15 Dec 2023
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, message_text, re.IGNORECASE)
+        for pattern in DATE_PATTERNS:
+            check_deadline(deadline)
+            match = pattern.search(message_text)
             if match:
                 date_str = match.group(1)
                 try:
                     date_obj = parser.parse(date_str, dayfirst=True, fuzzy=True)
                     confidence = 0.9
-                    print(f"  ✅ Date found: {date_obj.date()}")
+                    if tracing():
+                        log.debug("  ✅ Date found: %s", date_obj.date())
                     break
                 except Exception as e:
-                    print(f"  ⚠️ Failed to parse date '{date_str}': {e}")
+                    if tracing():
+                        log.debug("  ⚠️ Failed to parse date '%s': %s", date_str, e)
                     continue
         
         if not date_obj:
             date_obj = datetime.now()
             confidence = 0.3
-            print(f"  ⚠️ Using current date: {date_obj.date()}")
+            if tracing():
+                log.debug("  ⚠️ Using current date: %s", date_obj.date())
         
         return date_obj.date(), confidence
     
-    def extract_merchant(self, message_text):
+    def extract_merchant(self, message_text, deadline=None):
         """Extract merchant name"""
         merchant = None
         confidence = 0.0
         
         # Try to extract merchant from different patterns
-        patterns = [
-            r'at\s+([A-Z][A-Z\s&]+?)(?:\s+on|\.|,|$)',      # at AMAZON INDIA on
-            r'to\s+([A-Z][A-Z\s&]+?)(?:\s+on|\.|,|$)',      # to AMAZON INDIA
-            r'@\s+([A-Z][A-Z\s&]+?)(?:\s+on|\.|,|$)',       # @ AMAZON INDIA
-            r'(?:Info|Merchant)[:\s]*([^\n.,]+)',           # Info: AMAZON INDIA
-            r'(?:via|through)\s+([A-Z][A-Z\s&]+)',          # via AMAZON INDIA
-            r'[^\w]([A-Z]{2,}[A-Z\s&]+)(?:\s+(?:on|at|\.|,|$))',  # Any all caps words
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, message_text)
+        for pattern in MERCHANT_PATTERNS:
+            check_deadline(deadline)
+            match = pattern.search(message_text)
             if match:
-                merchant = match.group(1).strip()
-                
-                # Clean up merchant name
-                merchant = re.sub(r'\s+', ' ', merchant)  # Remove extra spaces
-                merchant = ' '.join(word.capitalize() for word in merchant.split())
-                
-                # Remove common suffixes
-                suffixes = ['Pvt', 'Ltd', 'Inc', 'Corp', 'LLC']
-                for suffix in suffixes:
-                    if merchant.endswith(suffix):
-                        merchant = merchant[:-len(suffix)].strip()
-                
+                merchant = clean_merchant_name(match.group(1))
                 confidence = 0.8
-                print(f"  ✅ Merchant found: {merchant}")
+                if tracing():
+                    log.debug("  ✅ Merchant found: %s", merchant)
                 break
         
-        if not merchant:
-            print(f"  ⚠️ No merchant found")
+        if not merchant and tracing():
+            log.debug("  ⚠️ No merchant found")
         
         return merchant, confidence
     
@@ -187,71 +375,259 @@ class SMSParser:
         else:
             return 'UNKNOWN', 0.5
     
-    def parse_sms(self, user_id, message_text, sender_number=None, sender_name=None):
-        """Main parsing function - FIXED"""
-        print(f"\n" + "="*60)
-        print(f"📱 PARSING SMS for User {user_id}")
-        print(f"Message: {message_text}")
-        print("="*60)
-        
-        # Step 1: Detect bank
-        bank_detected, bank_conf = self.detect_bank(message_text, sender_number)
-        print(f"🏦 Bank: {bank_detected or 'Not detected'} (confidence: {bank_conf:.2f})")
-        
-        # Step 2: Extract transaction type
-        txn_type, txn_type_conf = self.extract_transaction_type(message_text)
-        print(f"💳 Type: {txn_type} (confidence: {txn_type_conf:.2f})")
-        
-        # Step 3: Extract amount (FIXED)
-        amount, amount_conf = self.extract_amount(message_text)
-        
-        # Step 4: Extract date
-        date, date_conf = self.extract_date(message_text)
-        
-        # Step 5: Extract merchant
-        merchant, merchant_conf = self.extract_merchant(message_text)
-        
-        print("-"*60)
-        
-        # Calculate overall confidence
-        confidences = []
-        if amount_conf > 0:
-            confidences.append(amount_conf)
-        if date_conf > 0:
-            confidences.append(date_conf)
-        if merchant_conf > 0:
-            confidences.append(merchant_conf)
-        
-        if confidences:
-            field_avg = sum(confidences) / len(confidences)
-            overall_conf = field_avg * bank_conf * txn_type_conf
-        else:
-            overall_conf = bank_conf * txn_type_conf * 0.5
-        
-        # Prepare result
-        result = {
-            "success": amount is not None,
-            "sms_id": None,
-            "transaction_id": None,
-            "parsed_data": {
-                "amount": amount,
-                "merchant": merchant,
-                "date": date.strftime("%Y-%m-%d") if date else None,
-                "bank": bank_detected,
-                "transaction_type": txn_type
-            },
-            "confidence": round(overall_conf, 3),
-            "field_confidences": {
-                "amount": round(amount_conf, 3),
-                "date": round(date_conf, 3),
-                "merchant": round(merchant_conf, 3),
-                "bank": round(bank_conf, 3),
-                "transaction_type": round(txn_type_conf, 3)
-            }
-        }
+    @profiler.profiled
+    def parse_sms(self, user_id, message_text, sender_number=None, sender_name=None, fields=None):
+        """Main parsing function - parse and save"""
+        result = self.parse(user_id, message_text, sender_number, fields)
+        record_guard_metrics(result)
+        return self.persist_result(result, user_id, message_text, sender_number, sender_name)
+    
+    @profiler.profiled
+    def parse(self, user_id, message_text, sender_number=None, fields=None):
+        """Parse only, no database access (safe to run in worker processes)
+        
+        fields: optional subset of FIELD_NAMES; other extractors are skipped.
+        """
+        wanted = resolve_fields(fields)
+        trace = start_trace(log)
+        if trace:
+            log.debug("📱 PARSING SMS for User %s: %s", user_id, message_text)
+        
+        # Input guards
+        truncated = False
+        deadline = None
+        if GUARDS_ENABLED:
+            if len(message_text) > MAX_SMS_LENGTH:
+                message_text = message_text[:MAX_SMS_LENGTH]
+                truncated = True
+                if trace:
+                    log.debug("✂️ Message truncated to %d chars", MAX_SMS_LENGTH)
+            deadline = time.perf_counter() + PARSE_TIME_BUDGET_MS / 1000.0
+        
+        # Prefilter: OTPs, promos and chatter never reach the extractors
+        # (projections ask for specific fields, so they always run them)
+        message_class = None
+        if self.prefilter is not None and fields is None:
+            message_class = self.prefilter.classify(message_text, sender_number)
+            if message_class != TRANSACTIONAL:
+                if trace:
+                    log.debug("🚫 Prefilter: %s message, skipping extraction", message_class)
+                # The prefilter spends the same budget as the extractors
+                over_budget = deadline is not None and time.perf_counter() > deadline
+                return prefiltered_result(message_class, truncated, over_budget)
+        
+        # Fields that do not run (not requested, short-circuited or budget
+        # exhausted) keep these defaults
+        bank_detected, bank_conf = None, 0.5
+        txn_type, txn_type_conf = 'UNKNOWN', 0.5
+        amount, amount_conf = None, 0.0
+        date, date_conf = None, 0.0
+        merchant, merchant_conf = None, 0.0
+        merchant_id, category = None, "Uncategorized"
+        ran = set()
+        degraded = False
+        
+        try:
+            # Step 1: Detect bank
+            if "bank" in wanted:
+                bank_detected, bank_conf = self.detect_bank(message_text, sender_number)
+                ran.add("bank")
+                if trace:
+                    log.debug("🏦 Bank: %s (confidence: %.2f)", bank_detected or 'Not detected', bank_conf)
+            
+            # Step 2: Extract transaction type
+            if "transaction_type" in wanted:
+                txn_type, txn_type_conf = self.extract_transaction_type(message_text)
+                ran.add("transaction_type")
+                if trace:
+                    log.debug("💳 Type: %s (confidence: %.2f)", txn_type, txn_type_conf)
+            
+            # Step 3: Extract amount (FIXED)
+            if "amount" in wanted:
+                amount, amount_conf = self.extract_amount(message_text, deadline)
+                ran.add("amount")
+            
+            # No amount means the message is not a transaction: skip the rest
+            if "amount" in ran and amount is None:
+                if trace:
+                    log.debug("⏭️ Non-transactional message, skipping date/merchant")
+            else:
+                # Step 4: Extract date
+                if "date" in wanted:
+                    date, date_conf = self.extract_date(message_text, deadline)
+                    ran.add("date")
+                
+                # Step 5: Extract merchant
+                if "merchant" in wanted:
+                    merchant, merchant_conf = self.extract_merchant(message_text, deadline)
+                    ran.add("merchant")
+        except ParseBudgetExceeded:
+            degraded = True
+            log.warning("⏱️ Parse budget of %sms exceeded, returning partial result", PARSE_TIME_BUDGET_MS)
+        
+        # Step 6: Canonicalize merchant + category in one index lookup
+        if "merchant" in ran:
+            merchant_id, merchant, category = self.merchant_index.lookup(merchant)
+            if trace:
+                log.debug("🏷️ Merchant: %s (id: %s, category: %s)", merchant or 'N/A', merchant_id, category)
+        
+        result = assemble_result(
+            wanted, fields, ran, degraded, truncated,
+            bank=(bank_detected, bank_conf),
+            txn_type=(txn_type, txn_type_conf),
+            amount=(amount, amount_conf),
+            date=(date, date_conf),
+            merchant=(merchant, merchant_conf),
+            merchant_id=merchant_id,
+            category=category
+        )
+        result.message_class = message_class
+        
+        if trace:
+            log.debug("📊 RESULT: success=%s amount=₹%s merchant=%s date=%s bank=%s type=%s confidence=%.2f%%",
+                      result.success, amount if amount else 'N/A', merchant or 'N/A',
+                      date.isoformat() if date else 'N/A', bank_detected or 'N/A', txn_type,
+                      result.confidence * 100)
+        
+        return result
+    
+    @profiler.profiled
+    def parse_batch(self, user_id, messages, sender_numbers=None, fields=None):
+        """Columnar parse of many messages; returns the same results as parse() per message
+        
+        Each field's pattern tiers are applied to the whole column of still
+        unresolved messages (see cascade_column) instead of running the full
+        cascade message by message. The time budget is pooled over the batch
+        (PARSE_TIME_BUDGET_MS per message) and checked between tiers; rows
+        still unresolved when it runs out are degraded, as in parse().
+        """
+        wanted = resolve_fields(fields)
+        count = len(messages)
+        if sender_numbers is None:
+            sender_numbers = [None] * count
+        
+        texts = list(messages)
+        truncated = [False] * count
+        deadline = None
+        if GUARDS_ENABLED:
+            for row, text in enumerate(texts):
+                if len(text) > MAX_SMS_LENGTH:
+                    texts[row] = text[:MAX_SMS_LENGTH]
+                    truncated[row] = True
+            deadline = time.perf_counter() + PARSE_TIME_BUDGET_MS / 1000.0 * max(count, 1)
+        
+        # Prefilter the column; only transactional rows go through the cascades
+        classes = [None] * count
+        if self.prefilter is not None and fields is None:
+            classify = self.prefilter.classify
+            classes = [classify(text, sender) for text, sender in zip(texts, sender_numbers)]
+        prefilter_over_budget = deadline is not None and time.perf_counter() > deadline
+        candidates = [row for row in range(count) if classes[row] in (None, TRANSACTIONAL)]
+        
+        ran = [set() for _ in range(count)]
+        degraded = [False] * count
+        banks = [(None, 0.5)] * count
+        txn_types = [('UNKNOWN', 0.5)] * count
+        amounts = [(None, 0.0)] * count
+        dates = [(None, 0.0)] * count
+        merchants = [(None, 0.0)] * count
+        lookups = [(None, None, "Uncategorized")] * count
+        
+        # Keyword checks have no cascade: evaluate them row by row
+        if "bank" in wanted:
+            for row in candidates:
+                banks[row] = self.detect_bank(texts[row], sender_numbers[row])
+                ran[row].add("bank")
+        if "transaction_type" in wanted:
+            for row in candidates:
+                txn_types[row] = self.extract_transaction_type(texts[row])
+                ran[row].add("transaction_type")
+        
+        rows = candidates
+        if "amount" in wanted:
+            found, _, cut = cascade_column(texts, rows, AMOUNT_PATTERNS, _parse_amount, deadline)
+            for row, (tier, amount) in found.items():
+                amounts[row] = (amount, amount_confidence(tier))
+            for row in cut:
+                degraded[row] = True
+            rows = []
+            for row in candidates:
+                if degraded[row]:
+                    continue
+                ran[row].add("amount")
+                # No amount means the message is not a transaction: skip the rest
+                if amounts[row][0] is not None:
+                    rows.append(row)
+        
+        if "date" in wanted:
+            found, missing, cut = cascade_column(texts, rows, DATE_PATTERNS, _parse_date, deadline)
+            for row, (_, date_obj) in found.items():
+                dates[row] = (date_obj.date(), 0.9)
+            for row in missing:
+                dates[row] = (datetime.now().date(), 0.3)
+            for row in cut:
+                degraded[row] = True
+            rows = [row for row in rows if not degraded[row]]
+            for row in rows:
+                ran[row].add("date")
+        
+        if "merchant" in wanted:
+            found, _, cut = cascade_column(texts, rows, MERCHANT_PATTERNS, clean_merchant_name, deadline)
+            for row, (_, merchant) in found.items():
+                merchants[row] = (merchant, 0.8)
+            for row in cut:
+                degraded[row] = True
+            for row in rows:
+                if not degraded[row]:
+                    ran[row].add("merchant")
+                    lookups[row] = self.merchant_index.lookup(merchants[row][0])
+        
+        results = []
+        for row in range(count):
+            if classes[row] not in (None, TRANSACTIONAL):
+                results.append(prefiltered_result(classes[row], truncated[row], prefilter_over_budget))
+                continue
+            merchant_id, merchant, category = lookups[row]
+            result = assemble_result(
+                wanted, fields, ran[row], degraded[row], truncated[row],
+                bank=banks[row],
+                txn_type=txn_types[row],
+                amount=amounts[row],
+                date=dates[row],
+                merchant=(merchant, merchants[row][1]),
+                merchant_id=merchant_id,
+                category=category
+            )
+            result.message_class = classes[row]
+            results.append(result)
+        log.debug("📦 Batch of %d messages parsed for User %s", count, user_id)
+        return results
+    
+    @profiler.profiled(counts=False)
+    def persist_result(self, result, user_id, message_text, sender_number=None, sender_name=None):
+        """Save a parse result to the database (always runs in the API process)"""
+        amount = result.amount.value
+        date = result.date.value
+        bank_detected = result.bank.value
+        overall_conf = result.confidence
+        
+        # Projected parses are read-only: they lack the fields a row needs
+        if result.fields is not None:
+            return result
         
         # Save to database if we have amount
         if amount and self.db and hasattr(self.db, 'save_sms_message'):
+            transaction = None
+            if overall_conf > 0.5:
+                transaction = {
+                    "amount": amount,
+                    "merchant": result.merchant.value or "Unknown Merchant",
+                    "transaction_date": date or datetime.now().date(),
+                    "bank_name": bank_detected or "Unknown Bank",
+                    "confidence": overall_conf,
+                    "merchant_id": result.merchant_id,
+                    "category": result.category
+                }
             try:
                 sms_id = self.db.save_sms_message(
                     user_id=user_id,
@@ -261,40 +637,56 @@ class SMSParser:
                     is_bank_sms=(bank_detected is not None),
                     bank_detected=bank_detected
                 )
-                result["sms_id"] = sms_id
+                result.sms_id = sms_id
                 
-                if sms_id and overall_conf > 0.5:
-                    transaction_id = self.db.save_parsed_sms_transaction(
-                        user_id=user_id,
-                        sms_id=sms_id,
-                        amount=amount,
-                        merchant=merchant or "Unknown Merchant",
-                        transaction_date=date or datetime.now().date(),
-                        bank_name=bank_detected or "Unknown Bank",
-                        confidence=overall_conf
-                    )
-                    result["transaction_id"] = transaction_id
+                # Batch writes run on a worker thread next to request handlers: the
+                # duplicate check and the insert it guards must not interleave
+                with self._persist_lock:
+                    match = None
+                    if sms_id and transaction and self.dedupe is not None:
+                        match = self.dedupe.find(user_id, amount, transaction["transaction_date"],
+                                                 result.transaction_type.value, transaction["merchant"],
+                                                 result.merchant_id, sender_number)
+                    if match is not None:
+                        # Same payment notified twice: link it, do not count it again
+                        original_id, similarity = match
+                        if self.db.save_transaction_link(user_id, original_id, sms_id, similarity):
+                            result.transaction_id = original_id
+                            result.duplicate = True
+                            transaction = None
+                            metrics.inc('dedupe.linked')
+                        else:
+                            match = None
+                    if sms_id and transaction and match is None:
+                        result.transaction_id = self.db.save_parsed_sms_transaction(
+                            user_id=user_id,
+                            sms_id=sms_id,
+                            **transaction
+                        )
+                        if result.transaction_id and self.dedupe is not None:
+                            self.dedupe.remember(user_id, amount, transaction["transaction_date"],
+                                                 result.transaction_type.value, result.transaction_id,
+                                                 transaction["merchant"], result.merchant_id, sender_number)
                     
             except Exception as e:
-                print(f"⚠️ Database error: {e}")
-        
-        print(f"📊 RESULT:")
-        print(f"  Success: {result['success']}")
-        print(f"  Amount: ₹{amount if amount else 'N/A'}")
-        print(f"  Merchant: {merchant or 'N/A'}")
-        print(f"  Date: {date.strftime('%Y-%m-%d') if date else 'N/A'}")
-        print(f"  Bank: {bank_detected or 'N/A'}")
-        print(f"  Type: {txn_type}")
-        print(f"  Confidence: {overall_conf:.2%}")
-        print("="*60)
+                log.error("⚠️ Database error: %s", e)
+            
+            # Database down or timing out: journal whatever was not saved (bad data is not retried)
+            unsaved = result.sms_id is None or (transaction and result.transaction_id is None)
+            if self.spool is not None and unsaved and self.db.write_unavailable(user_id):
+                seq = self.spool.append(spool_record(
+                    user_id, message_text, sender_number, sender_name, bank_detected,
+                    sms_id=result.sms_id, transaction=transaction
+                ))
+                log.warning("📼 Database unavailable, SMS spooled as record %d", seq)
         
         return result
 
 # Singleton instance
 sms_parser_instance = None
 
-def get_sms_parser(db):
+def get_sms_parser(db, spool=None):
     global sms_parser_instance
     if sms_parser_instance is None:
-        sms_parser_instance = SMSParser(db)
+        sms_parser_instance = SMSParser(db, spool=spool)
     return sms_parser_instance
@@ -0,0 +1,503 @@
+"""Durable local spool for SMS writes while PostgreSQL is unavailable.
+
+When a save fails because the database is unavailable (no connection,
+connection lost, connect or statement timeout; see is_unavailable_error)
+the SMS and its parse result are appended to a segmented, memory-mapped
+journal instead of being dropped. Other errors (bad data) are not spooled:
+retrying them would fail the same way. A background replayer drains the
+journal into Postgres in bulk once the database is reachable again.
+
+Journal layout (SPOOL_DIR):
+    spool.id                    random id of this journal, part of the replay key
+    replayed.seq                highest sequence number known to be in Postgres
+    segment-<first seq>.log     preallocated, mmap'd, SPOOL_SEGMENT_BYTES each
+    dead-letter.jsonl           records replay rejected for reasons other than availability
+    pid-<pid>/                  journal of another process that found SPOOL_DIR locked
+
+Each record is a 20-byte header (magic, payload length, sequence number,
+CRC32 of sequence + payload) followed by a JSON payload. The payload is
+written before its header, so a torn write leaves no valid record behind.
+Pages are msync'd every SPOOL_FSYNC_EVERY records or SPOOL_FSYNC_MS
+milliseconds, whichever comes first. A full segment is rotated to a new one.
+
+Replay is idempotent: each (spool id, sequence) pair is claimed in the
+spool_replayed table in the same transaction as the rows it produces, so
+re-running a batch after a crash inserts nothing twice. A batch that fails
+for any other reason is retried record by record, and the records that
+still fail go to dead-letter.jsonl so they do not block the ones behind.
+
+Whoever holds the SPOOL_DIR lock (the API process or the replay CLI) also
+drains pid-* journals whose process is gone (their lock is free) and
+removes them once they are empty.
+
+CLI:
+    python spool.py status [--dir DIR]
+    python spool.py replay [--dir DIR]
+"""
+import os
+import json
+import mmap
+import time
+import uuid
+import zlib
+import fcntl
+import shutil
+import struct
+import argparse
+import threading
+from datetime import datetime
+
+import psycopg2
+
+from metrics import metrics
+from log_config import get_logger
+
+SPOOL_ENABLED = os.getenv('SPOOL_ENABLED', 'true').lower() == 'true'
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+SPOOL_FSYNC_EVERY = int(os.getenv('SPOOL_FSYNC_EVERY', '64'))
+SPOOL_FSYNC_MS = float(os.getenv('SPOOL_FSYNC_MS', '50'))
+SPOOL_REPLAY_BATCH = int(os.getenv('SPOOL_REPLAY_BATCH', '500'))
+
+log = get_logger(__name__)
+
+RECORD_MAGIC = 0x53504C31  # "SPL1"
+HEADER = struct.Struct('<IIQI')
+SEQ = struct.Struct('<Q')
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def is_unavailable_error(error):
+    """Refused/lost connections and timeouts (QueryCanceled): the write may succeed later"""
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError, ConnectionError))
+
+
+def _segment_name(first_seq):
+    return f"segment-{first_seq:020d}.log"
+
+
+def _scan(buffer, limit=None):
+    """Yield (offset, seq, payload bytes) for each valid record from the start of a segment"""
+    offset = 0
+    end = len(buffer) if limit is None else limit
+    while offset + HEADER.size <= end:
+        magic, length, seq, crc = HEADER.unpack_from(buffer, offset)
+        if magic != RECORD_MAGIC or offset + HEADER.size + length > end:
+            return
+        payload = bytes(buffer[offset + HEADER.size:offset + HEADER.size + length])
+        if zlib.crc32(payload, zlib.crc32(SEQ.pack(seq))) != crc:
+            return
+        yield offset, seq, payload
+        offset += HEADER.size + length
+
+
+class Spool:
+    """Single-writer segmented journal; one instance per process"""
+
+    def __init__(self, directory=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES,
+                 fsync_every=SPOOL_FSYNC_EVERY, fsync_ms=SPOOL_FSYNC_MS, shared=True):
+        os.makedirs(directory, exist_ok=True)
+        self.root = directory
+        self.orphans = []
+        # A second process (e.g. another uvicorn worker) gets its own sub-journal;
+        # with shared=False a locked journal raises BlockingIOError instead
+        self._lock_file = open(os.path.join(directory, 'spool.lock'), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            if not shared:
+                raise
+            directory = os.path.join(directory, f"pid-{os.getpid()}")
+            os.makedirs(directory, exist_ok=True)
+            self._lock_file = open(os.path.join(directory, 'spool.lock'), 'a')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            self.orphans = self._open_orphans(segment_bytes)
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_ms / 1000.0
+        self.spool_id = self._load_spool_id()
+        self.replayed_seq = self._load_replayed_seq()
+
+        self._lock = threading.Lock()
+        self._map = None
+        self._file = None
+        self._segment_path = None
+        self._offset = 0
+        self._unsynced = 0
+        self.last_seq = self.replayed_seq
+        self._open_tail()
+
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="spool-fsync", daemon=True)
+        self._flusher.start()
+
+    # ---- files ----
+    def _open_orphans(self, segment_bytes):
+        """Journals left in pid-* directories by processes that are gone"""
+        orphans = []
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if not name.startswith('pid-') or not os.path.isdir(path):
+                continue
+            try:
+                orphan = Spool(path, segment_bytes, shared=False)
+            except BlockingIOError:
+                continue  # its process is still running
+            orphan.root = self.root
+            log.info("📼 Adopted journal %s (%d pending)", path, orphan.pending())
+            orphans.append(orphan)
+        return orphans
+
+    def retire_orphans(self):
+        """Close and delete adopted journals that are fully replayed"""
+        for orphan in list(self.orphans):
+            if orphan.pending() <= 0:
+                orphan.close()
+                shutil.rmtree(orphan.directory, ignore_errors=True)
+                self.orphans.remove(orphan)
+
+    def backlog(self):
+        """Pending records in this journal and the adopted ones"""
+        return self.pending() + sum(orphan.pending() for orphan in self.orphans)
+
+    def _load_spool_id(self):
+        path = os.path.join(self.directory, 'spool.id')
+        if os.path.exists(path):
+            with open(path) as f:
+                return f.read().strip()
+        spool_id = uuid.uuid4().hex
+        with open(path, 'w') as f:
+            f.write(spool_id)
+        return spool_id
+
+    def _load_replayed_seq(self):
+        path = os.path.join(self.directory, 'replayed.seq')
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+
+    def _store_replayed_seq(self, seq):
+        path = os.path.join(self.directory, 'replayed.seq')
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.replayed_seq = seq
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith('segment-') and name.endswith('.log'))
+
+    def _open_segment(self, path, create):
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o600)
+        # Also repairs a segment left empty by a crash right after creation
+        if os.fstat(fd).st_size < self.segment_bytes:
+            os.ftruncate(fd, self.segment_bytes)
+        self._file = fd
+        self._map = mmap.mmap(fd, os.fstat(fd).st_size)
+        self._segment_path = path
+
+    def _open_tail(self):
+        """Reopen the newest segment and find where its valid records end"""
+        names = self.segments()
+        if not names:
+            self._open_segment(os.path.join(self.directory, _segment_name(self.last_seq + 1)), create=True)
+            return
+        self._open_segment(os.path.join(self.directory, names[-1]), create=False)
+        for offset, seq, payload in _scan(self._map):
+            self._offset = offset + HEADER.size + len(payload)
+            self.last_seq = max(self.last_seq, seq)
+
+    def _rotate(self):
+        self._sync()
+        self._map.close()
+        os.close(self._file)
+        self._offset = 0
+        self._open_segment(os.path.join(self.directory, _segment_name(self.last_seq + 1)), create=True)
+        metrics.inc("spool.rotations")
+
+    # ---- writing ----
+    def append(self, record):
+        """Journal one record (a JSON-serializable dict); returns its sequence number"""
+        payload = json.dumps(record, separators=(",", ":"), default=str).encode("utf-8")
+        size = HEADER.size + len(payload)
+        if size > self.segment_bytes:
+            raise SpoolFull(f"Record of {size} bytes exceeds the spool segment size")
+        with self._lock:
+            if self._offset + size > len(self._map):
+                self._rotate()
+            seq = self.last_seq + 1
+            crc = zlib.crc32(payload, zlib.crc32(SEQ.pack(seq)))
+            start = self._offset + HEADER.size
+            self._map[start:start + len(payload)] = payload
+            self._map[self._offset:start] = HEADER.pack(RECORD_MAGIC, len(payload), seq, crc)
+            self._offset += size
+            self.last_seq = seq
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+        metrics.inc("spool.appended")
+        metrics.set_gauge("spool.pending", self.pending())
+        return seq
+
+    def _sync(self):
+        if self._unsynced:
+            self._map.flush()
+            self._unsynced = 0
+
+    def _flush_loop(self):
+        while not self._closed:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                if not self._closed and self._unsynced:
+                    self._sync()
+
+    def close(self):
+        for orphan in self.orphans:
+            orphan.close()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._sync()
+            self._map.close()
+            os.close(self._file)
+        self._lock_file.close()
+
+    # ---- reading ----
+    def pending(self):
+        return self.last_seq - self.replayed_seq
+
+    def read(self, after_seq, limit):
+        """Up to limit (seq, record) pairs with seq > after_seq, in order"""
+        records = []
+        names = self.segments()
+        for position, name in enumerate(names):
+            # Skip segments that end before after_seq (the next one starts later)
+            if position + 1 < len(names) and int(names[position + 1][8:28]) <= after_seq + 1:
+                continue
+            path = os.path.join(self.directory, name)
+            with self._lock:
+                if path == self._segment_path:
+                    data = bytes(self._map[:self._offset])
+                else:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+            for _, seq, payload in _scan(data):
+                if seq > after_seq:
+                    records.append((seq, json.loads(payload)))
+                    if len(records) >= limit:
+                        return records
+        return records
+
+    def mark_replayed(self, seq):
+        """Advance the watermark and delete segments that are fully replayed"""
+        self._store_replayed_seq(seq)
+        names = self.segments()
+        for position, name in enumerate(names[:-1]):
+            next_first = int(names[position + 1][8:28])
+            path = os.path.join(self.directory, name)
+            if next_first - 1 <= seq and path != self._segment_path:
+                os.remove(path)
+        metrics.set_gauge("spool.pending", self.pending())
+
+    def dead_letter(self, seq, record, error):
+        """Set aside a record that replay keeps rejecting"""
+        entry = {"spool_id": self.spool_id, "seq": seq, "error": f"{type(error).__name__}: {error}",
+                 "record": record}
+        with open(os.path.join(self.root, 'dead-letter.jsonl'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        metrics.inc("spool.dead_letter")
+        log.error("📼 Spool record %s/%d moved to dead-letter.jsonl: %s", self.spool_id, seq, entry["error"])
+
+    def status(self):
+        status = {
+            "directory": self.directory,
+            "spool_id": self.spool_id,
+            "last_seq": self.last_seq,
+            "replayed_seq": self.replayed_seq,
+            "pending": self.pending(),
+            "segments": len(self.segments())
+        }
+        if self.orphans:
+            status["adopted"] = [orphan.status() for orphan in self.orphans]
+        return status
+
+
+def spool_record(user_id, message_text, sender_number, sender_name, bank_detected,
+                 sms_id=None, transaction=None):
+    """Journal payload for one SMS; transaction uses the reparse.desired_row keys"""
+    return {
+        "user_id": user_id,
+        "message_text": message_text,
+        "sender_number": sender_number,
+        "sender_name": sender_name,
+        "bank_detected": bank_detected,
+        "sms_id": sms_id,
+        "received_at": datetime.now().isoformat(),
+        "transaction": transaction
+    }
+
+
+def replay_batch(spool, conn, limit=SPOOL_REPLAY_BATCH):
+    """Move one batch from the journal into Postgres; returns the number of records handled
+
+    conn is a connection, or a callable user_id -> connection when the
+    records go to several shards (each shard keeps its own replay ledger).
+    """
+    records = spool.read(spool.replayed_seq, limit)
+    if not records:
+        return 0
+    conn_for = conn if callable(conn) else (lambda user_id: conn)
+    groups = {}
+    for seq, record in records:
+        target = conn_for(record["user_id"])
+        groups.setdefault(id(target), (target, []))[1].append((seq, record))
+
+    replayed = dead = 0
+    for target, group in groups.values():
+        try:
+            replayed += _replay_records(spool, target, group)
+        except Exception as e:
+            if is_unavailable_error(e):
+                raise ConnectionError(str(e)) from e
+            # Find the records the database rejects instead of retrying the batch forever
+            for seq, record in group:
+                try:
+                    replayed += _replay_records(spool, target, [(seq, record)])
+                except Exception as error:
+                    if is_unavailable_error(error):
+                        raise ConnectionError(str(error)) from error
+                    spool.dead_letter(seq, record, error)
+                    dead += 1
+    spool.mark_replayed(records[-1][0])
+    duplicates = len(records) - replayed - dead
+    metrics.inc("spool.replayed", replayed)
+    metrics.inc("spool.replay_duplicates", duplicates)
+    log.info("📼 Replayed %d spooled SMS (%d already in the database, %d dead-lettered)",
+             replayed, duplicates, dead)
+    return len(records)
+
+
+def _replay_records(spool, conn, records):
+    """Replay records into one database in one transaction; returns how many were new there"""
+    from psycopg2.extras import execute_values
+    from reparse import insert_transactions
+
+    try:
+        with conn.cursor() as cursor:
+            claimed = execute_values(cursor, """
+                INSERT INTO spool_replayed (spool_id, seq) VALUES %s
+                ON CONFLICT DO NOTHING RETURNING seq
+            """, [(spool.spool_id, seq) for seq, _ in records], fetch=True)
+            fresh = {row[0] for row in claimed}
+            # Copies: pre-allocated ids must not outlive a rolled-back attempt
+            todo = [(seq, dict(record)) for seq, record in records if seq in fresh]
+
+            # Pre-allocate ids so each new sms_messages row is tied to its record
+            missing = [(seq, record) for seq, record in todo if record.get("sms_id") is None]
+            if missing:
+                cursor.execute("SELECT nextval('sms_messages_id_seq') FROM generate_series(1, %s)",
+                               (len(missing),))
+                for (_, record), (sms_id,) in zip(missing, cursor.fetchall()):
+                    record["sms_id"] = sms_id
+                execute_values(cursor, """
+                    INSERT INTO sms_messages
+                    (id, user_id, message_text, sender_number, sender_name,
+                     is_bank_sms, bank_detected, processed, received_at)
+                    VALUES %s
+                """, [(record["sms_id"], record["user_id"], record["message_text"], record["sender_number"],
+                       record["sender_name"], record["bank_detected"] is not None, record["bank_detected"],
+                       record["transaction"] is not None, record["received_at"]) for _, record in missing])
+
+            inserts = [(record["sms_id"], record["user_id"], record["transaction"])
+                       for _, record in todo if record.get("transaction")]
+            if inserts:
+                insert_transactions(cursor, inserts)
+                cursor.execute("UPDATE sms_messages SET processed = TRUE WHERE id = ANY(%s)",
+                               ([sms_id for sms_id, _, _ in inserts],))
+            if todo:
+                execute_values(cursor, """
+                    UPDATE spool_replayed AS r SET sms_id = v.sms_id
+                    FROM (VALUES %s) AS v(spool_id, seq, sms_id)
+                    WHERE r.spool_id = v.spool_id AND r.seq = v.seq
+                """, [(spool.spool_id, seq, record["sms_id"]) for seq, record in todo],
+                    template="(%s, %s::bigint, %s::integer)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(todo)
+
+
+def drain(spool, database):
+    """Replay everything pending, adopted journals included; reconnects the shared connection afterwards"""
+    if spool.backlog() <= 0:
+        return 0
+    conns = {}
+
+    def conn_for(user_id):
+        shard = database.shard_for(user_id)
+        if shard.name not in conns:
+            conns[shard.name] = shard.new_connection()
+        if conns[shard.name] is None:
+            raise ConnectionError(f"database {shard.name} is unavailable")
+        return conns[shard.name]
+
+    total = 0
+    try:
+        for journal in [spool, *spool.orphans]:
+            while True:
+                handled = replay_batch(journal, conn_for)
+                if not handled:
+                    break
+                total += handled
+        spool.retire_orphans()
+    except ConnectionError:
+        # Still down; the next drain() retries
+        return total
+    finally:
+        for conn in conns.values():
+            if conn is not None:
+                conn.close()
+    # Runs on a worker thread: reconnect() swaps db.conn under the connection lock
+    database.reconnect()
+    return total
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Inspect or replay the local SMS spool")
+    arg_parser.add_argument("command", choices=["status", "replay"])
+    arg_parser.add_argument("--dir", default=SPOOL_DIR)
+    args = arg_parser.parse_args()
+
+    try:
+        spool = Spool(args.dir, shared=False)
+    except BlockingIOError:
+        print(f" {args.dir} is in use by a running API process, which replays it itself")
+        raise SystemExit(1)
+    try:
+        if args.command == "status":
+            print(json.dumps(spool.status(), indent=2))
+            return
+        from database import db
+        replayed = drain(spool, db)
+        print(f" {replayed} records processed, {spool.backlog()} still pending")
+    finally:
+        spool.close()
+
+
+if __name__ == "__main__":
+    main()
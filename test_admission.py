@@ -0,0 +1,71 @@
+# test_admission.py - Priority limiter accounting under timeouts, shedding and cancellation
+
+import asyncio
+
+from admission import INTERACTIVE, AdmissionController, Overloaded, PriorityLimiter
+
+
+async def _limiter_checks():
+    limiter = PriorityLimiter("test", limit=1, queue_size=2)
+    await limiter.acquire(INTERACTIVE, 1.0)
+
+    # A waiter whose request is cancelled leaves the queue
+    waiter = asyncio.create_task(limiter.acquire(INTERACTIVE, 10.0))
+    await asyncio.sleep(0)
+    assert limiter.queued == 1
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert (limiter.queued, limiter.in_flight) == (0, 1)
+    print("  ✅ cancelled waiter releases its queue slot")
+
+    # Cancelled right after being granted: either acquire still returns (the caller
+    # owns the slot) or it raises and the slot goes back; it is never lost
+    waiter = asyncio.create_task(limiter.acquire(INTERACTIVE, 10.0))
+    await asyncio.sleep(0)
+    limiter.release()
+    waiter.cancel()
+    outcome = (await asyncio.gather(waiter, return_exceptions=True))[0]
+    owned = 0 if isinstance(outcome, BaseException) else 1
+    assert (limiter.queued, limiter.in_flight) == (0, owned)
+    if owned:
+        limiter.release()
+    print("  ✅ slot granted to a cancelled waiter is not lost")
+
+    await limiter.acquire(INTERACTIVE, 1.0)
+    try:
+        await limiter.acquire(INTERACTIVE, 0.01)
+        raise AssertionError("expected a queue timeout")
+    except Overloaded:
+        pass
+    assert (limiter.queued, limiter.in_flight) == (0, 1)
+    print("  ✅ timed-out waiter leaves the queue")
+
+
+async def _controller_checks():
+    controller = AdmissionController(route_limits="/api/sms=4", user_limit=4, global_limit=1,
+                                     reserved_for_reads=0, queue_size=4, queue_timeout_ms=10000)
+    route = controller.limiter_for("/api/sms/parse")
+    release = await controller.admit(route, 1, INTERACTIVE)
+
+    # Cancelled while queued on the global limiter: route slot and user count come back
+    waiter = asyncio.create_task(controller.admit(route, 1, INTERACTIVE))
+    await asyncio.sleep(0)
+    assert controller.global_limiter.queued == 1 and route.in_flight == 2
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert (route.in_flight, controller.global_limiter.queued) == (1, 0)
+    assert controller.user_in_flight == {1: 1}
+    release()
+    assert (route.in_flight, controller.global_limiter.in_flight, controller.user_in_flight) == (0, 0, {})
+    print("  ✅ request cancelled in the global queue releases its route slot and user count")
+
+
+def test_priority_limiter():
+    print("🧪 Testing admission limiter...\n")
+    asyncio.run(_limiter_checks())
+    asyncio.run(_controller_checks())
+    print("\n✅ Admission limiter OK")
+
+
+if __name__ == "__main__":
+    test_priority_limiter()
@@ -0,0 +1,39 @@
+# test_batch_parsing.py - Columnar batch parse must match per-message parse (no database needed)
+
+from sms_parser import SMSParser, MAX_SMS_LENGTH
+
+
+MESSAGES = [
+    "HDFC Bank: Rs. 1,500.00 debited from A/c XX1234 on 15-12-2023 at AMAZON INDIA. Avl Bal: Rs. 45,230.15",
+    "ICICI Bank: Rs. 2,750.00 spent on Credit Card XX7878 at SWIGGY on 15/12/23.",
+    "UPI: Rs. 500.00 paid to KIRANA STORE on 15-12-2023.",
+    "SBI: INR 12,000 credited to your A/c via NEFT from ACME CORP PVT LTD",
+    "Axis Bank: 3,200.50 INR withdrawn at ATM on 01 Jan 2024",
+    "Your OTP for login is 482913. Do not share it with anyone.",
+    "Paytm: Amount: 99.00 paid @ ZOMATO.",
+    "Big sale! Flat 50% off this weekend only",
+    "PhonePe: 250 Rs paid to RAHUL SHARMA on 31/12/2023",
+    "Rs. 75 debited " + "x" * (MAX_SMS_LENGTH + 50),
+    "",
+]
+
+
+def test_batch_matches_single():
+    print("🧪 Testing columnar batch parsing...\n")
+
+    parser = SMSParser(None)
+    senders = ["VK-HDFCBK"] * len(MESSAGES)
+
+    for fields in (None, ["amount", "transaction_type"], ["merchant", "date"]):
+        expected = [parser.parse(1, text, sender, fields).to_dict() for text, sender in zip(MESSAGES, senders)]
+        actual = [result.to_dict() for result in parser.parse_batch(1, MESSAGES, senders, fields)]
+        for text, single, batch in zip(MESSAGES, expected, actual):
+            assert single == batch, f"{text[:40]!r}: {single} != {batch}"
+        print(f"  ✅ fields={fields}: {len(actual)} results identical")
+
+    assert parser.parse_batch(1, []) == []
+    print("\n✅ Batch parsing OK")
+
+
+if __name__ == "__main__":
+    test_batch_matches_single()
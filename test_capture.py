@@ -0,0 +1,62 @@
+# test_capture.py - Capture anonymization and replay result diffs (no server needed)
+
+import json
+
+from capture import anonymize_query, anonymize_sender, anonymize_text, build_record, pseudonym
+from replay import diff_paths, diff_results, percentile, route_of, strip_volatile
+
+
+def test_capture_and_replay():
+    print("🧪 Testing traffic capture and replay helpers...\n")
+
+    text = "Rs.450.00 debited from A/c XX1234 to VPA rahul.s@okaxis Ref 412345678901. Avl Bal INR 1234567.50"
+    assert anonymize_text(text) == ("Rs.450.00 debited from A/c XX0000 to VPA user@upi Ref 999999999999. "
+                                    "Avl Bal INR 1234567.50")
+    assert anonymize_text("Your OTP is 834512") == "Your OTP is 999999"
+    assert anonymize_text("Card 4111 1111 1111 1111 used") == "Card 9999 9999 9999 9999 used"
+    assert anonymize_text("Aadhaar 1234-5678-9012") == "Aadhaar 9999-9999-9999"
+    assert anonymize_text("call 98765 43210.") == "call 99999 99999."
+    assert anonymize_text("Rs 500 1234 5678 on 15-12-2023 10:42") == "Rs 500 9999 9999 on 15-12-2023 10:42"
+    assert anonymize_text("Avl Bal INR 1,23,456.50, ref 12 34") == "Avl Bal INR 1,23,456.50, ref 12 34"
+    print("  ✅ identifiers masked, amounts kept")
+
+    assert pseudonym(42, "salt") == pseudonym(42, "salt") != pseudonym(43, "salt")
+    assert pseudonym(42, "salt") != pseudonym(42, "other")
+    raw = {"t": 1.0, "method": "POST", "path": "/api/sms/parse", "query": "",
+           "headers": [(b"content-type", b"application/json")], "status": 200, "latency_ms": 1.0,
+           "body": json.dumps({"user_id": 42, "message_text": "Call 9876543210",
+                               "sender_number": "+91 98765 43210", "sender_name": "Mom"}).encode()}
+    record = build_record(raw)
+    assert record["body"]["user_id"] == pseudonym(42)
+    assert record["body"]["message_text"] == "Call 9999999999"
+    assert record["body"]["sender_number"] == "+99 99999 99999" and record["body"]["sender_name"] is None
+    assert build_record(dict(raw, path="/api/transactions/42"))["path"] == f"/api/transactions/{pseudonym(42)}"
+    assert build_record(dict(raw, body=None))["body_truncated"] is True
+    assert anonymize_query("user_id=42&limit=5") == f"user_id={pseudonym(42)}&limit=5"
+    assert anonymize_sender("VK-HDFCBK") == "VK-HDFCBK"
+    print("  ✅ capture records anonymized")
+
+    assert route_of("/api/transactions/42/") == "/api/transactions/{id}/"
+    assert percentile([1, 2, 3, 4], 50) == 2 and percentile([1, 2, 3, 4], 99) == 4
+    ten = list(range(1, 11))
+    assert [percentile(ten, q) for q in (10, 50, 90, 99, 100)] == [1, 5, 9, 10, 10]
+    assert percentile([7], 50) == 7 and percentile([], 50) is None
+    before = [{"i": 0, "route": "/api/sms/parse", "status": 200, "body": {"sms_id": 1, "amount": 10.0}},
+              {"i": 1, "route": "/api/sms/parse", "status": 200, "body": {"sms_id": 2, "amount": 20.0}}]
+    after = [{"i": 0, "route": "/api/sms/parse", "status": 200, "body": {"sms_id": 7, "amount": 10.0}},
+             {"i": 1, "route": "/api/sms/parse", "status": 200, "body": {"sms_id": 8, "amount": 25.0}}]
+    report = diff_results(before, after)
+    assert report["compared"] == 2 and report["body"] == 1 and report["status"] == 0
+    assert report["examples"][0]["paths"] == [".amount"]
+    report = diff_results(before, [dict(after[0], status=500)])
+    assert (report["compared"], report["status"], report["missing"]) == (1, 1, 1)
+    nested = {"transactions": [{"id": 1, "amount": 5.0}], "created_at": "now"}
+    assert strip_volatile(nested, {"id", "created_at"}) == {"transactions": [{"amount": 5.0}]}
+    assert diff_paths({"a": [1, {"b": 2}]}, {"a": [1, {"b": 3}]}) == [".a[1].b"]
+    print("  ✅ result diffs ignore row ids")
+
+    print("\n✅ Capture and replay OK")
+
+
+if __name__ == "__main__":
+    test_capture_and_replay()
@@ -0,0 +1,55 @@
+# test_dedupe.py - Duplicate-notification index (no database needed)
+
+from datetime import date
+
+from dedupe import DuplicateIndex, merchant_similarity
+
+
+def test_duplicate_index():
+    print("🧪 Testing duplicate notification index...\n")
+
+    day = date(2023, 12, 15)
+    index = DuplicateIndex(window_s=600, max_per_user=3, max_users=2)
+    index.remember(1, 349.0, day, "DEBIT", 10, "SWIGGY", sender="VK-HDFCBK", now=0)
+
+    # The app notification for the same payment links to it
+    assert index.find(1, 349.0, day, "DEBIT", "Swiggy Ltd", sender="VM-PHONPE", now=60) == (10, 1.0)
+    assert index.find(1, 349.0, day, "DEBIT", None, sender="VM-PHONPE", now=60) == (10, None)
+    print("  ✅ second notification matched")
+
+    # Same sender twice is two payments; other merchant, direction or amount is another payment
+    assert index.find(1, 349.0, day, "DEBIT", "SWIGGY", sender="VK-HDFCBK", now=60) is None
+    assert index.find(1, 349.0, day, "DEBIT", "SWIGGY", now=60) is None
+    unknown_senders = DuplicateIndex()
+    unknown_senders.remember(4, 120.0, day, "DEBIT", 55, "BLUE TOKAI", now=0)
+    assert unknown_senders.find(4, 120.0, day, "DEBIT", "BLUE TOKAI", now=60) is None
+    assert index.find(1, 349.0, day, "DEBIT", "RAHUL SHARMA", sender="VM-PHONPE", now=60) is None
+    assert index.find(1, 349.0, day, "CREDIT", "SWIGGY", sender="VM-PHONPE", now=60) is None
+    assert index.find(1, 350.0, day, "DEBIT", "SWIGGY", sender="VM-PHONPE", now=60) is None
+    assert index.find(2, 349.0, day, "DEBIT", "SWIGGY", sender="VM-PHONPE", now=60) is None
+    print("  ✅ distinct payments kept apart")
+
+    # Outside the window the entry is gone
+    assert index.find(1, 349.0, day, "DEBIT", "SWIGGY", sender="VM-PHONPE", now=601) is None
+    print("  ✅ entries expire after the window")
+
+    # Bounded: oldest entries per user, least recently active users evicted
+    for position in range(5):
+        index.remember(1, 100.0 + position, day, "DEBIT", position, now=700)
+    assert index.stats() == {"users": 1, "entries": 3}
+    assert index.find(1, 100.0, day, "DEBIT", sender="X", now=700) is None
+    index.remember(2, 1.0, day, "DEBIT", 1, now=700)
+    index.remember(3, 1.0, day, "DEBIT", 1, now=700)
+    assert index.stats()["users"] == 2 and index.find(1, 104.0, day, "DEBIT", sender="X", now=700) is None
+    print("  ✅ memory bounded per user and across users")
+
+    assert merchant_similarity("AMAZON INDIA", "Amazon") == 1.0
+    assert merchant_similarity("Unknown Merchant", "Amazon") is None
+    assert merchant_similarity("Ola", "Coca Cola") < 0.6
+    assert merchant_similarity("Jio", "Jio Mart") < 0.6
+    assert merchant_similarity("A", "B", 7, 7) == 1.0
+    print("\n✅ Duplicate index OK")
+
+
+if __name__ == "__main__":
+    test_duplicate_index()
@@ -0,0 +1,33 @@
+# test_merchant_index.py - Merchant canonicalization checks (no database needed)
+
+from merchant_index import MerchantIndex
+
+
+def test_merchant_canonicalization():
+    print("🧪 Testing Merchant Index...\n")
+
+    index = MerchantIndex.from_defaults(cache_size=2)
+
+    # Alias variants collapse onto one canonical merchant
+    amazon_ids = set()
+    for raw in ["Amazon India", "Amazon Pay", "Amzn", "AMAZON SELLER SERVICES PVT LTD", "Pos Amazon India"]:
+        merchant_id, name, category = index.lookup(raw)
+        print(f"  {raw!r} -> {name} ({merchant_id}, {category})")
+        assert name == "Amazon"
+        assert category == "Shopping"
+        amazon_ids.add(merchant_id)
+    assert len(amazon_ids) == 1
+
+    # Unknown merchants keep their raw name and land in the bounded LRU
+    for raw in ["Corner Cafe", "Sharma Sweets", "Local Chemist"]:
+        merchant_id, name, category = index.lookup(raw)
+        assert merchant_id is None and name == raw and category == "Uncategorized"
+    assert len(index.unknown_cache) == 2
+
+    # No merchant at all
+    assert index.lookup(None) == (None, None, "Uncategorized")
+    print("\n✅ Merchant index OK")
+
+
+if __name__ == "__main__":
+    test_merchant_canonicalization()
@@ -0,0 +1,49 @@
+# test_prefilter.py - Prefilter verdicts and parser short-circuit (no database needed)
+
+import time
+
+from prefilter import SMSPrefilter, TRANSACTIONAL, OTP, PROMOTIONAL, OTHER
+from sms_parser import SMSParser
+
+
+CASES = [
+    ("HDFC Bank: Rs. 1,500.00 debited from A/c XX1234 on 15-12-2023 at AMAZON INDIA.", "VK-HDFCBK", TRANSACTIONAL),
+    ("SBI: INR 12,000 credited to your A/c via NEFT from ACME CORP PVT LTD", "AD-SBIINB-S", TRANSACTIONAL),
+    ("Paytm: Amount: 99.00 paid @ ZOMATO.", None, TRANSACTIONAL),
+    ("Rs. 500 debited for your order. OTP was not required.", "VK-HDFCBK", TRANSACTIONAL),
+    ("Your OTP for login is 482913. Do not share it with anyone.", "VK-HDFCBK", OTP),
+    ("Big sale! Flat 50% off this weekend only", "AD-MYNTRA-P", PROMOTIONAL),
+    ("Get a pre-approved loan upto Rs 5 lakh. Apply now https://x.co/a", "VM-HDFCBK", PROMOTIONAL),
+    ("Reached home, call you later", "+91 98765 43210", OTHER),
+    ("", None, OTHER),
+]
+
+
+def test_prefilter():
+    print("🧪 Testing SMS prefilter...\n")
+
+    prefilter = SMSPrefilter()
+    for text, sender, expected in CASES:
+        actual = prefilter.classify(text, sender)
+        assert actual == expected, f"{text[:40]!r}: {actual} != {expected}"
+        print(f"  ✅ {expected:<13} {text[:50]!r}")
+
+    # Long digit runs must not backtrack quadratically (this took seconds before)
+    for text in ("1" * 20000, "1," * 10000, "9" * 20000 + " % off", "1" * 20000 + ".50 INR"):
+        started = time.perf_counter()
+        prefilter.classify(text)
+        assert time.perf_counter() - started < 0.5, f"{text[:12]!r}... took too long"
+    assert prefilter.classify("1" * 5000 + ".50 INR") == TRANSACTIONAL
+    print("  ✅ long digit runs classified in linear time")
+
+    parser = SMSParser(None)
+    result = parser.parse(1, "Your OTP for login is 482913. Do not share it with anyone.", "VK-HDFCBK")
+    assert result.message_class == OTP
+    assert not result.success and result.amount.value is None
+    result = parser.parse(1, CASES[0][0], CASES[0][1])
+    assert result.message_class == TRANSACTIONAL and result.amount.value == 1500.0
+    print("\n✅ Prefilter OK")
+
+
+if __name__ == "__main__":
+    test_prefilter()
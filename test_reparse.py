@@ -0,0 +1,28 @@
+# test_reparse.py - Rows the re-parse job and queue workers would write (no database needed)
+
+from datetime import date, datetime
+
+from reparse import desired_row
+from sms_parser import SMSParser
+
+
+def test_desired_row():
+    print("🧪 Testing re-parse row derivation...\n")
+
+    parser = SMSParser(None)
+    received_at = datetime(2024, 1, 15, 9, 30)
+
+    dated = parser.parse(1, "INR 1,250.00 spent on HDFC Bank card XX9876 at SWIGGY on 12-01-2024", "VM-HDFCBK")
+    assert desired_row(dated, received_at)["transaction_date"] == date(2024, 1, 12)
+    print("  ✅ date from the message text kept")
+
+    undated = parser.parse(1, "INR 1,250.00 spent on HDFC Bank card XX9876 at SWIGGY", "VM-HDFCBK")
+    assert undated.date.confidence < 0.9
+    assert desired_row(undated, received_at)["transaction_date"] == date(2024, 1, 15)
+    print("  ✅ dateless message dated by received_at, not by the run")
+
+    print("\n✅ Re-parse rows OK")
+
+
+if __name__ == "__main__":
+    test_desired_row()
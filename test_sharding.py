@@ -0,0 +1,41 @@
+# test_sharding.py - Consistent-hash shard routing (no database needed)
+
+from sharding import ShardRouter, parse_shards
+
+
+def test_router():
+    print("🧪 Testing shard router...\n")
+
+    shards = parse_shards("s0=postgresql://pg0/finapp_sms, s1=host=pg1 dbname=finapp_sms")
+    assert shards == [("s0", "postgresql://pg0/finapp_sms"), ("s1", "host=pg1 dbname=finapp_sms")]
+
+    users = range(1, 20001)
+    two = ShardRouter(["s0", "s1"])
+    three = ShardRouter(["s0", "s1", "s2"])
+    swapped = ShardRouter(["s1", "s0"])
+    before = {user_id: two.shard_for(user_id) for user_id in users}
+    after = {user_id: three.shard_for(user_id) for user_id in users}
+
+    # Deterministic, and every shard gets a fair share
+    assert before == {user_id: swapped.shard_for(user_id) for user_id in users}
+    for name in ("s0", "s1", "s2"):
+        share = sum(1 for owner in after.values() if owner == name) / len(after)
+        assert 0.2 < share < 0.47, f"{name}: {share:.2%}"
+        print(f"  ✅ {name}: {share:.1%} of users")
+
+    # Adding a shard only moves users onto the new shard (about a third of them)
+    moved = [user_id for user_id in users if before[user_id] != after[user_id]]
+    assert all(after[user_id] == "s2" for user_id in moved)
+    print(f"  ✅ adding s2 moved {len(moved) / len(before):.1%} of users, all to s2")
+
+    for bad in ("", "s0", "s0=a,s0=b"):
+        try:
+            parse_shards(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"{bad!r} should be rejected")
+    print("\n✅ Shard routing OK")
+
+
+if __name__ == "__main__":
+    test_router()
@@ -45,10 +45,10 @@ def test_parser():
         print(f"📱 Testing: {test['name']}")
         result = parser.parse_sms(user_id=1, message_text=test['sms'])
         
-        if result["success"]:
-            amount = result["parsed_data"]["amount"]
-            merchant = result["parsed_data"]["merchant"]
-            confidence = result["confidence"]
+        if result.success:
+            amount = result.amount.value
+            merchant = result.merchant.value
+            confidence = result.confidence
             
             if abs(amount - test['expected']) < 0.01:
                 print(f"  ✅ PASS: Rs. {amount} at {merchant} (confidence: {confidence:.2%})")
@@ -0,0 +1,107 @@
+# test_spool.py - Local SMS journal: append, crash recovery, replay (replay needs PostgreSQL)
+
+import os
+import json
+import tempfile
+
+import psycopg2
+
+from spool import HEADER, Spool, replay_batch, spool_record
+
+
+def test_append_and_recover():
+    print("🧪 Testing spool journal...\n")
+
+    with tempfile.TemporaryDirectory() as directory:
+        spool = Spool(directory, segment_bytes=4096, shared=False)
+        for position in range(40):
+            assert spool.append({"n": position, "text": "x" * 100}) == position + 1
+        assert len(spool.segments()) > 1
+        assert [record["n"] for _, record in spool.read(0, 100)] == list(range(40))
+        assert [seq for seq, _ in spool.read(35, 100)] == [36, 37, 38, 39, 40]
+        spool.mark_replayed(30)
+        assert spool.pending() == 10
+        spool.close()
+        print("  ✅ records appended across segments and read back in order")
+
+        # A crash mid-append: a payload without its header, and a header whose CRC does not match
+        reopened = Spool(directory, segment_bytes=4096, shared=False)
+        tail, offset = reopened._segment_path, reopened._offset
+        reopened.close()
+        with open(tail, "r+b") as segment:
+            segment.seek(offset + HEADER.size)
+            segment.write(b'{"n": "torn"}')
+            segment.seek(offset)
+            segment.write(HEADER.pack(0x53504C31, 13, 41, 12345))
+
+        recovered = Spool(directory, segment_bytes=4096, shared=False)
+        assert recovered.last_seq == 40 and recovered.replayed_seq == 30
+        assert recovered.append({"n": 40}) == 41
+        assert recovered.read(40, 10) == [(41, {"n": 40})]
+        recovered.close()
+        print("  ✅ torn and corrupt tail records ignored after a restart")
+
+
+def test_adopts_orphaned_journals():
+    with tempfile.TemporaryDirectory() as directory:
+        orphan = Spool(os.path.join(directory, "pid-12345"), shared=False)
+        orphan.append({"n": 1})
+        orphan.close()
+
+        spool = Spool(directory, shared=False)
+        assert spool.backlog() == 1 and len(spool.orphans) == 1
+        spool.orphans[0].mark_replayed(1)
+        spool.retire_orphans()
+        assert not spool.orphans and not os.path.exists(os.path.join(directory, "pid-12345"))
+        spool.close()
+        print("  ✅ journals of exited processes adopted and removed once replayed")
+
+
+def test_replay_idempotent():
+    try:
+        conn = psycopg2.connect(host=os.getenv('DB_HOST', 'localhost'), database=os.getenv('DB_NAME', 'finapp_sms'),
+                                user=os.getenv('DB_USER', 'postgres'), password=os.getenv('DB_PASSWORD', 'postgres123'),
+                                port=os.getenv('DB_PORT', '5432'), connect_timeout=2)
+    except psycopg2.OperationalError:
+        print("  ⏭️ replay checks skipped (no database)")
+        return
+    user_id = 2000000011
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('spool_replayed') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                print("  ⏭️ replay checks skipped (schema not created)")
+                return
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory, shared=False)
+            spool.append(spool_record(user_id, "Rs.10 spent", "VK-HDFCBK", None, "HDFC"))
+            spool.append(spool_record(user_id, "bad", "VK-HDFCBK", "x" * 500, None))
+            spool.append(spool_record(user_id, "Rs.20 spent", "VK-HDFCBK", None, "HDFC"))
+
+            assert replay_batch(spool, conn) == 3
+            # A crash before the watermark was stored replays the batch again
+            spool._store_replayed_seq(0)
+            assert replay_batch(spool, conn) == 3
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT message_text FROM sms_messages WHERE user_id = %s ORDER BY id", (user_id,))
+                assert [row[0] for row in cursor.fetchall()] == ["Rs.10 spent", "Rs.20 spent"]
+            conn.rollback()
+            with open(os.path.join(directory, "dead-letter.jsonl")) as dead:
+                letters = [json.loads(line) for line in dead]
+            assert [letter["seq"] for letter in letters] == [2, 2]
+            spool.close()
+        print("  ✅ replay is idempotent and dead-letters records the database rejects")
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM spool_replayed WHERE sms_id IN (SELECT id FROM sms_messages WHERE user_id = %s)",
+                           (user_id,))
+            cursor.execute("DELETE FROM sms_messages WHERE user_id = %s", (user_id,))
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    test_append_and_recover()
+    test_adopts_orphaned_journals()
+    test_replay_idempotent()
+    print("\n✅ Spool OK")